@@ -1,10 +1,14 @@
-import copy
+import base64
+import binascii
 import json
 import os
 import logging
 import uuid
+import hashlib
 import httpx
 import asyncio
+import math
+from functools import wraps
 from quart import (
     Blueprint,
     Quart,
@@ -14,16 +18,29 @@ from quart import (
     send_from_directory,
     render_template,
     current_app,
+    copy_current_request_context,
+    g,
 )
+from quart.wrappers.response import ResponseBody
 
-from openai import AsyncAzureOpenAI
-from azure.identity.aio import (
-    DefaultAzureCredential,
-    get_bearer_token_provider
-)
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+from azure.cosmos.exceptions import CosmosHttpResponseError
+from azure.identity.aio import DefaultAzureCredential
 from backend.auth.auth_utils import get_authenticated_user_details
+from backend.auth.graph_groups import GraphGroupResolver
+from backend.auth.token_cache import CachedTokenProvider
+from backend.function_calling.tool_executor import ToolExecutor
+from backend.function_calling.tool_registry import ToolRegistry
 from backend.security.ms_defender_utils import get_msdefender_user_json
 from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history_trimming import HistoryTrimmer, SummaryCache, TokenCounter
+from backend.response_cache import CacheLookup, ResponseCache, normalize_question
+from backend.admission import AdmissionController, RateLimitExceeded
+from backend.fair_scheduler import FairScheduler
+from backend.load_balancer import Deployment, LoadBalancer, TrackedStream
+from backend.resilience import RetryBudget, RetryPolicy
+from backend.single_flight import SingleFlight
+from backend.metrics import metrics
 from backend.settings import (
     app_settings,
     MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION
@@ -34,20 +51,99 @@ from backend.utils import (
     format_non_streaming_response,
     convert_to_pf_format,
     format_pf_non_streaming_response,
+    format_pf_stream_response,
+    parse_pf_stream,
+    format_cached_stream_response,
+    format_cached_non_streaming_response,
+    RedactedModelArgs,
+    close_stream,
 )
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
 
 cosmos_db_ready = asyncio.Event()
 
+response_cache = (
+    ResponseCache(
+        ttl=app_settings.response_cache.ttl,
+        max_entries=app_settings.response_cache.max_entries,
+        max_bytes=app_settings.response_cache.max_bytes,
+        similarity_threshold=app_settings.response_cache.similarity_threshold,
+    )
+    if app_settings.response_cache.enabled
+    else None
+)
+response_cache_config_hash = None
+
+single_flight = (
+    SingleFlight(max_buffered_chunks=app_settings.azure_openai.coalesce_max_buffered_chunks)
+    if app_settings.azure_openai.coalesce_concurrent_requests
+    else None
+)
+
+retry_policy = RetryPolicy(
+    max_attempts=app_settings.azure_openai.retry_max_attempts,
+    base_delay=app_settings.azure_openai.retry_base_delay,
+    max_delay=app_settings.azure_openai.retry_max_delay,
+    budget=RetryBudget(
+        ratio=app_settings.azure_openai.retry_budget_ratio,
+        min_retries_per_second=app_settings.azure_openai.retry_budget_min_per_second,
+    ),
+    hedge_percentile=app_settings.azure_openai.hedge_percentile,
+)
+
+fair_scheduler = (
+    FairScheduler(
+        max_concurrency=app_settings.request_limits.max_concurrency,
+        per_user_concurrency=app_settings.request_limits.per_user_concurrency,
+        max_queue_depth=app_settings.request_limits.max_queue_depth,
+        max_wait=app_settings.request_limits.max_wait,
+        user_weights=app_settings.request_limits.user_weights,
+    )
+    if app_settings.request_limits.enabled
+    else None
+)
+
+HISTORY_SUMMARY_MAX_TOKENS = 256
+history_trimmer = (
+    HistoryTrimmer(app_settings.azure_openai.history_token_budget)
+    if app_settings.azure_openai.history_token_budget
+    else None
+)
+history_summary_cache = SummaryCache()
+# Prompt token estimates for admission control share the trimmer's counts
+token_counter = history_trimmer or TokenCounter()
+
 
 def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
+    app.azure_openai_client = None
+    app.azure_openai_token_provider = None
+    app.azure_openai_load_balancer = None
+    app.azure_openai_tool_registry = None
+    app.azure_openai_tool_executor = None
+    app.azure_functions_http_client = None
+    app.graph_group_resolver = None
+    app.promptflow_http_client = None
     
     @app.before_serving
     async def init():
+        try:
+            app.azure_openai_client = await init_openai_client()
+        except Exception:
+            # Defer to the first request so misconfiguration is reported per call
+            logging.exception("Failed to initialize Azure OpenAI client")
+            app.azure_openai_client = None
+
+        load_balancer = app.azure_openai_load_balancer
+        if history_trimmer or (load_balancer and load_balancer.admission_enabled):
+            await asyncio.to_thread(token_counter.load_encoding)
+
+        if app_settings.base_settings.use_promptflow:
+            app.promptflow_http_client = init_promptflow_client()
+
         try:
             app.cosmos_conversation_client = await init_cosmosdb_client()
             cosmos_db_ready.set()
@@ -55,6 +151,35 @@ def create_app():
             logging.exception("Failed to initialize CosmosDB client")
             app.cosmos_conversation_client = None
             raise e
+
+    @app.after_serving
+    async def shutdown():
+        if app.azure_openai_client:
+            # Closes the transport shared with the other deployments of the pool
+            await app.azure_openai_client.close()
+            app.azure_openai_client = None
+            app.azure_openai_load_balancer = None
+
+        if app.azure_openai_token_provider:
+            await app.azure_openai_token_provider.close()
+            app.azure_openai_token_provider = None
+
+        if app.azure_openai_tool_registry:
+            await app.azure_openai_tool_registry.close()
+            app.azure_openai_tool_registry = None
+            app.azure_openai_tool_executor = None
+
+        if app.azure_functions_http_client:
+            await app.azure_functions_http_client.aclose()
+            app.azure_functions_http_client = None
+
+        if app.graph_group_resolver:
+            await app.graph_group_resolver.close()
+            app.graph_group_resolver = None
+
+        if app.promptflow_http_client:
+            await app.promptflow_http_client.aclose()
+            app.promptflow_http_client = None
     
     return app
 
@@ -111,13 +236,36 @@ frontend_settings = {
 MS_DEFENDER_ENABLED = os.environ.get("MS_DEFENDER_ENABLED", "true").lower() == "true"
 
 
-azure_openai_tools = []
-azure_openai_available_tools = []
+azure_openai_client_lock = asyncio.Lock()
+
+
+def init_admission_controller(name, tokens_per_minute, requests_per_minute):
+    if not tokens_per_minute and not requests_per_minute:
+        return None
+
+    return AdmissionController(
+        tokens_per_minute=tokens_per_minute,
+        requests_per_minute=requests_per_minute,
+        max_wait=app_settings.azure_openai.admission_max_wait,
+        max_queue_depth=app_settings.azure_openai.admission_max_queue_depth,
+        name=name,
+    )
+
+
+async def close_all(resources):
+    # Closes what an initialization had created before it failed, most recent first
+    for close in reversed(resources):
+        try:
+            await close()
+        except Exception:
+            logging.exception("Exception while closing a partly initialized resource")
+
 
 # Initialize Azure OpenAI Client
 async def init_openai_client():
-    azure_openai_client = None
-    
+    # The app only keeps the clients once all of them were created
+    resources = []
+
     try:
         # API version check
         if (
@@ -143,68 +291,189 @@ async def init_openai_client():
             else f"https://{app_settings.azure_openai.resource}.openai.azure.com/"
         )
 
+        # Deployment
+        deployment = app_settings.azure_openai.model
+        if not deployment:
+            raise ValueError("AZURE_OPENAI_MODEL is required")
+
+        # Remote function calls
+        if app_settings.azure_openai.function_call_azure_functions_enabled and (
+            not app_settings.azure_openai.function_call_azure_functions_tools_base_url or
+            not app_settings.azure_openai.function_call_azure_functions_tool_base_url
+        ):
+            raise ValueError(
+                "AZURE_OPENAI_FUNCTION_CALL_AZURE_FUNCTIONS_TOOLS_BASE_URL and AZURE_OPENAI_FUNCTION_CALL_AZURE_FUNCTIONS_TOOL_BASE_URL are required"
+            )
+
         # Authentication
         aoai_api_key = app_settings.azure_openai.key
         ad_token_provider = None
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure Entra ID auth")
-            async with DefaultAzureCredential() as credential:
-                ad_token_provider = get_bearer_token_provider(
-                    credential,
-                    "https://cognitiveservices.azure.com/.default"
-                )
-
-        # Deployment
-        deployment = app_settings.azure_openai.model
-        if not deployment:
-            raise ValueError("AZURE_OPENAI_MODEL is required")
+            # One credential per worker, with tokens refreshed ahead of expiry
+            ad_token_provider = CachedTokenProvider(
+                DefaultAzureCredential(),
+                refresh_margin=app_settings.azure_openai.token_refresh_margin,
+            )
+            # Also closes the credential if the first token cannot be acquired
+            resources.append(ad_token_provider.close)
+            await ad_token_provider.start()
 
         # Default Headers
         default_headers = {"x-ms-useragent": USER_AGENT}
 
         # Remote function calls
+        tool_registry = None
+        tool_executor = None
+        azure_functions_http_client = None
         if app_settings.azure_openai.function_call_azure_functions_enabled:
+            # Tool metadata and tool calls share one pooled client
+            azure_functions_http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_keepalive_connections=app_settings.azure_openai.function_call_azure_functions_max_concurrency,
+                    keepalive_expiry=app_settings.azure_openai.http_keepalive_expiry,
+                ),
+                timeout=app_settings.azure_openai.function_call_azure_functions_timeout,
+            )
+            resources.append(azure_functions_http_client.aclose)
+
             azure_functions_tools_url = f"{app_settings.azure_openai.function_call_azure_functions_tools_base_url}?code={app_settings.azure_openai.function_call_azure_functions_tools_key}"
-            async with httpx.AsyncClient() as client:
-                response = await client.get(azure_functions_tools_url)
-            response_status_code = response.status_code
-            if response_status_code == httpx.codes.OK:
-                azure_openai_tools.extend(json.loads(response.text))
-                for tool in azure_openai_tools:
-                    azure_openai_available_tools.append(tool["function"]["name"])
-            else:
-                logging.error(f"An error occurred while getting OpenAI Function Call tools metadata: {response.status_code}")
+            tool_registry = ToolRegistry(
+                azure_functions_tools_url,
+                ttl=app_settings.azure_openai.function_call_azure_functions_tools_ttl,
+                http_client=azure_functions_http_client,
+            )
+            resources.append(tool_registry.close)
+            await tool_registry.start()
+
+            azure_functions_tool_url = f"{app_settings.azure_openai.function_call_azure_functions_tool_base_url}?code={app_settings.azure_openai.function_call_azure_functions_tool_key}"
+            tool_executor = ToolExecutor(
+                azure_functions_tool_url,
+                http_client=azure_functions_http_client,
+                max_concurrency=app_settings.azure_openai.function_call_azure_functions_max_concurrency,
+                timeout=app_settings.azure_openai.function_call_azure_functions_timeout,
+            )
+
+        # Pooled HTTP transport, shared by every request served by this worker
+        http_client = DefaultAsyncHttpxClient(
+            http2=app_settings.azure_openai.http2,
+            limits=httpx.Limits(
+                max_connections=app_settings.azure_openai.http_max_connections,
+                max_keepalive_connections=app_settings.azure_openai.http_max_keepalive_connections,
+                keepalive_expiry=app_settings.azure_openai.http_keepalive_expiry,
+            ),
+        )
+        resources.append(http_client.aclose)
 
-        
         azure_openai_client = AsyncAzureOpenAI(
             api_version=app_settings.azure_openai.preview_api_version,
             api_key=aoai_api_key,
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=http_client,
         )
 
-        return azure_openai_client
+        # Additional deployments share the transport and credential of the primary one
+        deployments = [
+            Deployment(
+                "primary",
+                azure_openai_client,
+                deployment,
+                weight=app_settings.azure_openai.weight,
+                title_model=app_settings.azure_openai.title_model,
+                admission=init_admission_controller(
+                    "primary",
+                    app_settings.azure_openai.tokens_per_minute,
+                    app_settings.azure_openai.requests_per_minute,
+                ),
+            )
+        ]
+        for index, pool_deployment in enumerate(app_settings.azure_openai.deployments, start=1):
+            name = pool_deployment.name or f"deployment-{index}"
+            deployments.append(Deployment(
+                name,
+                AsyncAzureOpenAI(
+                    api_version=app_settings.azure_openai.preview_api_version,
+                    api_key=pool_deployment.key or aoai_api_key,
+                    azure_ad_token_provider=None if pool_deployment.key else ad_token_provider,
+                    default_headers=default_headers,
+                    azure_endpoint=pool_deployment.endpoint,
+                    http_client=http_client,
+                ),
+                pool_deployment.model,
+                weight=pool_deployment.weight,
+                title_model=pool_deployment.title_model,
+                admission=init_admission_controller(
+                    name,
+                    pool_deployment.tokens_per_minute,
+                    pool_deployment.requests_per_minute,
+                ),
+            ))
+        load_balancer = LoadBalancer(
+            deployments,
+            failure_threshold=app_settings.azure_openai.breaker_failure_threshold,
+            cooldown=app_settings.azure_openai.breaker_cooldown,
+        )
     except Exception as e:
-        logging.exception("Exception in Azure OpenAI initialization", e)
-        azure_openai_client = None
+        logging.exception("Exception in Azure OpenAI initialization")
+        await close_all(resources)
         raise e
 
-async def openai_remote_azure_function_call(function_name, function_args):
-    if app_settings.azure_openai.function_call_azure_functions_enabled is not True:
-        return
+    current_app.azure_openai_token_provider = ad_token_provider
+    current_app.azure_functions_http_client = azure_functions_http_client
+    current_app.azure_openai_tool_registry = tool_registry
+    current_app.azure_openai_tool_executor = tool_executor
+    current_app.azure_openai_load_balancer = load_balancer
+    return azure_openai_client
 
-    azure_functions_tool_url = f"{app_settings.azure_openai.function_call_azure_functions_tool_base_url}?code={app_settings.azure_openai.function_call_azure_functions_tool_key}"
-    headers = {'content-type': 'application/json'}
-    body = {
-        "tool_name": function_name,
-        "tool_arguments": json.loads(function_args)
-    }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(azure_functions_tool_url, data=json.dumps(body), headers=headers)
-    response.raise_for_status()
 
-    return response.text
+async def get_openai_client():
+    # The client is normally created once in before_serving; fall back to a
+    # lazy, one-time initialization for app instances that skip startup hooks.
+    if current_app.azure_openai_client is None:
+        async with azure_openai_client_lock:
+            if current_app.azure_openai_client is None:
+                current_app.azure_openai_client = await init_openai_client()
+
+    return current_app.azure_openai_client
+
+
+async def get_load_balancer():
+    # Built alongside the primary client
+    await get_openai_client()
+    return current_app.azure_openai_load_balancer
+
+
+def get_graph_group_resolver():
+    # Only document-level security on Azure AI Search needs Graph; create on first use
+    if current_app.graph_group_resolver is None:
+        current_app.graph_group_resolver = GraphGroupResolver(
+            ttl=app_settings.datasource.permitted_groups_cache_ttl,
+            max_entries=app_settings.datasource.permitted_groups_cache_size,
+        )
+
+    return current_app.graph_group_resolver
+
+
+async def get_security_filter():
+    # Resolved once per request: both the data source payload and the response cache use it
+    if "security_filter" not in g:
+        g.security_filter = None
+        if getattr(app_settings.datasource, "permitted_groups_column", None):
+            g.security_filter = await app_settings.datasource.resolve_filter_string(
+                request, get_graph_group_resolver()
+            )
+
+    return g.security_filter
+
+
+async def openai_remote_azure_function_calls(tool_calls):
+    # Runs the (name, arguments) pairs concurrently; results keep the input order
+    if app_settings.azure_openai.function_call_azure_functions_enabled is not True:
+        return [None] * len(tool_calls)
+
+    return await current_app.azure_openai_tool_executor.call_all(tool_calls)
 
 async def init_cosmosdb_client():
     cosmos_conversation_client = None
@@ -227,6 +496,7 @@ async def init_cosmosdb_client():
                 database_name=app_settings.chat_history.database,
                 container_name=app_settings.chat_history.conversations_container,
                 enable_message_feedback=app_settings.chat_history.enable_feedback,
+                delete_concurrency=app_settings.chat_history.delete_concurrency,
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
@@ -238,7 +508,7 @@ async def init_cosmosdb_client():
     return cosmos_conversation_client
 
 
-def prepare_model_args(request_body, request_headers):
+async def prepare_model_args(request_body, request_headers):
     request_messages = request_body.get("messages", [])
     messages = []
     if not app_settings.datasource:
@@ -273,6 +543,8 @@ def prepare_model_args(request_body, request_headers):
                     
                     messages.append(messages_helper)
 
+    if history_trimmer:
+        messages = await trim_history(messages)
 
     user_security_context = None
     if (MS_DEFENDER_ENABLED):
@@ -293,87 +565,148 @@ def prepare_model_args(request_body, request_headers):
 
     if len(messages) > 0:
         if messages[-1]["role"] == "user":
-            if app_settings.azure_openai.function_call_azure_functions_enabled and len(azure_openai_tools) > 0:
-                model_args["tools"] = azure_openai_tools
+            tool_registry = current_app.azure_openai_tool_registry
+            if app_settings.azure_openai.function_call_azure_functions_enabled and tool_registry and tool_registry.tools:
+                model_args["tools"] = tool_registry.tools
 
             if app_settings.datasource:
                 model_args["extra_body"] = {
                     "data_sources": [
                         app_settings.datasource.construct_payload_configuration(
-                            request=request
+                            filter_string=await get_security_filter()
                         )
                     ]
                 }
 
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = [
-            "key",
-            "connection_string",
-            "embedding_key",
-            "encoded_api_key",
-            "api_key",
-        ]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["data_sources"][0]["parameters"].get(
-                secret_param
-            ):
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    secret_param
-                ] = "*****"
-        authentication = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    "authentication"
-                ][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("embedding_dependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
-                if field in secret_params:
-                    model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                        "embedding_dependency"
-                    ]["authentication"][field] = "*****"
+    # Rendered with secrets masked only if debug logging is enabled
+    logging.debug("REQUEST BODY: %s", RedactedModelArgs(model_args))
 
     if model_args.get("extra_body") is None:
         model_args["extra_body"] = {}
     if user_security_context:  # security component introduced here https://learn.microsoft.com/en-us/azure/defender-for-cloud/gain-end-user-context-ai     
                 model_args["extra_body"]["user_security_context"]= user_security_context.to_dict()
-    logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
 
     return model_args
 
 
-async def promptflow_request(request):
+def summary_message(summary):
+    return {
+        "role": "assistant",
+        "content": f"Summary of the earlier conversation: {summary}"
+    }
+
+
+async def summarize_history(conversation_messages, previous_summary=None):
+    summary_prompt = "Summarize the conversation so far in a few sentences. Keep names, facts and decisions the user may refer back to. Do not include any other commentary."
+
+    messages = [
+        {"role": msg["role"], "content": msg["content"]}
+        for msg in conversation_messages
+        if msg["role"] in ("user", "assistant") and msg.get("content")
+    ]
+    prompt = [{"role": "user", "content": summary_prompt}]
+    # The summary prompt stays within the history budget: the earlier summary
+    # is carried over and only the newest turns that fit beside it are sent
+    head = [summary_message(previous_summary)] if previous_summary else []
+    fixed_tokens = history_trimmer.count_tokens(head + prompt) + HISTORY_SUMMARY_MAX_TOKENS
+    messages = head + history_trimmer.fit(messages, history_trimmer.budget - fixed_tokens) + prompt
+
     try:
-        headers = {
+        azure_openai_client = await get_openai_client()
+        response = await azure_openai_client.chat.completions.create(
+            model=app_settings.azure_openai.model,
+            messages=messages,
+            temperature=0,
+            max_tokens=HISTORY_SUMMARY_MAX_TOKENS
+        )
+        metrics.counter("history.summaries").inc()
+        return response.choices[0].message.content
+    except Exception:
+        metrics.counter("history.summary_failures").inc()
+        logging.exception("Exception while summarizing conversation history")
+        return None
+
+
+async def trim_history(messages):
+    # Keep the prompt within the configured token budget, optionally replacing
+    # the dropped turns with a short summary
+    summarize = app_settings.azure_openai.history_summarize
+    kept, dropped = history_trimmer.trim(
+        messages,
+        reserved_tokens=HISTORY_SUMMARY_MAX_TOKENS if summarize else 0
+    )
+    if not dropped or not summarize:
+        return kept
+
+    head_end = next(i for i, message in enumerate(messages) if message["role"] != "system")
+    head, history, latest = messages[:head_end], messages[head_end:-1], messages[-1:]
+
+    # A summary cached by an earlier turn is reused while the turns after it fit
+    covered, summary = history_summary_cache.get(history)
+    if covered < len(dropped):
+        # Summarize up to half of the history budget ahead of the trimmed
+        # boundary, so the next turns fit beside the new summary without
+        # summarizing again
+        history_tokens = history_trimmer.budget - history_trimmer.count_tokens(head + latest) - HISTORY_SUMMARY_MAX_TOKENS
+        end = len(history) - len(history_trimmer.fit(history[len(dropped):], history_tokens // 2))
+        summary = await summarize_history(history[covered:end], previous_summary=summary)
+        if not summary:
+            return kept
+        history_summary_cache.put(history[:end], summary)
+        covered = end
+
+    return head + [summary_message(summary)] + history[covered:] + latest
+
+
+def init_promptflow_client():
+    # Adding timeout for scenarios where response takes longer to come back
+    logging.debug(f"Setting timeout to {app_settings.promptflow.response_timeout}")
+    return httpx.AsyncClient(
+        http2=app_settings.promptflow.http2,
+        limits=httpx.Limits(
+            max_connections=app_settings.promptflow.http_max_connections,
+            max_keepalive_connections=app_settings.promptflow.http_max_keepalive_connections,
+            keepalive_expiry=app_settings.promptflow.http_keepalive_expiry,
+        ),
+        timeout=float(app_settings.promptflow.response_timeout),
+        headers={
             "Content-Type": "application/json",
             "Authorization": f"Bearer {app_settings.promptflow.api_key}",
-        }
-        # Adding timeout for scenarios where response takes longer to come back
-        logging.debug(f"Setting timeout to {app_settings.promptflow.response_timeout}")
-        async with httpx.AsyncClient(
-            timeout=float(app_settings.promptflow.response_timeout)
-        ) as client:
-            pf_formatted_obj = convert_to_pf_format(
-                request,
-                app_settings.promptflow.request_field_name,
-                app_settings.promptflow.response_field_name
-            )
-            # NOTE: This only support question and chat_history parameters
-            # If you need to add more parameters, you need to modify the request body
-            response = await client.post(
-                app_settings.promptflow.endpoint,
-                json={
-                    app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
-                    "chat_history": pf_formatted_obj[:-1],
-                },
-                headers=headers,
-            )
+        },
+    )
+
+
+def get_promptflow_client():
+    # Created in before_serving; app instances that skip startup hooks get
+    # one on first use, still shared by the requests that follow.
+    if current_app.promptflow_http_client is None:
+        current_app.promptflow_http_client = init_promptflow_client()
+
+    return current_app.promptflow_http_client
+
+
+def prepare_promptflow_request_body(request):
+    if history_trimmer:
+        request = {**request, "messages": history_trimmer.trim(request["messages"])[0]}
+    pf_formatted_obj = convert_to_pf_format(
+        request,
+        app_settings.promptflow.request_field_name,
+        app_settings.promptflow.response_field_name
+    )
+    # NOTE: This only support question and chat_history parameters
+    # If you need to add more parameters, you need to modify the request body
+    return {
+        app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
+        "chat_history": pf_formatted_obj[:-1],
+    }
+
+
+async def promptflow_request(request):
+    try:
+        response = await get_promptflow_client().post(
+            app_settings.promptflow.endpoint,
+            json=prepare_promptflow_request_body(request),
+        )
         resp = response.json()
         resp["id"] = request["messages"][-1]["id"]
         return resp
@@ -386,13 +719,17 @@ async def process_function_call(response):
     messages = []
 
     if response_message.tool_calls:
-        for tool_call in response_message.tool_calls:
-            # Check if function exists
-            if tool_call.function.name not in azure_openai_available_tools:
-                continue
-            
-            function_response = await openai_remote_azure_function_call(tool_call.function.name, tool_call.function.arguments)
+        available_tools = current_app.azure_openai_tool_registry.available_tools
+        # Check if function exists
+        tool_calls = [
+            tool_call for tool_call in response_message.tool_calls
+            if tool_call.function.name in available_tools
+        ]
+        function_responses = await openai_remote_azure_function_calls(
+            [(tool_call.function.name, tool_call.function.arguments) for tool_call in tool_calls]
+        )
 
+        for tool_call, function_response in zip(tool_calls, function_responses):
             # adding assistant response to messages
             messages.append(
                 {
@@ -418,6 +755,62 @@ async def process_function_call(response):
     
     return None
 
+async def create_chat_completion(model_args):
+    load_balancer = await get_load_balancer()
+    # Admission reserves the most a request can use: its prompt and the longest allowed answer
+    prompt_tokens = token_counter.count_tokens(model_args["messages"]) if load_balancer.admission_enabled else 0
+
+    async def create_on(lease):
+        # Retries are left to retry_policy, which also knows about the retry budget
+        completions = lease.deployment.client.with_options(max_retries=0).chat.completions
+        raw_response = await completions.with_raw_response.create(**{**model_args, "model": lease.deployment.model})
+        response = raw_response.parse()
+        if model_args.get("stream"):
+            # The deployment stays busy until the stream is consumed
+            response = TrackedStream(
+                response, lease, prompt_tokens=prompt_tokens, max_tokens=model_args.get("max_tokens")
+            )
+        else:
+            lease.release(tokens=response.usage.total_tokens if response.usage else 0)
+        return response, raw_response.headers.get("apim-request-id")
+
+    async def create():
+        return await load_balancer.call(
+            create_on,
+            budget=retry_policy.budget,
+            tokens=prompt_tokens + (model_args.get("max_tokens") or 0),
+        )
+
+    # Only complete answers are hedged; a stream is retried until it is opened
+    return await retry_policy.call(create, hedge=not model_args.get("stream"))
+
+
+async def create_chat_completion_shared(model_args):
+    # Identical requests in flight at the same time share one upstream call
+    key_args = model_args
+    if app_settings.azure_openai.coalesce_across_users:
+        # Opted in: the Defender user context is left out of the key, so a
+        # shared call is only attributed to the user whose request started it
+        key_args = {
+            **model_args,
+            "extra_body": {
+                name: value
+                for name, value in (model_args.get("extra_body") or {}).items()
+                if name != "user_security_context"
+            }
+        }
+    key = hashlib.sha256(
+        json.dumps(key_args, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    async def create():
+        return await create_chat_completion(model_args)
+
+    if model_args.get("stream"):
+        return await single_flight.stream(key, create)
+
+    return await single_flight.call(key, create)
+
+
 async def send_chat_request(request_body, request_headers):
     filtered_messages = []
     messages = request_body.get("messages", [])
@@ -426,13 +819,15 @@ async def send_chat_request(request_body, request_headers):
             filtered_messages.append(message)
             
     request_body['messages'] = filtered_messages
-    model_args = prepare_model_args(request_body, request_headers)
 
     try:
-        azure_openai_client = await init_openai_client()
-        raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
-        response = raw_response.parse()
-        apim_request_id = raw_response.headers.get("apim-request-id") 
+        # Initialize the client first so tool metadata is loaded before the payload is built
+        await get_openai_client()
+        model_args = await prepare_model_args(request_body, request_headers)
+        if single_flight:
+            response, apim_request_id = await create_chat_completion_shared(model_args)
+        else:
+            response, apim_request_id = await create_chat_completion(model_args)
     except Exception as e:
         logging.exception("Exception in send_chat_request")
         raise e
@@ -451,9 +846,23 @@ async def complete_chat_request(request_body, request_headers):
             app_settings.promptflow.citations_field_name
         )
     else:
-        response, apim_request_id = await send_chat_request(request_body, request_headers)
         history_metadata = request_body.get("history_metadata", {})
+        cache_lookup = await lookup_cached_answer(request_body)
+        if cache_lookup and cache_lookup.answer:
+            return format_cached_non_streaming_response(
+                cache_lookup.answer.messages,
+                cache_lookup.answer.model,
+                history_metadata
+            )
+
+        response, apim_request_id = await send_chat_request(request_body, request_headers)
         non_streaming_response = format_non_streaming_response(response, history_metadata, apim_request_id)
+        if cache_lookup and non_streaming_response:
+            store_cached_answer(
+                cache_lookup,
+                non_streaming_response["choices"][0]["messages"],
+                non_streaming_response["model"]
+            )
 
         if app_settings.azure_openai.function_call_azure_functions_enabled:
             function_response = await process_function_call(response)  # Add await here
@@ -477,7 +886,7 @@ class AzureOpenaiFunctionCallStreamState():
         self.streaming_state = "INITIAL"    # Streaming state (INITIAL, STREAMING, COMPLETED)
 
 
-async def process_function_call_stream(completionChunk, function_call_stream_state, request_body, request_headers, history_metadata, apim_request_id):
+async def process_function_call_stream(completionChunk, function_call_stream_state, request_body, request_headers, history_metadata, apim_request_id, call_tools=openai_remote_azure_function_calls):
     if hasattr(completionChunk, "choices") and len(completionChunk.choices) > 0:
         response_message = completionChunk.choices[0].delta
         
@@ -506,9 +915,11 @@ async def process_function_call_stream(completionChunk, function_call_stream_sta
             function_call_stream_state.current_tool_call["tool_arguments"] = function_call_stream_state.tool_arguments_stream
             function_call_stream_state.tool_calls.append(function_call_stream_state.current_tool_call)
             
-            for tool_call in function_call_stream_state.tool_calls:
-                tool_response = await openai_remote_azure_function_call(tool_call["tool_name"], tool_call["tool_arguments"])
+            tool_responses = await call_tools(
+                [(tool_call["tool_name"], tool_call["tool_arguments"]) for tool_call in function_call_stream_state.tool_calls]
+            )
 
+            for tool_call, tool_response in zip(function_call_stream_state.tool_calls, tool_responses):
                 function_call_stream_state.function_messages.append({
                     "role": "assistant",
                     "function_call": {
@@ -531,42 +942,229 @@ async def process_function_call_stream(completionChunk, function_call_stream_sta
             return function_call_stream_state.streaming_state
 
 
+def get_response_cache_scope(security_filter):
+    # Everything besides the question that an answer depends on
+    global response_cache_config_hash
+    if response_cache_config_hash is None:
+        config = {
+            "model": app_settings.azure_openai.model,
+            "system_message": app_settings.azure_openai.system_message,
+            "temperature": app_settings.azure_openai.temperature,
+            "top_p": app_settings.azure_openai.top_p,
+            "max_tokens": app_settings.azure_openai.max_tokens,
+            "data_source": app_settings.datasource.construct_payload_configuration() if app_settings.datasource else None,
+        }
+        response_cache_config_hash = hashlib.sha256(
+            json.dumps(config, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    filter_hash = hashlib.sha256(security_filter.encode("utf-8")).hexdigest() if security_filter else ""
+    return f"{response_cache_config_hash}:{filter_hash}"
+
+
+async def embed_question(question):
+    try:
+        azure_openai_client = await get_openai_client()
+        response = await azure_openai_client.embeddings.create(
+            model=app_settings.azure_openai.embedding_name,
+            input=normalize_question(question)
+        )
+        return response.data[0].embedding
+    except Exception:
+        logging.exception("Exception while embedding question for the response cache")
+        return None
+
+
+async def lookup_cached_answer(request_body):
+    # Only standalone questions are cached; follow-ups depend on the conversation
+    if response_cache is None or app_settings.azure_openai.function_call_azure_functions_enabled:
+        return None
+
+    messages = [message for message in request_body.get("messages", []) if message]
+    user_messages = [message for message in messages if message.get("role") == "user"]
+    if len(user_messages) != 1 or messages[-1] is not user_messages[0]:
+        return None
+    question = user_messages[0].get("content")
+    if not isinstance(question, str) or not normalize_question(question):
+        return None
+
+    scope = get_response_cache_scope(await get_security_filter())
+    # Exact hits skip the embeddings call; on a miss the embedding serves the
+    # similarity lookup and later storing the answer
+    answer = response_cache.get_exact(question, scope)
+    embedding = None
+    if answer is None:
+        if response_cache.similarity_threshold and app_settings.azure_openai.embedding_name:
+            embedding = await embed_question(question)
+        answer = response_cache.get(question, scope, embedding)
+
+    return CacheLookup(
+        question=question,
+        scope=scope,
+        embedding=embedding,
+        answer=answer
+    )
+
+
+def store_cached_answer(cache_lookup, messages, model):
+    # Keep citations and the answer; anything else (e.g. tool calls) is not replayable
+    answer_messages = []
+    for message in messages:
+        if message.get("role") == "tool" and isinstance(message.get("content"), str):
+            answer_messages.append({"role": "tool", "content": message["content"]})
+        elif message.get("role") == "assistant" and isinstance(message.get("content"), str):
+            answer_messages.append({"role": "assistant", "content": message["content"]})
+        else:
+            return
+
+    if answer_messages and answer_messages[-1]["role"] == "assistant" and answer_messages[-1]["content"]:
+        response_cache.put(
+            cache_lookup.question,
+            cache_lookup.scope,
+            answer_messages,
+            model,
+            embedding=cache_lookup.embedding
+        )
+
+
+async def replay_cached_answer(answer, history_metadata):
+    for event in format_cached_stream_response(answer.messages, answer.model, history_metadata):
+        yield event
+
+
+def is_answer_delta(message):
+    return message.get("role") == "assistant" and isinstance(message.get("content"), str)
+
+
+async def cache_streamed_answer(events, cache_lookup):
+    # Stored only once the answer was streamed completely
+    messages = []
+    model = None
+    try:
+        async for event in events:
+            if event:
+                model = event.get("model")
+                for message in event["choices"][0]["messages"]:
+                    if is_answer_delta(message) and messages and is_answer_delta(messages[-1]):
+                        messages[-1] = {"role": "assistant", "content": messages[-1]["content"] + message["content"]}
+                    else:
+                        messages.append(message)
+            yield event
+    finally:
+        await close_stream(events)
+
+    store_cached_answer(cache_lookup, messages, model)
+
+
 async def stream_chat_request(request_body, request_headers):
-    response, apim_request_id = await send_chat_request(request_body, request_headers)
     history_metadata = request_body.get("history_metadata", {})
+    cache_lookup = await lookup_cached_answer(request_body)
+    if cache_lookup and cache_lookup.answer:
+        return replay_cached_answer(cache_lookup.answer, history_metadata)
+
+    response, apim_request_id = await send_chat_request(request_body, request_headers)
+
+    # The answer is streamed after the request and app contexts have exited, while
+    # the tool calls and the completion that follows them need the app's clients
+    call_tools = copy_current_request_context(openai_remote_azure_function_calls)
+    send_function_chat_request = copy_current_request_context(send_chat_request)
     
     async def generate(apim_request_id, history_metadata):
-        if app_settings.azure_openai.function_call_azure_functions_enabled:
-            # Maintain state during function call streaming
-            function_call_stream_state = AzureOpenaiFunctionCallStreamState()
-            
-            async for completionChunk in response:
-                stream_state = await process_function_call_stream(completionChunk, function_call_stream_state, request_body, request_headers, history_metadata, apim_request_id)
-                
-                # No function call, asistant response
-                if stream_state == "INITIAL":
+        # Closed when the client disconnects; cancellation also stops any tool calls in flight
+        function_response = None
+        try:
+            if app_settings.azure_openai.function_call_azure_functions_enabled:
+                # Maintain state during function call streaming
+                function_call_stream_state = AzureOpenaiFunctionCallStreamState()
+
+                async for completionChunk in response:
+                    stream_state = await process_function_call_stream(completionChunk, function_call_stream_state, request_body, request_headers, history_metadata, apim_request_id, call_tools)
+
+                    # No function call, asistant response
+                    if stream_state == "INITIAL":
+                        yield format_stream_response(completionChunk, history_metadata, apim_request_id)
+
+                    # Function call stream completed, functions were executed.
+                    # Append function calls and results to history and send to OpenAI, to stream the final answer.
+                    if stream_state == "COMPLETED":
+                        request_body["messages"].extend(function_call_stream_state.function_messages)
+                        function_response, apim_request_id = await send_function_chat_request(request_body, request_headers)
+                        async for functionCompletionChunk in function_response:
+                            yield format_stream_response(functionCompletionChunk, history_metadata, apim_request_id)
+
+            else:
+                async for completionChunk in response:
                     yield format_stream_response(completionChunk, history_metadata, apim_request_id)
+        finally:
+            await close_stream(response)
+            if function_response is not None:
+                await close_stream(function_response)
 
-                # Function call stream completed, functions were executed.
-                # Append function calls and results to history and send to OpenAI, to stream the final answer.
-                if stream_state == "COMPLETED":
-                    request_body["messages"].extend(function_call_stream_state.function_messages)
-                    function_response, apim_request_id = await send_chat_request(request_body, request_headers)
-                    async for functionCompletionChunk in function_response:
-                        yield format_stream_response(functionCompletionChunk, history_metadata, apim_request_id)
-                
-        else:
-            async for completionChunk in response:
-                yield format_stream_response(completionChunk, history_metadata, apim_request_id)
+    stream = generate(apim_request_id=apim_request_id, history_metadata=history_metadata)
+    if cache_lookup:
+        return cache_streamed_answer(stream, cache_lookup)
+
+    return stream
 
-    return generate(apim_request_id=apim_request_id, history_metadata=history_metadata)
+
+async def stream_promptflow_request(request_body):
+    history_metadata = request_body.get("history_metadata", {})
+    response_id = request_body["messages"][-1].get("id")
+
+    # The stream is opened here, while the request context is still available
+    client = get_promptflow_client()
+    response = await client.send(
+        client.build_request(
+            "POST",
+            app_settings.promptflow.endpoint,
+            json=prepare_promptflow_request_body(request_body),
+            headers={"Accept": "text/event-stream"},
+        ),
+        stream=True,
+    )
+    if response.is_error:
+        await response.aread()
+        await response.aclose()
+        response.raise_for_status()
+
+    async def generate():
+        try:
+            async for pfChunk in parse_pf_stream(response):
+                for event in format_pf_stream_response(
+                    pfChunk,
+                    history_metadata,
+                    app_settings.promptflow.response_field_name,
+                    app_settings.promptflow.citations_field_name,
+                    response_id
+                ):
+                    yield event
+        finally:
+            await response.aclose()
+
+    return generate()
+
+
+def should_stream():
+    if app_settings.base_settings.use_promptflow:
+        return app_settings.azure_openai.stream and app_settings.promptflow.stream
+
+    return app_settings.azure_openai.stream
 
 
 async def conversation_internal(request_body, request_headers):
     try:
-        if app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
-            result = await stream_chat_request(request_body, request_headers)
-            response = await make_response(format_as_ndjson(result))
+        if should_stream():
+            if app_settings.base_settings.use_promptflow:
+                result = await stream_promptflow_request(request_body)
+            else:
+                result = await stream_chat_request(request_body, request_headers)
+            response = await make_response(
+                format_as_ndjson(
+                    result,
+                    coalesce_window=app_settings.azure_openai.stream_coalesce_window_ms / 1000,
+                    coalesce_max_bytes=app_settings.azure_openai.stream_coalesce_max_bytes,
+                )
+            )
             response.timeout = None
             response.mimetype = "application/json-lines"
             return response
@@ -576,13 +1174,67 @@ async def conversation_internal(request_body, request_headers):
 
     except Exception as ex:
         logging.exception(ex)
-        if hasattr(ex, "status_code"):
+        if isinstance(ex, RateLimitExceeded):
+            return jsonify({"error": str(ex)}), ex.status_code, {"Retry-After": str(math.ceil(ex.retry_after))}
+        elif hasattr(ex, "status_code"):
             return jsonify({"error": str(ex)}), ex.status_code
         else:
             return jsonify({"error": str(ex)}), 500
 
 
+class ReleasingBody(ResponseBody):
+    '''Response body that calls ``release`` once it has been sent or abandoned'''
+    def __init__(self, body, release):
+        self.body = body
+        self.release = release
+
+    async def __aenter__(self):
+        try:
+            return await self.body.__aenter__()
+        except BaseException:
+            self.release()
+            raise
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        try:
+            return await self.body.__aexit__(exc_type, exc_value, tb)
+        finally:
+            self.release()
+
+    def __getattr__(self, name):
+        return getattr(self.body, name)
+
+
+def fair_scheduled(route):
+    '''
+    Runs the route in a slot from the fair scheduler, keyed by the signed in
+    user. The slot is held until the response, including a streamed answer,
+    has been sent.
+    '''
+    @wraps(route)
+    async def wrapper(*args, **kwargs):
+        if not fair_scheduler:
+            return await route(*args, **kwargs)
+
+        user_id = get_authenticated_user_details(request_headers=request.headers)["user_principal_id"]
+        try:
+            slot = await fair_scheduler.acquire(user_id)
+        except RateLimitExceeded as ex:
+            return jsonify({"error": str(ex)}), ex.status_code, {"Retry-After": str(math.ceil(ex.retry_after))}
+
+        try:
+            response = await make_response(await route(*args, **kwargs))
+        except BaseException:
+            slot.release()
+            raise
+        response.response = ReleasingBody(response.response, slot.release)
+        return response
+
+    return wrapper
+
+
 @bp.route("/conversation", methods=["POST"])
+@fair_scheduled
 async def conversation():
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
@@ -600,8 +1252,17 @@ def get_frontend_settings():
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    if not app_settings.base_settings.metrics_enabled:
+        return jsonify({"error": "Metrics are not enabled"}), 404
+
+    return jsonify(metrics.snapshot()), 200
+
+
 ## Conversation History API ##
 @bp.route("/history/generate", methods=["POST"])
+@fair_scheduled
 async def add_conversation():
     await cosmos_db_ready.wait()
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
@@ -617,15 +1278,18 @@ async def add_conversation():
             raise Exception("CosmosDB is not configured or not working")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
+        # with a placeholder title; the real title is generated off the critical path below
         history_metadata = {}
+        generate_conversation_title = False
         if not conversation_id:
-            title = await generate_title(request_json["messages"])
+            title = title_placeholder(request_json["messages"])
             conversation_dict = await current_app.cosmos_conversation_client.create_conversation(
                 user_id=user_id, title=title
             )
             conversation_id = conversation_dict["id"]
             history_metadata["title"] = title
             history_metadata["date"] = conversation_dict["createdAt"]
+            generate_conversation_title = True
 
         ## Format the incoming message object in the "chat/completions" messages format
         ## then write it to the conversation history in cosmos
@@ -646,6 +1310,17 @@ async def add_conversation():
         else:
             raise Exception("No user message found")
 
+        if generate_conversation_title:
+            # Scheduled after the user message is written so both updates of the
+            # conversation document don't race
+            current_app.add_background_task(
+                update_conversation_title,
+                user_id,
+                conversation_id,
+                request_json["messages"],
+                history_metadata,
+            )
+
         # Submit request to Chat Completions for response
         request_body = await request.get_json()
         history_metadata["conversation_id"] = conversation_id
@@ -680,21 +1355,24 @@ async def update_conversation():
         ## then write it to the conversation history in cosmos
         messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
+            input_messages = []
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
-                # write the tool message first
-                await current_app.cosmos_conversation_client.create_message(
-                    uuid=str(uuid.uuid4()),
-                    conversation_id=conversation_id,
-                    user_id=user_id,
-                    input_message=messages[-2],
-                )
-            # write the assistant message
-            await current_app.cosmos_conversation_client.create_message(
-                uuid=messages[-1]["id"],
+                # the tool message is written first
+                input_messages.append((str(uuid.uuid4()), messages[-2]))
+            input_messages.append((messages[-1]["id"], messages[-1]))
+
+            # both messages are written in one transactional batch
+            createdMessages = await current_app.cosmos_conversation_client.add_messages_batch(
                 conversation_id=conversation_id,
                 user_id=user_id,
-                input_message=messages[-1],
+                input_messages=input_messages,
             )
+            if createdMessages == "Conversation not found":
+                raise Exception(
+                    "Conversation not found for the given conversation ID: "
+                    + conversation_id
+                    + "."
+                )
         else:
             raise Exception("No bot messages found")
 
@@ -799,7 +1477,6 @@ async def delete_conversation():
 @bp.route("/history/list", methods=["GET"])
 async def list_conversations():
     await cosmos_db_ready.wait()
-    offset = request.args.get("offset", 0)
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
 
@@ -807,6 +1484,30 @@ async def list_conversations():
     if not current_app.cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
+    ## with a cursor (empty for the first page) a page and the cursor of the next one are returned
+    if "cursor" in request.args:
+        try:
+            continuation_token = decode_cursor(request.args["cursor"])
+            conversations, continuation_token = await current_app.cosmos_conversation_client.get_conversations_page(
+                user_id, limit=25, continuation_token=continuation_token
+            )
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        except CosmosHttpResponseError as e:
+            ## Cosmos rejects continuation tokens it did not issue
+            if e.status_code == 400:
+                return jsonify({"error": "Invalid cursor"}), 400
+            raise
+
+        return jsonify({"conversations": conversations, "next": encode_cursor(continuation_token)}), 200
+
+    try:
+        offset = int(request.args.get("offset", 0))
+        if offset < 0:
+            raise ValueError(offset)
+    except ValueError:
+        return jsonify({"error": "offset must be a non-negative integer"}), 400
+
     ## get the conversations from cosmos
     conversations = await current_app.cosmos_conversation_client.get_conversations(
         user_id, offset=offset, limit=25
@@ -819,6 +1520,21 @@ async def list_conversations():
     return jsonify(conversations), 200
 
 
+def encode_cursor(continuation_token):
+    if continuation_token is None:
+        return None
+    return base64.urlsafe_b64encode(continuation_token.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
 @bp.route("/history/read", methods=["POST"])
 async def get_conversation():
     await cosmos_db_ready.wait()
@@ -927,23 +1643,21 @@ async def delete_all_conversations():
         if not current_app.cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        conversations = await current_app.cosmos_conversation_client.get_conversations(
-            user_id, offset=0, limit=None
-        )
-        if not conversations:
-            return jsonify({"error": f"No conversations for {user_id} were found"}), 404
-
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
-                conversation["id"], user_id
+        if request.args.get("background", "false").lower() == "true":
+            ## large histories are deleted after the response; poll the job for its status
+            job = await current_app.cosmos_conversation_client.create_deletion_job(user_id)
+            current_app.add_background_task(run_deletion_job, user_id, job["id"])
+            return (
+                jsonify({"job_id": job["id"], "status": job["status"]}),
+                202,
+                {"Location": f"/history/delete_all/{job['id']}"},
             )
 
-            ## Now delete the conversation
-            deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation(
-                user_id, conversation["id"]
-            )
+        ## delete the messages and conversations in batches
+        deleted_conversations = await current_app.cosmos_conversation_client.delete_all_conversations(user_id)
+        if not deleted_conversations:
+            return jsonify({"error": f"No conversations for {user_id} were found"}), 404
+
         return (
             jsonify(
                 {
@@ -958,6 +1672,48 @@ async def delete_all_conversations():
         return jsonify({"error": str(e)}), 500
 
 
+async def run_deletion_job(user_id, job_id):
+    cosmos_conversation_client = current_app.cosmos_conversation_client
+    try:
+        deleted_conversations = await cosmos_conversation_client.delete_all_conversations(user_id)
+        await cosmos_conversation_client.update_deletion_job(user_id, job_id, "succeeded", deleted=deleted_conversations)
+    except Exception as e:
+        logging.exception("Exception in background deletion of conversations")
+        await cosmos_conversation_client.update_deletion_job(user_id, job_id, "failed", error=str(e))
+
+
+@bp.route("/history/delete_all/<job_id>", methods=["GET"])
+async def get_deletion_job(job_id):
+    await cosmos_db_ready.wait()
+    ## get the user id from the request headers
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
+
+    try:
+        ## make sure cosmos is configured
+        if not current_app.cosmos_conversation_client:
+            raise Exception("CosmosDB is not configured or not working")
+
+        job = await current_app.cosmos_conversation_client.get_deletion_job(user_id, job_id)
+        if not job:
+            return jsonify({"error": f"Deletion job {job_id} was not found"}), 404
+
+        return (
+            jsonify(
+                {
+                    "job_id": job["id"],
+                    "status": job["status"],
+                    "deleted": job["deleted"],
+                    "error": job.get("error"),
+                }
+            ),
+            200,
+        )
+    except Exception as e:
+        logging.exception("Exception in /history/delete_all/<job_id>")
+        return jsonify({"error": str(e)}), 500
+
+
 @bp.route("/history/clear", methods=["POST"])
 async def clear_messages():
     await cosmos_db_ready.wait()
@@ -1037,21 +1793,50 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
+def title_placeholder(conversation_messages) -> str:
+    # Same text generate_title falls back to when the model call fails
+    return conversation_messages[-1]["content"]
+
+
+async def update_conversation_title(user_id, conversation_id, conversation_messages, history_metadata):
+    try:
+        title = await generate_title(conversation_messages)
+        # history_metadata is shared with the response still being streamed,
+        # so chunks sent from now on carry the generated title
+        history_metadata["title"] = title
+        await current_app.cosmos_conversation_client.update_conversation_title(
+            user_id, conversation_id, title
+        )
+    except Exception:
+        logging.exception("Exception while updating conversation title")
+
+
 async def generate_title(conversation_messages) -> str:
     ## make sure the messages are sorted by _ts descending
     title_prompt = "Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Do not include any other commentary or description."
 
+    # Only the most recent messages are needed to name the conversation
     messages = [
         {"role": msg["role"], "content": msg["content"]}
-        for msg in conversation_messages
+        for msg in conversation_messages[-app_settings.azure_openai.title_message_window:]
     ]
     messages.append({"role": "user", "content": title_prompt})
 
-    try:
-        azure_openai_client = await init_openai_client()
-        response = await azure_openai_client.chat.completions.create(
-            model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
+    async def create_title(lease):
+        # Fail over to another deployment rather than retrying a throttled one
+        response = await lease.deployment.client.with_options(max_retries=0).chat.completions.create(
+            model=lease.deployment.title_model,
+            messages=messages,
+            temperature=1,
+            max_tokens=64
         )
+        lease.release(tokens=response.usage.total_tokens if response.usage else 0)
+        return response
+
+    try:
+        load_balancer = await get_load_balancer()
+        tokens = token_counter.count_tokens(messages) + 64 if load_balancer.admission_enabled else 0
+        response = await load_balancer.call(create_title, tokens=tokens)
 
         title = response.choices[0].message.content
         return title
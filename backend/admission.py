@@ -0,0 +1,131 @@
+import asyncio
+import time
+from typing import Optional
+
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+
+WAIT_BUCKETS_MS = [0, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+class RateLimitExceeded(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too many requests, retry after {retry_after:.1f} seconds")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    '''
+    Refills at ``per_minute`` units a minute up to one minute's worth.
+    Reservations may take the bucket negative; the debt is what later
+    reservations queue behind.
+    '''
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        '''Seconds until ``amount`` could be taken'''
+        self._refill(now)
+        # A request larger than the bucket only waits for a full bucket
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        self.tokens -= amount
+        return amount
+
+    def give(self, amount: float):
+        self._refill(time.monotonic())
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdmissionController:
+    '''
+    Keeps requests to a deployment within its tokens and requests per minute.
+
+    A request reserves its estimated tokens up front and waits until the
+    buckets have refilled enough to cover it, so requests are admitted in
+    arrival order at the configured rate. Requests that would wait longer
+    than ``max_wait`` seconds, or find ``max_queue_depth`` requests already
+    waiting, are shed with ``RateLimitExceeded`` instead. Once the actual
+    usage is known the reservation is settled against it.
+    '''
+    def __init__(
+        self,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        max_wait: float = 10.0,
+        max_queue_depth: int = 100,
+        name: str = "default",
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.max_wait = max_wait
+        self.max_queue_depth = max_queue_depth
+        self.waiting = 0
+
+        registry = registry or default_metrics
+        self.queue_depth = registry.gauge(f"admission.{name}.queue_depth")
+        self.wait_ms = registry.histogram(f"admission.{name}.wait_ms", WAIT_BUCKETS_MS)
+        self.admitted = registry.counter(f"admission.{name}.admitted")
+        self.shed = registry.counter(f"admission.{name}.shed")
+
+    def delay(self, tokens: int) -> float:
+        now = time.monotonic()
+        return max(
+            self.token_bucket.delay(tokens, now) if self.token_bucket else 0.0,
+            self.request_bucket.delay(1, now) if self.request_bucket else 0.0,
+        )
+
+    async def admit(self, tokens: int) -> int:
+        '''
+        Waits until a request of ``tokens`` estimated tokens may be sent and
+        returns the number of tokens reserved for it.
+        '''
+        delay = self.delay(tokens)
+        if delay > self.max_wait or (delay > 0 and self.waiting >= self.max_queue_depth):
+            self.shed.inc()
+            raise RateLimitExceeded(delay)
+
+        now = time.monotonic()
+        if self.token_bucket:
+            tokens = self.token_bucket.take(tokens, now)
+        if self.request_bucket:
+            self.request_bucket.take(1, now)
+
+        if delay > 0:
+            self.waiting += 1
+            self.queue_depth.set(self.waiting)
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.settle(tokens, 0, sent=False)
+                raise
+            finally:
+                self.waiting -= 1
+                self.queue_depth.set(self.waiting)
+
+        self.wait_ms.observe(delay * 1000)
+        self.admitted.inc()
+        return tokens
+
+    def settle(self, reserved: int, used: int, sent: bool = True):
+        '''
+        Corrects a reservation to the tokens actually used. A request that
+        was never sent also returns its request slot.
+        '''
+        if self.token_bucket and used != reserved:
+            self.token_bucket.give(reserved - used)
+        if self.request_bucket and not sent:
+            self.request_bucket.give(1)
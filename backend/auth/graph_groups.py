@@ -0,0 +1,123 @@
+import base64
+import collections
+import hashlib
+import json
+import logging
+import time
+from typing import List, Optional
+
+import httpx
+
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+
+GRAPH_TRANSITIVE_MEMBER_OF_URL = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+
+
+def _token_claims(user_token: str) -> dict:
+    # The signature is not checked: claims are only used to key and bound the cache
+    try:
+        payload = user_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return claims if isinstance(claims, dict) else {}
+    except (IndexError, ValueError):
+        return {}
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+class GraphGroupResolver:
+    '''
+    Resolves the transitive group memberships of a user through Microsoft
+    Graph, following ``@odata.nextLink`` pages iteratively on a pooled async
+    client.
+
+    Results are cached per user for ``ttl`` seconds (and never beyond the
+    token's own expiry), keyed by a hash of the token's subject, and bounded
+    to ``max_entries`` users in LRU order. A cached entry is only served for
+    the exact token that fetched it, so an unverified subject claim can never
+    be used to read another user's groups.
+    '''
+    def __init__(
+        self,
+        graph_url: str = GRAPH_TRANSITIVE_MEMBER_OF_URL,
+        ttl: float = 300,
+        max_entries: int = 1024,
+        http_client: Optional[httpx.AsyncClient] = None,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.graph_url = graph_url
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._http_client = http_client or httpx.AsyncClient()
+        self._owns_http_client = http_client is None
+        # subject hash -> (token hash, groups, expires at)
+        self._cache = collections.OrderedDict()
+
+        registry = registry or default_metrics
+        self.hits = registry.counter("graph_groups.cache_hits")
+        self.misses = registry.counter("graph_groups.cache_misses")
+        self.fetch_failures = registry.counter("graph_groups.fetch_failures")
+        self.latency = registry.histogram("graph_groups.fetch_latency_ms")
+
+    async def _fetch_groups(self, user_token: str) -> Optional[List[dict]]:
+        headers = {"Authorization": "bearer " + user_token}
+        groups = []
+        endpoint = self.graph_url
+        while endpoint:
+            response = await self._http_client.get(endpoint, headers=headers)
+            if response.status_code != httpx.codes.OK:
+                logging.error(f"Error fetching user groups: {response.status_code} {response.text}")
+                return None
+
+            page = response.json()
+            groups.extend(page["value"])
+            endpoint = page.get("@odata.nextLink")
+
+        return groups
+
+    async def get_groups(self, user_token: str) -> List[dict]:
+        claims = _token_claims(user_token)
+        subject = claims.get("oid") or claims.get("sub") or user_token
+        key = _digest(subject)
+        token_digest = _digest(user_token)
+        now = time.time()
+
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] == token_digest and entry[2] > now:
+            self._cache.move_to_end(key)
+            self.hits.inc()
+            return entry[1]
+
+        self.misses.inc()
+        start = time.perf_counter()
+        try:
+            groups = await self._fetch_groups(user_token)
+        except Exception as e:
+            logging.error(f"Exception while fetching user groups: {e}")
+            groups = None
+        finally:
+            self.latency.observe((time.perf_counter() - start) * 1000)
+
+        if groups is None:
+            # Failures are not cached so the next turn retries
+            self.fetch_failures.inc()
+            return []
+
+        expires_at = now + self.ttl
+        if isinstance(claims.get("exp"), (int, float)):
+            expires_at = min(expires_at, claims["exp"])
+        if self.max_entries > 0 and expires_at > now:
+            self._cache[key] = (token_digest, groups, expires_at)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+        return groups
+
+    async def close(self):
+        if self._owns_http_client:
+            await self._http_client.aclose()
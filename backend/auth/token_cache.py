@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+
+class CachedTokenProvider:
+    '''
+    Keeps one async credential alive for the lifetime of the worker and caches
+    its access token, refreshing it in the background before it expires.
+
+    Instances are callables usable as the ``azure_ad_token_provider`` of
+    ``AsyncAzureOpenAI``: requests are served from the cache and only block on
+    the credential when no valid token exists at all.
+    '''
+    def __init__(
+        self,
+        credential,
+        scope: str = COGNITIVE_SERVICES_SCOPE,
+        refresh_margin: float = 300,
+        retry_interval: float = 10,
+        registry: Optional[MetricsRegistry] = None,
+        metrics_prefix: str = "token_cache",
+    ):
+        self.credential = credential
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._token = None
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+
+        registry = registry or default_metrics
+        self.hits = registry.counter(f"{metrics_prefix}.hits")
+        self.misses = registry.counter(f"{metrics_prefix}.misses")
+        self.refreshes = registry.counter(f"{metrics_prefix}.refreshes")
+        self.refresh_failures = registry.counter(f"{metrics_prefix}.refresh_failures")
+
+    def _is_valid(self, token) -> bool:
+        return token is not None and token.expires_on > time.time()
+
+    async def _acquire(self):
+        token = await self.credential.get_token(self.scope)
+        self._token = token
+        return token
+
+    async def start(self):
+        async with self._lock:
+            if not self._is_valid(self._token):
+                await self._acquire()
+
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        while True:
+            remaining = (self._token.expires_on if self._token else 0) - time.time()
+            # Refresh ahead of expiry, but never spin on tokens shorter-lived than the margin
+            if remaining > self.refresh_margin:
+                delay = remaining - self.refresh_margin
+            else:
+                delay = max(remaining / 2, 0)
+            await asyncio.sleep(delay)
+            try:
+                async with self._lock:
+                    await self._acquire()
+                self.refreshes.inc()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Keep serving the cached token while it is still valid
+                self.refresh_failures.inc()
+                logging.exception("Failed to refresh Azure Entra ID token")
+                await asyncio.sleep(self.retry_interval)
+
+    async def get_token(self) -> str:
+        token = self._token
+        if self._is_valid(token):
+            self.hits.inc()
+            return token.token
+
+        self.misses.inc()
+        async with self._lock:
+            # Another caller may have acquired a token while this one waited
+            if not self._is_valid(self._token):
+                await self._acquire()
+            return self._token.token
+
+    async def __call__(self) -> str:
+        return await self.get_token()
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+        await self.credential.close()
@@ -0,0 +1,146 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, Optional
+
+from backend.admission import RateLimitExceeded, WAIT_BUCKETS_MS
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+
+class Slot:
+    '''A granted request slot; release it once the response has been sent'''
+    def __init__(self, scheduler: "FairScheduler", user_id: str):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.granted_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.scheduler._release(self)
+
+
+class FairScheduler:
+    '''
+    Limits concurrent requests overall and per user, queueing the overflow
+    in a weighted fair queue.
+
+    Each user may have at most ``per_user_concurrency`` requests running or
+    waiting. Once ``max_concurrency`` requests are running the rest wait,
+    and free slots go to the waiting request with the smallest virtual
+    finish time: a user's requests are spaced ``1 / weight`` apart in
+    virtual time, so a user with many queued requests cannot starve users
+    with a few. Requests over the per-user limit, arriving at a full queue
+    or waiting longer than ``max_wait`` seconds are rejected with
+    ``RateLimitExceeded``.
+    '''
+    def __init__(
+        self,
+        max_concurrency: int = 64,
+        per_user_concurrency: int = 4,
+        max_queue_depth: int = 256,
+        max_wait: float = 30.0,
+        user_weights: Optional[Dict[str, float]] = None,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.per_user_concurrency = per_user_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_wait = max_wait
+        self.user_weights = user_weights or {}
+
+        self.running = 0
+        self.queued = 0
+        # Requests running or waiting, by user
+        self.outstanding: Dict[str, int] = {}
+        self.last_finish: Dict[str, float] = {}
+        self.virtual_time = 0.0
+        self._queue = []
+        self._sequence = itertools.count()
+        # Moving average of how long a slot is held, for retry hints
+        self._slot_seconds: Optional[float] = None
+
+        registry = registry or default_metrics
+        self.in_flight = registry.gauge("scheduler.in_flight")
+        self.queue_depth = registry.gauge("scheduler.queue_depth")
+        self.queue_wait_ms = registry.histogram("scheduler.queue_wait_ms", WAIT_BUCKETS_MS)
+        self.rejected = registry.counter("scheduler.rejected")
+
+    def retry_after(self, ahead: int = 0) -> float:
+        '''Rough seconds until a request behind ``ahead`` others would get a slot'''
+        slot_seconds = self._slot_seconds or 1.0
+        return max(1.0, slot_seconds * (1 + ahead / self.max_concurrency))
+
+    def _reject(self, ahead: int = 0):
+        self.rejected.inc()
+        raise RateLimitExceeded(self.retry_after(ahead))
+
+    def _grant(self, user_id: str, waited: float) -> Slot:
+        self.running += 1
+        self.in_flight.set(self.running)
+        self.queue_wait_ms.observe(waited * 1000)
+        return Slot(self, user_id)
+
+    async def acquire(self, user_id: str) -> Slot:
+        if self.outstanding.get(user_id, 0) >= self.per_user_concurrency:
+            self._reject()
+
+        if self.running < self.max_concurrency and not self.queued:
+            self.outstanding[user_id] = self.outstanding.get(user_id, 0) + 1
+            return self._grant(user_id, 0.0)
+
+        if self.queued >= self.max_queue_depth:
+            self._reject(self.queued)
+
+        weight = self.user_weights.get(user_id, 1.0)
+        start = max(self.virtual_time, self.last_finish.get(user_id, 0.0))
+        finish = start + 1 / weight
+        self.last_finish[user_id] = finish
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (finish, next(self._sequence), start, time.monotonic(), user_id, waiter))
+        self.outstanding[user_id] = self.outstanding.get(user_id, 0) + 1
+        self.queued += 1
+        self.queue_depth.set(self.queued)
+
+        try:
+            return await asyncio.wait_for(waiter, self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as we gave up
+                waiter.result().release()
+            else:
+                self.queued -= 1
+                self.queue_depth.set(self.queued)
+                self._forget(user_id)
+            if isinstance(ex, asyncio.TimeoutError):
+                self._reject(self.queued)
+            raise
+
+    def _forget(self, user_id: str):
+        self.outstanding[user_id] -= 1
+        if not self.outstanding[user_id]:
+            del self.outstanding[user_id]
+            self.last_finish.pop(user_id, None)
+
+    def _release(self, slot: Slot):
+        held = time.monotonic() - slot.granted_at
+        self._slot_seconds = held if self._slot_seconds is None else 0.8 * self._slot_seconds + 0.2 * held
+        self.running -= 1
+        self.in_flight.set(self.running)
+        self._forget(slot.user_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.running < self.max_concurrency and self._queue:
+            _, _, start, enqueued_at, user_id, waiter = heapq.heappop(self._queue)
+            if waiter.done():
+                # Timed out or cancelled, already accounted for
+                continue
+            self.queued -= 1
+            self.queue_depth.set(self.queued)
+            self.virtual_time = max(self.virtual_time, start)
+            waiter.set_result(self._grant(user_id, time.monotonic() - enqueued_at))
@@ -0,0 +1,89 @@
+import asyncio
+import json
+from typing import List, Optional, Tuple
+
+import httpx
+
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+
+class ToolExecutor:
+    '''
+    Executes tool calls against the Azure Functions "tool" endpoint.
+
+    All calls share one pooled HTTP client. A batch of tool calls emitted by
+    the model runs concurrently, at most ``max_concurrency`` at a time per
+    batch, and results are returned in the order the calls were requested.
+    Each call may take up to ``timeout`` seconds.
+    '''
+    def __init__(
+        self,
+        tool_url: str,
+        http_client: Optional[httpx.AsyncClient] = None,
+        max_concurrency: int = 4,
+        timeout: float = 30,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.tool_url = tool_url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._http_client = http_client or httpx.AsyncClient()
+        self._owns_http_client = http_client is None
+
+        registry = registry or default_metrics
+        self.calls = registry.counter("tool_executor.calls")
+        self.timeouts = registry.counter("tool_executor.timeouts")
+        self.latency = registry.histogram("tool_executor.latency_ms")
+
+    async def _post(self, function_name: str, function_args: str) -> str:
+        headers = {'content-type': 'application/json'}
+        body = {
+            "tool_name": function_name,
+            "tool_arguments": json.loads(function_args)
+        }
+        # The shared client's default timeout would otherwise cut slow tools short
+        response = await self._http_client.post(
+            self.tool_url, content=json.dumps(body), headers=headers, timeout=self.timeout
+        )
+        response.raise_for_status()
+
+        return response.text
+
+    async def call(self, function_name: str, function_args: str) -> str:
+        self.calls.inc()
+        start = asyncio.get_running_loop().time()
+        try:
+            return await asyncio.wait_for(
+                self._post(function_name, function_args),
+                self.timeout
+            )
+        except asyncio.TimeoutError:
+            self.timeouts.inc()
+            raise
+        finally:
+            self.latency.observe((asyncio.get_running_loop().time() - start) * 1000)
+
+    async def call_all(self, tool_calls: List[Tuple[str, str]]) -> List[str]:
+        # Bounds the calls of this batch only; other requests' batches are not held up
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def call(function_name, function_args):
+            async with semaphore:
+                return await self.call(function_name, function_args)
+
+        tasks = [
+            asyncio.create_task(call(function_name, function_args))
+            for function_name, function_args in tool_calls
+        ]
+        try:
+            # gather preserves the order of the requested calls
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def close(self):
+        if self._owns_http_client:
+            await self._http_client.aclose()
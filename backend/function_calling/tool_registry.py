@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+import httpx
+
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+
+class ToolRegistry:
+    '''
+    Tool definitions served by the Azure Functions tools endpoint.
+
+    Definitions are fetched once at startup and refreshed in the background
+    every ``ttl`` seconds using ETag/If-None-Match. Each refresh replaces the
+    snapshot as a whole, so concurrent requests always see a consistent,
+    de-duplicated set of tools.
+    '''
+    def __init__(
+        self,
+        tools_url: str,
+        ttl: float = 300,
+        http_client: Optional[httpx.AsyncClient] = None,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.tools_url = tools_url
+        self.ttl = ttl
+        self._http_client = http_client or httpx.AsyncClient()
+        self._owns_http_client = http_client is None
+        self._tools = []
+        self._available_tools = frozenset()
+        self._etag = None
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+
+        registry = registry or default_metrics
+        self.fetches = registry.counter("tool_registry.fetches")
+        self.not_modified = registry.counter("tool_registry.not_modified")
+        self.fetch_failures = registry.counter("tool_registry.fetch_failures")
+
+    @property
+    def tools(self) -> List[dict]:
+        return self._tools
+
+    @property
+    def available_tools(self) -> frozenset:
+        return self._available_tools
+
+    def _set_tools(self, tools: List[dict]):
+        tools_by_name = {}
+        for tool in tools:
+            name = tool["function"]["name"]
+            if name in tools_by_name:
+                logging.warning(f"Ignoring duplicate OpenAI Function Call tool definition: {name}")
+                continue
+            tools_by_name[name] = tool
+
+        self._tools = list(tools_by_name.values())
+        self._available_tools = frozenset(tools_by_name)
+
+    async def refresh(self):
+        # Only one refresh is in flight at a time; readers never wait on it
+        async with self._lock:
+            headers = {"If-None-Match": self._etag} if self._etag else {}
+            response = await self._http_client.get(self.tools_url, headers=headers)
+            if response.status_code == httpx.codes.NOT_MODIFIED:
+                self.not_modified.inc()
+                return
+
+            if response.status_code != httpx.codes.OK:
+                self.fetch_failures.inc()
+                logging.error(f"An error occurred while getting OpenAI Function Call tools metadata: {response.status_code}")
+                return
+
+            self._set_tools(response.json())
+            self._etag = response.headers.get("ETag")
+            self.fetches.inc()
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.refresh()
+            except Exception:
+                self.fetch_failures.inc()
+                logging.exception("Exception while refreshing OpenAI Function Call tools metadata")
+
+    async def start(self):
+        try:
+            await self.refresh()
+        except Exception:
+            self.fetch_failures.inc()
+            logging.exception("Exception while loading OpenAI Function Call tools metadata")
+
+        if self.ttl and self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+        if self._owns_http_client:
+            await self._http_client.aclose()
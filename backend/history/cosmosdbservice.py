@@ -1,16 +1,47 @@
+import asyncio
+import contextlib
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Optional
+from azure.core.async_paging import AsyncItemPaged
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
-  
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+REQUEST_CHARGE_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+## a transactional batch holds at most 100 operations on one partition
+MAX_BATCH_OPERATIONS = 100
+DELETION_JOB_TTL = 24 * 60 * 60
+CONVERSATION_LIST_FIELDS = "c.id, c.title, c.createdAt, c.updatedAt"
+MESSAGE_FIELDS = "c.id, c.role, c.content, c.createdAt, c.feedback"
+
+
+class RequestCharge():
+    '''
+    Response hook adding up the request units charged for an operation,
+    over every page of a query.
+    '''
+    def __init__(self):
+        self.request_units = 0.0
+
+    def __call__(self, headers, result):
+        ## query_items also calls the hook before the first page is fetched, with stale headers
+        if isinstance(result, AsyncItemPaged):
+            return
+        self.request_units += float(headers.get('x-ms-request-charge', 0) or 0)
+
+
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, delete_concurrency: int = 4, registry: Optional[MetricsRegistry] = None):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        self.delete_concurrency = delete_concurrency
+        self.registry = registry or default_metrics
         try:
             self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
         except exceptions.CosmosHttpResponseError as e:
@@ -45,6 +76,17 @@ class CosmosConversationClient():
             
         return True, "CosmosDB client initialized successfully"
 
+    @contextlib.contextmanager
+    def measure(self, operation):
+        ## records the latency and request units of the container calls made with the yielded hook
+        request_charge = RequestCharge()
+        start = time.monotonic()
+        try:
+            yield request_charge
+        finally:
+            self.registry.histogram(f"cosmos.{operation}.latency_ms").observe((time.monotonic() - start) * 1000)
+            self.registry.histogram(f"cosmos.{operation}.request_charge", REQUEST_CHARGE_BUCKETS).observe(request_charge.request_units)
+
     async def create_conversation(self, user_id, title = ''):
         conversation = {
             'id': str(uuid.uuid4()),  
@@ -55,38 +97,159 @@ class CosmosConversationClient():
             'title': title
         }
         ## TODO: add some error handling based on the output of the upsert_item call
-        resp = await self.container_client.upsert_item(conversation)  
+        with self.measure("create_conversation") as request_charge:
+            resp = await self.container_client.upsert_item(conversation, response_hook=request_charge)
         if resp:
             return resp
         else:
             return False
     
     async def upsert_conversation(self, conversation):
-        resp = await self.container_client.upsert_item(conversation)
+        with self.measure("upsert_conversation") as request_charge:
+            resp = await self.container_client.upsert_item(conversation, response_hook=request_charge)
         if resp:
             return resp
         else:
             return False
 
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        ## patch only the title so concurrent updates of other fields are not overwritten
+        try:
+            with self.measure("update_conversation_title") as request_charge:
+                resp = await self.container_client.patch_item(
+                    item=conversation_id,
+                    partition_key=user_id,
+                    patch_operations=[{'op': 'set', 'path': '/title', 'value': title}],
+                    response_hook=request_charge
+                )
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+        return resp
+
     async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
+        with self.measure("delete_conversation") as request_charge:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id, response_hook=request_charge)
+            if conversation:
+                resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id, response_hook=request_charge)
         if conversation:
-            resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
             return resp
         else:
             return True
 
-        
+
+    async def delete_items(self, user_id, item_ids):
+        ## deletes items of the user's partition in transactional batches, running up to
+        ## delete_concurrency batches at a time; returns the number of items deleted
+        semaphore = asyncio.Semaphore(self.delete_concurrency)
+
+        async def delete_batch(batch):
+            async with semaphore:
+                while batch:
+                    try:
+                        with self.measure("delete_batch") as request_charge:
+                            await self.container_client.execute_item_batch(
+                                batch_operations=[('delete', (item_id,)) for item_id in batch],
+                                partition_key=user_id,
+                                response_hook=request_charge
+                            )
+                        return len(batch)
+                    except exceptions.CosmosBatchOperationError as e:
+                        ## an item deleted meanwhile fails the whole batch; retry without it
+                        if e.status_code != 404:
+                            raise
+                        batch = batch[:e.error_index] + batch[e.error_index + 1:]
+                return 0
+
+        tasks = [
+            asyncio.create_task(delete_batch(item_ids[i:i + MAX_BATCH_OPERATIONS]))
+            for i in range(0, len(item_ids), MAX_BATCH_OPERATIONS)
+        ]
+        try:
+            return sum(await asyncio.gather(*tasks))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def get_item_ids(self, user_id, item_type, conversation_id=None):
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            },
+            {
+                'name': '@type',
+                'value': item_type
+            }
+        ]
+        query = "SELECT VALUE c.id FROM c WHERE c.userId = @userId AND c.type = @type"
+        if conversation_id:
+            parameters.append({'name': '@conversationId', 'value': conversation_id})
+            query += " AND c.conversationId = @conversationId"
+
+        item_ids = []
+        with self.measure("get_item_ids") as request_charge:
+            async for item_id in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id, response_hook=request_charge):
+                item_ids.append(item_id)
+        return item_ids
+
     async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+        ## only the ids of the conversation's messages are read, then deleted in batches
+        message_ids = await self.get_item_ids(user_id, 'message', conversation_id)
+        return await self.delete_items(user_id, message_ids)
+
+    async def delete_all_conversations(self, user_id):
+        ## messages go first so a failure never leaves messages without their conversation;
+        ## returns the number of conversations deleted
+        await self.delete_items(user_id, await self.get_item_ids(user_id, 'message'))
+        return await self.delete_items(user_id, await self.get_item_ids(user_id, 'conversation'))
 
+    async def create_deletion_job(self, user_id):
+        ## status of a background deletion, stored with the user's history so any worker can report it
+        job = {
+            'id': str(uuid.uuid4()),
+            'type': 'deletionJob',
+            'userId': user_id,
+            'status': 'running',
+            'deleted': 0,
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            ## expires a day later where the container has time to live enabled
+            'ttl': DELETION_JOB_TTL
+        }
+        with self.measure("create_deletion_job") as request_charge:
+            return await self.container_client.upsert_item(job, response_hook=request_charge)
+
+    async def update_deletion_job(self, user_id, job_id, status, deleted=0, error=None):
+        patch_operations = [
+            {'op': 'set', 'path': '/status', 'value': status},
+            {'op': 'set', 'path': '/deleted', 'value': deleted},
+            {'op': 'set', 'path': '/updatedAt', 'value': datetime.utcnow().isoformat()}
+        ]
+        if error:
+            patch_operations.append({'op': 'set', 'path': '/error', 'value': error})
+        with self.measure("update_deletion_job") as request_charge:
+            return await self.container_client.patch_item(
+                item=job_id,
+                partition_key=user_id,
+                patch_operations=patch_operations,
+                response_hook=request_charge
+            )
+
+    async def get_deletion_job(self, user_id, job_id):
+        try:
+            with self.measure("get_deletion_job") as request_charge:
+                job = await self.container_client.read_item(item=job_id, partition_key=user_id, response_hook=request_charge)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        return job if job.get('type') == 'deletionJob' else None
+
+    def _conversations_query(self, sort_order):
+        ## only the fields the conversation list shows are read
+        if sort_order.upper() not in ('ASC', 'DESC'):
+            raise ValueError(f"Invalid sort order: {sort_order}")
+        return f"SELECT {CONVERSATION_LIST_FIELDS} FROM c WHERE c.userId = @userId AND c.type = 'conversation' ORDER BY c.updatedAt {sort_order.upper()}"
 
     async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
         parameters = [
@@ -95,45 +258,66 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        query = self._conversations_query(sort_order)
         if limit is not None:
-            query += f" offset {offset} limit {limit}" 
+            query += " OFFSET @offset LIMIT @limit"
+            parameters.append({'name': '@offset', 'value': int(offset)})
+            parameters.append({'name': '@limit', 'value': int(limit)})
         
         conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        with self.measure("get_conversations") as request_charge:
+            async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id, response_hook=request_charge):
+                conversations.append(item)
         
         return conversations
 
-    async def get_conversation(self, user_id, conversation_id):
+    async def get_conversations_page(self, user_id, limit, continuation_token=None, sort_order = 'DESC'):
+        ## one page of conversations and the continuation token of the next page, None after the last
+        ## page; unlike OFFSET, resuming from a token costs the same however deep the page is
         parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
         conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        with self.measure("get_conversations_page") as request_charge:
+            pages = self.container_client.query_items(
+                query=self._conversations_query(sort_order),
+                parameters=parameters,
+                partition_key=user_id,
+                max_item_count=limit,
+                response_hook=request_charge
+            ).by_page(continuation_token)
+            async for page in pages:
+                async for item in page:
+                    conversations.append(item)
+                break
+
+        return conversations, pages.continuation_token
 
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
+    async def get_conversation(self, user_id, conversation_id):
+        ## a point read in the user's partition is the cheapest way to read a single (small) document
+        try:
+            with self.measure("get_conversation") as request_charge:
+                conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id, response_hook=request_charge)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+        ## if no conversation is found, return None
+        if conversation.get('type') != 'conversation':
             return None
         else:
-            return conversations[0]
+            return conversation
  
-    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+    def _message_document(self, uuid, conversation_id, user_id, input_message: dict, created_at=None):
+        created_at = created_at or datetime.utcnow().isoformat()
         message = {
             'id': uuid,
             'type': 'message',
             'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
+            'createdAt': created_at,
+            'updatedAt': created_at,
             'conversationId' : conversation_id,
             'role': input_message['role'],
             'content': input_message['content']
@@ -141,24 +325,74 @@ class CosmosConversationClient():
 
         if self.enable_message_feedback:
             message['feedback'] = ''
-        
-        resp = await self.container_client.upsert_item(message)  
+        return message
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        message = self._message_document(uuid, conversation_id, user_id, input_message)
+
+        ## bump the parent conversation's updatedAt to the message's createdAt; the patch is a
+        ## point write in the user's partition, and fails if the user has no such conversation
+        if not await self.touch_conversation(user_id, conversation_id, message['createdAt']):
+            return "Conversation not found"
+
+        with self.measure("create_message") as request_charge:
+            resp = await self.container_client.upsert_item(message, response_hook=request_charge)
         if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
-                return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
             return resp
         else:
             return False
+
+    async def add_messages_batch(self, conversation_id, user_id, input_messages: list):
+        ## writes (uuid, message) pairs and bumps the conversation's updatedAt in one transactional
+        ## batch on the user's partition: either all of them are stored or none
+        if len(input_messages) + 1 > MAX_BATCH_OPERATIONS:
+            raise ValueError(f"At most {MAX_BATCH_OPERATIONS - 1} messages can be written in one batch")
+
+        ## createdAt increases through the batch so the messages keep their order
+        now = datetime.utcnow()
+        messages = [
+            self._message_document(message_id, conversation_id, user_id, input_message, (now + timedelta(microseconds=i)).isoformat())
+            for i, (message_id, input_message) in enumerate(input_messages)
+        ]
+        batch_operations = [
+            ('patch', (conversation_id, [{'op': 'set', 'path': '/updatedAt', 'value': messages[-1]['createdAt']}]), {'filter_predicate': "from c where c.type = 'conversation'"})
+        ] + [('upsert', (message,)) for message in messages]
+
+        try:
+            with self.measure("add_messages_batch") as request_charge:
+                results = await self.container_client.execute_item_batch(
+                    batch_operations=batch_operations,
+                    partition_key=user_id,
+                    response_hook=request_charge
+                )
+        except exceptions.CosmosBatchOperationError as e:
+            if e.error_index == 0 and e.status_code in (404, 412):
+                return "Conversation not found"
+            raise
+
+        return [result['resourceBody'] for result in results[1:]]
+
+    async def touch_conversation(self, user_id, conversation_id, updated_at):
+        try:
+            with self.measure("touch_conversation") as request_charge:
+                resp = await self.container_client.patch_item(
+                    item=conversation_id,
+                    partition_key=user_id,
+                    patch_operations=[{'op': 'set', 'path': '/updatedAt', 'value': updated_at}],
+                    filter_predicate="from c where c.type = 'conversation'",
+                    response_hook=request_charge
+                )
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            return False
+        return resp
     
     async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
+        with self.measure("update_message_feedback") as request_charge:
+            message = await self.container_client.read_item(item=message_id, partition_key=user_id, response_hook=request_charge)
+            if message:
+                message['feedback'] = feedback
+                resp = await self.container_client.upsert_item(message, response_hook=request_charge)
         if message:
-            message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
             return resp
         else:
             return False
@@ -174,10 +408,15 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+        ## only the fields shown in the conversation are read, in the order they were written;
+        ## the composite index on (userId, conversationId, type, createdAt) serves the filter and the sort:
+        ## userId, conversationId and type are equality filters on its leading paths, so the index is
+        ## already ordered by createdAt within them
+        query = f"SELECT {MESSAGE_FIELDS} FROM c WHERE c.userId = @userId AND c.conversationId = @conversationId AND c.type = 'message' ORDER BY c.createdAt ASC"
         messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            messages.append(item)
+        with self.measure("get_messages") as request_charge:
+            async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id, response_hook=request_charge):
+                messages.append(item)
 
         return messages
 
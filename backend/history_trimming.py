@@ -0,0 +1,202 @@
+import collections
+import functools
+import hashlib
+import json
+import logging
+from typing import List, Optional, Tuple
+
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+
+DEFAULT_ENCODING = "cl100k_base"
+TOKEN_BUCKETS = [100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000]
+
+# Fixed per-message overhead and reply priming of the chat completions format
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+# Only these fields reach the model; ids, dates and feedback in stored history do not
+_COUNTED_FIELDS = ("role", "content", "name", "context", "function_call", "tool_calls")
+
+
+def _estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English text
+    return (len(text) + 3) // 4
+
+
+def _fit_start(history: List[dict], counts: List[int], remaining: int) -> Tuple[int, int]:
+    # Index of the oldest message kept when keeping history newest first
+    # within remaining tokens, and the tokens left over
+    start = len(history)
+    while start > 0 and counts[start - 1] <= remaining:
+        remaining -= counts[start - 1]
+        start -= 1
+    # Never start the kept history with an assistant reply or tool output
+    while start < len(history) and history[start].get("role") != "user":
+        remaining += counts[start]
+        start += 1
+
+    return start, remaining
+
+
+class TokenCounter:
+    '''
+    Counts the prompt tokens of chat messages.
+
+    Tokens are counted with a tiktoken encoding when tiktoken and its data
+    are available, otherwise estimated from text length. Counts are cached
+    per text, since every turn resends the whole history.
+    '''
+    def __init__(self, encoding_name: Optional[str] = DEFAULT_ENCODING):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._encoding_loaded = False
+        self._count_text = functools.lru_cache(maxsize=4096)(self._count_text_uncached)
+
+    def load_encoding(self):
+        # Loading may download the encoding data; call off the event loop at startup
+        if self._encoding_loaded:
+            return self._encoding
+
+        if self.encoding_name:
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception as e:
+                logging.warning(f"Could not load tiktoken encoding {self.encoding_name}, estimating token counts: {e}")
+        self._encoding_loaded = True
+        return self._encoding
+
+    def _count_text_uncached(self, text: str) -> int:
+        encoding = self.load_encoding()
+        if encoding is None:
+            return _estimate_tokens(text)
+
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def count_message(self, message: dict) -> int:
+        tokens = TOKENS_PER_MESSAGE
+        for field in _COUNTED_FIELDS:
+            value = message.get(field)
+            if value is None:
+                continue
+            tokens += self._count_text(value if isinstance(value, str) else json.dumps(value))
+            if field == "name":
+                tokens += TOKENS_PER_NAME
+
+        return tokens
+
+    def count_tokens(self, messages: List[dict]) -> int:
+        return TOKENS_PER_REPLY + sum(self.count_message(message) for message in messages)
+
+    def fit(self, history: List[dict], tokens: int) -> List[dict]:
+        '''
+        Returns the newest messages of history that fit in tokens, starting at
+        a user message.
+        '''
+        counts = [self.count_message(message) for message in history]
+        start, _ = _fit_start(history, counts, tokens)
+        return history[start:]
+
+
+class HistoryTrimmer(TokenCounter):
+    '''
+    Fits conversation history into a prompt token budget.
+
+    Leading system messages and the latest message are always kept. Older
+    messages are then kept newest first while they fit, and the kept history
+    always starts at a user message.
+    '''
+    def __init__(
+        self,
+        budget: int,
+        encoding_name: Optional[str] = DEFAULT_ENCODING,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        super().__init__(encoding_name)
+        self.budget = budget
+
+        registry = registry or default_metrics
+        self.prompt_tokens = registry.histogram("history.prompt_tokens", TOKEN_BUCKETS)
+        self.sent_tokens = registry.histogram("history.sent_tokens", TOKEN_BUCKETS)
+        self.trimmed_requests = registry.counter("history.trimmed_requests")
+        self.dropped_messages = registry.counter("history.dropped_messages")
+
+    def trim(self, messages: List[dict], reserved_tokens: int = 0) -> Tuple[List[dict], List[dict]]:
+        '''
+        Returns the messages to send and the older messages that were dropped.
+        '''
+        head_end = 0
+        while head_end < len(messages) - 1 and messages[head_end].get("role") == "system":
+            head_end += 1
+        head, history, latest = messages[:head_end], messages[head_end:-1], messages[-1:]
+
+        counts = [self.count_message(message) for message in history]
+        fixed = TOKENS_PER_REPLY + reserved_tokens + sum(self.count_message(m) for m in head + latest)
+        total = fixed + sum(counts)
+        self.prompt_tokens.observe(total - reserved_tokens)
+
+        start, remaining = _fit_start(history, counts, self.budget - fixed)
+        dropped = history[:start]
+        if dropped:
+            self.trimmed_requests.inc()
+            self.dropped_messages.inc(len(dropped))
+        self.sent_tokens.observe(self.budget - remaining - reserved_tokens)
+
+        return head + history[start:] + latest, dropped
+
+
+class SummaryCache:
+    '''
+    Remembers summaries of the oldest messages of conversations.
+
+    Entries are keyed by a hash of the summarized messages, so a later turn
+    of the same conversation finds the summary of its history's longest
+    summarized prefix. Bounded to ``max_entries`` summaries in LRU order.
+    '''
+    def __init__(self, max_entries: int = 1024, registry: Optional[MetricsRegistry] = None):
+        self.max_entries = max_entries
+        # prefix hash -> summary
+        self._entries = collections.OrderedDict()
+
+        registry = registry or default_metrics
+        self.hits = registry.counter("history.summary_cache_hits")
+        self.misses = registry.counter("history.summary_cache_misses")
+
+    @staticmethod
+    def _prefix_keys(history: List[dict]) -> List[str]:
+        # Key of every prefix of history, from the empty prefix up; only role
+        # and content are summarized
+        digest = hashlib.sha256()
+        keys = [digest.hexdigest()]
+        for message in history:
+            digest.update(json.dumps([message.get("role"), message.get("content")]).encode("utf-8"))
+            keys.append(digest.copy().hexdigest())
+        return keys
+
+    def get(self, history: List[dict]) -> Tuple[int, Optional[str]]:
+        '''
+        Returns the number of leading messages of history covered by the
+        longest cached summary, and that summary.
+        '''
+        keys = self._prefix_keys(history)
+        for covered in range(len(history), 0, -1):
+            summary = self._entries.get(keys[covered])
+            if summary is not None:
+                self._entries.move_to_end(keys[covered])
+                self.hits.inc()
+                return covered, summary
+
+        self.misses.inc()
+        return 0, None
+
+    def put(self, summarized: List[dict], summary: str):
+        if self.max_entries <= 0:
+            return
+
+        key = self._prefix_keys(summarized)[-1]
+        self._entries[key] = summary
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
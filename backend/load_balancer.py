@@ -0,0 +1,262 @@
+import asyncio
+import collections
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, List, Optional
+
+import openai
+
+from backend.admission import AdmissionController, RateLimitExceeded
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+from backend.resilience import RetryBudget, is_retryable, retry_after
+
+
+class Deployment:
+    '''
+    One Azure OpenAI deployment of the pool, with its load and health.
+    '''
+    def __init__(
+        self,
+        name: str,
+        client: Any,
+        model: str,
+        weight: float = 1.0,
+        title_model: Optional[str] = None,
+        token_window: float = 60.0,
+        admission: Optional[AdmissionController] = None,
+    ):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.weight = weight
+        self.title_model = title_model or model
+        self.token_window = token_window
+        self.admission = admission
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        # Circuit breaker: open until ejected_until, then half-open for one probe
+        self.ejected_until = 0.0
+        self.probing = False
+        self._tokens = collections.deque()
+        self._token_total = 0
+
+    def available(self, now: float) -> bool:
+        return not self.ejected_until or (self.ejected_until <= now and not self.probing)
+
+    def record_tokens(self, tokens: int, now: float):
+        if tokens:
+            self._tokens.append((now, tokens))
+            self._token_total += tokens
+
+    def token_rate(self, now: float) -> float:
+        '''Tokens per minute over the last ``token_window`` seconds'''
+        while self._tokens and self._tokens[0][0] <= now - self.token_window:
+            self._token_total -= self._tokens.popleft()[1]
+        return self._token_total * 60 / self.token_window
+
+    def load(self, now: float, tokens: int = 0):
+        admission_delay = self.admission.delay(tokens) if self.admission else 0.0
+        return (admission_delay, (self.in_flight + 1) / self.weight, self.token_rate(now) / self.weight)
+
+
+class Lease:
+    '''
+    A request in flight on a deployment. Released exactly once, with the
+    tokens it used or the error it failed with.
+    '''
+    def __init__(self, load_balancer: "LoadBalancer", deployment: Deployment):
+        self.load_balancer = load_balancer
+        self.deployment = deployment
+        # Tokens reserved with the deployment's admission controller
+        self.reserved = None
+        self.released = False
+
+    def release(self, error: Optional[BaseException] = None, tokens: int = 0):
+        if not self.released:
+            self.released = True
+            if self.reserved is not None:
+                self.deployment.admission.settle(self.reserved, tokens)
+            self.load_balancer._release(self, error, tokens)
+
+
+class TrackedStream:
+    '''
+    Chat completion stream that keeps its lease until it is consumed or
+    closed, counting the prompt tokens and one token per chunk.
+    '''
+    def __init__(self, stream, lease: Lease, prompt_tokens: int = 0, max_tokens: Optional[int] = None):
+        self.stream = stream
+        self.lease = lease
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.completion_tokens = 0
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.stream:
+                self.completion_tokens += 1
+                yield chunk
+        except Exception as error:
+            self.lease.release(error, self.tokens)
+            raise
+        except BaseException:
+            # Closed or cancelled by the reader before the end of the answer
+            await self.close()
+            raise
+
+        if not self.lease.released:
+            self.lease.load_balancer._stream_finished(self.completion_tokens)
+            self.lease.release(tokens=self.tokens)
+
+    async def close(self):
+        try:
+            await self.stream.close()
+        finally:
+            if not self.lease.released:
+                self.lease.load_balancer._stream_abandoned(self.completion_tokens, self.max_tokens)
+                self.lease.release(tokens=self.tokens)
+
+
+class LoadBalancer:
+    '''
+    Routes requests to the least loaded healthy deployment of a pool.
+
+    Load is the number of requests in flight relative to the deployment's
+    weight, then its recent token rate relative to its weight. A deployment
+    answering 429 is ejected for as long as it asks (``cooldown`` seconds
+    if it does not say); ``failure_threshold`` consecutive 5xx or connection errors
+    eject it for ``cooldown`` seconds. After that a single probe request is
+    let through, and its outcome closes or reopens the breaker. When every
+    deployment is ejected, requests are still spread over all of them rather
+    than failing outright.
+    '''
+    def __init__(
+        self,
+        deployments: List[Deployment],
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        if not deployments:
+            raise ValueError("At least one deployment is required")
+        self.deployments = deployments
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.registry = registry or default_metrics
+        self.failovers = self.registry.counter("load_balancer.failovers")
+        self.no_healthy_deployment = self.registry.counter("load_balancer.no_healthy_deployment")
+        self.healthy_deployments = self.registry.gauge("load_balancer.healthy_deployments")
+        self.healthy_deployments.set(len(deployments))
+        self.abandoned_streams = self.registry.counter("load_balancer.abandoned_streams")
+        self.tokens_saved = self.registry.counter("load_balancer.tokens_saved")
+        # Moving average of streamed answer lengths, to estimate what closing a stream early saved
+        self._answer_tokens = None
+
+    @property
+    def admission_enabled(self) -> bool:
+        return any(d.admission for d in self.deployments)
+
+    def _metric(self, kind, deployment, name):
+        return getattr(self.registry, kind)(f"load_balancer.{deployment.name}.{name}")
+
+    def available(self, exclude=()) -> List[Deployment]:
+        now = time.monotonic()
+        return [d for d in self.deployments if d not in exclude and d.available(now)]
+
+    def acquire(self, exclude=(), tokens: int = 0) -> Lease:
+        now = time.monotonic()
+        candidates = [d for d in self.deployments if d not in exclude and d.available(now)]
+        if not candidates:
+            self.no_healthy_deployment.inc()
+            candidates = [d for d in self.deployments if d not in exclude] or self.deployments
+
+        loads = [d.load(now, tokens) for d in candidates]
+        lowest = min(loads)
+        deployment = random.choice([d for d, load in zip(candidates, loads) if load == lowest])
+        if deployment.ejected_until:
+            deployment.probing = True
+        deployment.in_flight += 1
+        self._metric("gauge", deployment, "in_flight").inc()
+        self._metric("counter", deployment, "requests").inc()
+        return Lease(self, deployment)
+
+    def _stream_finished(self, completion_tokens: int):
+        if self._answer_tokens is None:
+            self._answer_tokens = completion_tokens
+        else:
+            self._answer_tokens = 0.9 * self._answer_tokens + 0.1 * completion_tokens
+
+    def _stream_abandoned(self, completion_tokens: int, max_tokens: Optional[int] = None):
+        self.abandoned_streams.inc()
+        expected = self._answer_tokens if self._answer_tokens is not None else max_tokens
+        if expected is None:
+            return
+        if max_tokens:
+            expected = min(expected, max_tokens)
+        self.tokens_saved.inc(max(0, round(expected - completion_tokens)))
+
+    def _release(self, lease, error, tokens):
+        deployment = lease.deployment
+        now = time.monotonic()
+        deployment.in_flight -= 1
+        self._metric("gauge", deployment, "in_flight").dec()
+        deployment.record_tokens(tokens, now)
+
+        probing, deployment.probing = deployment.probing, False
+        if error is None or not is_retryable(error):
+            # Anything but throttling and server errors means the deployment is up
+            deployment.consecutive_failures = 0
+            deployment.ejected_until = 0.0
+        else:
+            self._metric("counter", deployment, "failures").inc()
+            deployment.consecutive_failures += 1
+            throttled = isinstance(error, openai.APIStatusError) and error.status_code == 429
+            if throttled or probing or deployment.consecutive_failures >= self.failure_threshold:
+                response = getattr(error, "response", None)
+                requested = retry_after(response.headers if response is not None else None) if throttled else None
+                deployment.ejected_until = now + (requested if requested is not None else self.cooldown)
+                self._metric("counter", deployment, "ejections").inc()
+                logging.warning("Ejected Azure OpenAI deployment %s after %s", deployment.name, type(error).__name__)
+
+        self.healthy_deployments.set(sum(d.available(now) for d in self.deployments))
+
+    async def call(
+        self,
+        func: Callable[[Lease], Awaitable[Any]],
+        budget: Optional[RetryBudget] = None,
+        tokens: int = 0,
+    ) -> Any:
+        '''
+        Calls ``func`` with a lease on the least loaded deployment, failing
+        over to another available deployment on throttling or server errors.
+        ``func`` releases the lease once the deployment has done its work,
+        with the tokens used. ``tokens`` is the estimated usage admitted
+        against the deployment's admission controller.
+        '''
+        tried = []
+        while True:
+            lease = self.acquire(exclude=tried, tokens=tokens)
+            try:
+                if lease.deployment.admission:
+                    lease.reserved = await lease.deployment.admission.admit(tokens)
+                return await func(lease)
+            except RateLimitExceeded:
+                lease.release()
+                raise
+            except asyncio.CancelledError:
+                lease.release()
+                raise
+            except Exception as error:
+                lease.release(error)
+                tried.append(lease.deployment)
+                if not is_retryable(error) or not self.available(exclude=tried):
+                    raise
+                if budget is not None and not budget.try_acquire():
+                    raise
+                self.failovers.inc()
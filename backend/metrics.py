@@ -0,0 +1,106 @@
+import bisect
+from typing import Dict, List, Optional
+
+
+DEFAULT_LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+# Metrics are updated from the worker's event loop only, so no locking is needed.
+class Counter:
+    def __init__(self):
+        self._value = 0
+
+    def inc(self, amount: int = 1):
+        self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Gauge:
+    def __init__(self):
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        self._value += amount
+
+    def dec(self, amount=1):
+        self._value -= amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Histogram:
+    def __init__(self, buckets: Optional[List[float]] = None):
+        self.buckets = sorted(buckets or DEFAULT_LATENCY_BUCKETS_MS)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._count += 1
+        self._sum += value
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + ["+Inf"], self._counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+
+        return {"count": self._count, "sum": self._sum, "buckets": buckets}
+
+
+class MetricsRegistry:
+    '''
+    Process-wide registry of named counters, gauges and histograms.
+    '''
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _get_or_create(self, name, factory):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = factory()
+            self._metrics[name] = metric
+
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get_or_create(name, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._get_or_create(name, Gauge)
+
+    def histogram(self, name: str, buckets: Optional[List[float]] = None) -> Histogram:
+        return self._get_or_create(name, lambda: Histogram(buckets))
+
+    def snapshot(self) -> dict:
+        return {
+            name: metric.snapshot()
+            for name, metric in sorted(self._metrics.items())
+        }
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,231 @@
+import asyncio
+import collections
+import email.utils
+import logging
+import random
+import re
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import httpx
+import openai
+
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    # Reset headers are either seconds ("1.5") or a duration such as "1m30s" or "250ms"
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    parts = _DURATION_PART.findall(value)
+    if not parts or "".join(number + unit for number, unit in parts) != value:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_after(headers) -> Optional[float]:
+    '''
+    Seconds the server asked us to wait before retrying, if it said so.
+    '''
+    if headers is None:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            # Or an HTTP date
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            pass
+
+    # Wait for whichever limit was hit to reset
+    resets = [
+        _parse_duration(headers[name])
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if headers.get(name)
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+class RetryBudget:
+    '''
+    Caps retries at ``ratio`` of the requests seen in the last ``window``
+    seconds, plus ``min_retries_per_second`` so that low traffic can still
+    retry. Keeps an outage from multiplying the load on the backend.
+    '''
+    def __init__(self, ratio: float = 0.2, min_retries_per_second: float = 1.0, window: float = 10.0):
+        self.ratio = ratio
+        self.min_retries_per_second = min_retries_per_second
+        self.window = window
+        self._requests = collections.deque()
+        self._retries = collections.deque()
+
+    def _expire(self, now):
+        for events in (self._requests, self._retries):
+            while events and events[0] <= now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        self._requests.append(time.monotonic())
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        self._expire(now)
+        allowed = self.min_retries_per_second * self.window + self.ratio * len(self._requests)
+        if len(self._retries) >= allowed:
+            return False
+
+        self._retries.append(now)
+        return True
+
+
+class RetryPolicy:
+    '''
+    Retries throttled and transiently failing calls.
+
+    The delay honours ``retry-after-ms``, ``retry-after`` and
+    ``x-ratelimit-reset-*`` response headers, otherwise it is a full-jitter
+    exponential backoff from ``base_delay`` up to ``max_delay``. A call the
+    server asks to wait longer than ``max_delay`` for is failed straight
+    away. Retries draw on a shared ``RetryBudget``.
+
+    With ``hedge_percentile`` set, a hedged call starts a second attempt once
+    the first has taken longer than that percentile of recent successful
+    latencies, and the first attempt to succeed wins.
+    '''
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        budget: Optional[RetryBudget] = None,
+        hedge_percentile: Optional[float] = None,
+        hedge_min_samples: int = 20,
+        hedge_window: int = 200,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies = collections.deque(maxlen=hedge_window)
+
+        registry = registry or default_metrics
+        self.retries = registry.counter("resilience.retries")
+        self.budget_exhausted = registry.counter("resilience.retry_budget_exhausted")
+        self.hedged_calls = registry.counter("resilience.hedged_calls")
+        self.hedge_wins = registry.counter("resilience.hedge_wins")
+        self.retry_delay_ms = registry.histogram("resilience.retry_delay_ms")
+
+    def backoff(self, attempt: int, error: BaseException) -> Optional[float]:
+        '''
+        Delay before retrying after the given (zero-based) failed attempt, or
+        None if the server asked for a longer wait than ``max_delay``.
+        '''
+        response = getattr(error, "response", None)
+        requested = retry_after(response.headers if response is not None else None)
+        if requested is not None:
+            if requested > self.max_delay:
+                return None
+            # A little jitter keeps throttled clients from retrying in lockstep
+            return requested + random.uniform(0, min(self.base_delay, requested * 0.1 + 0.01))
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.hedge_percentile is None or len(self._latencies) < self.hedge_min_samples:
+            return None
+
+        latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * self.hedge_percentile / 100), len(latencies) - 1)
+        return latencies[index]
+
+    async def _timed(self, func):
+        start = time.monotonic()
+        result = await func()
+        self._latencies.append(time.monotonic() - start)
+        return result
+
+    async def _hedged(self, func):
+        delay = self.hedge_delay()
+        first = asyncio.ensure_future(self._timed(func))
+        if delay is None:
+            return await first
+
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and self.budget.try_acquire():
+                self.hedged_calls.inc()
+                pending.add(asyncio.ensure_future(self._timed(func)))
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins.inc()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(self, func: Callable[[], Awaitable[Any]], hedge: bool = False) -> Any:
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            try:
+                if hedge:
+                    return await self._hedged(func)
+                return await func()
+            except Exception as error:
+                attempt += 1
+                if attempt >= self.max_attempts or not is_retryable(error):
+                    raise
+
+                delay = self.backoff(attempt - 1, error)
+                if delay is None:
+                    raise
+                if not self.budget.try_acquire():
+                    self.budget_exhausted.inc()
+                    raise
+
+                logging.warning("Retrying after %s in %.2fs (attempt %d)", type(error).__name__, delay, attempt + 1)
+                self.retries.inc()
+                self.retry_delay_ms.observe(delay * 1000)
+                await asyncio.sleep(delay)
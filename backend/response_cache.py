@@ -0,0 +1,235 @@
+import collections
+import dataclasses
+import re
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.]+$")
+
+
+def normalize_question(question: str) -> str:
+    # Case, whitespace and trailing punctuation do not change the question
+    return _TRAILING_PUNCTUATION.sub("", " ".join(question.casefold().split()))
+
+
+def _unit_vector(vector: List[float]) -> Optional[np.ndarray]:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if vector.ndim != 1 or norm == 0:
+        return None
+    return vector / norm
+
+
+class _EmbeddingIndex:
+    '''
+    Unit embeddings of one scope's cached questions, stored as the rows of
+    one matrix so a lookup is a single matrix-vector product.
+    '''
+    def __init__(self, dimensions: int):
+        self.vectors = np.zeros((16, dimensions), dtype=np.float32)
+        self.keys = []
+        self.rows = {}
+        self._free_rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, key, vector: np.ndarray):
+        if vector.shape[0] != self.vectors.shape[1]:
+            return
+        if self._free_rows:
+            row = self._free_rows.pop()
+            self.keys[row] = key
+        else:
+            row = len(self.keys)
+            if row == len(self.vectors):
+                self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+            self.keys.append(key)
+        self.vectors[row] = vector
+        self.rows[key] = row
+
+    def remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.vectors[row] = 0
+            self.keys[row] = None
+            self._free_rows.append(row)
+
+    def most_similar(self, vector: np.ndarray, threshold: float):
+        # Keys with at least ``threshold`` similarity, most similar first
+        if vector.shape[0] != self.vectors.shape[1]:
+            return
+        similarities = self.vectors[:len(self.keys)] @ vector
+        rows = np.flatnonzero(similarities >= threshold)
+        for row in rows[np.argsort(-similarities[rows], kind="stable")]:
+            if self.keys[row] is not None:
+                yield self.keys[row]
+
+
+@dataclasses.dataclass
+class CachedAnswer:
+    messages: List[dict]
+    model: str
+    size: int
+    expires_at: float
+    embedding: Optional[np.ndarray] = None
+
+
+@dataclasses.dataclass
+class CacheLookup:
+    question: str
+    scope: str
+    embedding: Optional[List[float]] = None
+    answer: Optional[CachedAnswer] = None
+
+
+class ResponseCache:
+    '''
+    In-memory cache of answers to standalone questions.
+
+    Answers are keyed on the normalized question within a scope, which must
+    identify everything else the answer depends on (model and data source
+    configuration, and the user's security filter). Entries expire after
+    ``ttl`` seconds and are evicted in LRU order to stay within
+    ``max_entries`` and ``max_bytes`` of message content. When a
+    ``similarity_threshold`` is set, a question missing the exact lookup may
+    be answered by the most similar cached question of the same scope whose
+    embedding has at least that cosine similarity.
+    '''
+    def __init__(
+        self,
+        ttl: float = 3600,
+        max_entries: int = 1000,
+        max_bytes: int = 10 * 1024 * 1024,
+        similarity_threshold: Optional[float] = None,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.similarity_threshold = similarity_threshold
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._indexes: Dict[str, _EmbeddingIndex] = {}
+
+        registry = registry or default_metrics
+        self.hits = registry.counter("response_cache.hits")
+        self.semantic_hits = registry.counter("response_cache.semantic_hits")
+        self.misses = registry.counter("response_cache.misses")
+        self.stores = registry.counter("response_cache.stores")
+        self.evictions = registry.counter("response_cache.evictions")
+        self.entries = registry.gauge("response_cache.entries")
+        self.bytes = registry.gauge("response_cache.bytes")
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits.value + self.misses.value
+        return self.hits.value / lookups if lookups else 0.0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+        index = self._indexes.get(key[0])
+        if entry.embedding is not None and index is not None:
+            index.remove(key)
+            if not index:
+                del self._indexes[key[0]]
+
+    def _update_gauges(self):
+        self.entries.set(len(self._entries))
+        self.bytes.set(self._size)
+
+    def _most_similar(self, scope, embedding, now):
+        index = self._indexes.get(scope)
+        if index is None:
+            return None
+
+        for key in index.most_similar(embedding, self.similarity_threshold):
+            if self._entries[key].expires_at > now:
+                return key
+
+        return None
+
+    def _live_entry(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            self._remove(key)
+            self._update_gauges()
+            entry = None
+
+        return entry
+
+    def _hit(self, key, entry):
+        self._entries.move_to_end(key)
+        self.hits.inc()
+        return entry
+
+    def get_exact(self, question: str, scope: str) -> Optional[CachedAnswer]:
+        '''
+        Returns the answer cached for this exact question. A miss is not
+        counted, so that callers can embed the question only then and finish
+        the lookup with ``get``.
+        '''
+        key = (scope, normalize_question(question))
+        entry = self._live_entry(key, time.time())
+
+        return self._hit(key, entry) if entry is not None else None
+
+    def get(self, question: str, scope: str, embedding: Optional[List[float]] = None) -> Optional[CachedAnswer]:
+        key = (scope, normalize_question(question))
+        now = time.time()
+
+        entry = self._live_entry(key, now)
+        if entry is None and embedding is not None and self.similarity_threshold is not None:
+            unit_embedding = _unit_vector(embedding)
+            similar_key = self._most_similar(scope, unit_embedding, now) if unit_embedding is not None else None
+            if similar_key is not None:
+                key, entry = similar_key, self._entries[similar_key]
+                self.semantic_hits.inc()
+
+        if entry is None:
+            self.misses.inc()
+            return None
+
+        return self._hit(key, entry)
+
+    def put(
+        self,
+        question: str,
+        scope: str,
+        messages: List[dict],
+        model: str,
+        embedding: Optional[List[float]] = None,
+    ):
+        size = len(question) + sum(len(message.get("content") or "") for message in messages)
+        if size > self.max_bytes or self.max_entries < 1:
+            return
+
+        key = (scope, normalize_question(question))
+        if key in self._entries:
+            self._remove(key)
+
+        unit_embedding = _unit_vector(embedding) if embedding is not None else None
+        self._entries[key] = CachedAnswer(
+            messages=messages,
+            model=model,
+            size=size,
+            expires_at=time.time() + self.ttl,
+            embedding=unit_embedding,
+        )
+        self._size += size
+        if unit_embedding is not None:
+            if scope not in self._indexes:
+                self._indexes[scope] = _EmbeddingIndex(len(unit_embedding))
+            self._indexes[scope].add(key, unit_embedding)
+        self.stores.inc()
+
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions.inc()
+        self._update_gauges()
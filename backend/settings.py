@@ -16,7 +16,7 @@ from pydantic import (
 )
 from pydantic.alias_generators import to_snake
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import List, Literal, Optional
+from typing import Dict, List, Literal, Optional
 from typing_extensions import Self
 from quart import Request
 from backend.utils import parse_multi_columns, generateFilterString
@@ -64,6 +64,7 @@ class _ChatHistorySettings(BaseSettings):
     account_key: Optional[str] = None
     conversations_container: str
     enable_feedback: bool = False
+    delete_concurrency: conint(ge=1) = 4
 
 
 class _PromptflowSettings(BaseSettings):
@@ -80,6 +81,42 @@ class _PromptflowSettings(BaseSettings):
     request_field_name: str = "query"
     response_field_name: str = "reply"
     citations_field_name: str = "documents"
+    stream: bool = False
+    http_max_connections: conint(ge=1) = 100
+    http_max_keepalive_connections: conint(ge=0) = 20
+    http_keepalive_expiry: confloat(ge=0) = 30.0
+    http2: bool = False
+
+
+class _ResponseCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="RESPONSE_CACHE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    ttl: confloat(ge=0) = 3600
+    max_entries: conint(ge=1) = 1000
+    max_bytes: conint(ge=1) = 10 * 1024 * 1024
+    similarity_threshold: Optional[confloat(gt=0, le=1)] = None
+
+
+class _RequestLimitsSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="REQUEST_LIMITS_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    max_concurrency: conint(ge=1) = 64
+    per_user_concurrency: conint(ge=1) = 4
+    max_queue_depth: conint(ge=0) = 256
+    max_wait: confloat(ge=0) = 30.0
+    user_weights: Dict[str, confloat(gt=0)] = {}
 
 
 class _AzureOpenAIFunction(BaseModel):
@@ -93,6 +130,17 @@ class _AzureOpenAITool(BaseModel):
     function: _AzureOpenAIFunction
     
 
+class _AzureOpenAIDeployment(BaseModel):
+    endpoint: str
+    model: str
+    key: Optional[str] = None
+    weight: confloat(gt=0) = 1.0
+    title_model: Optional[str] = None
+    name: Optional[str] = None
+    tokens_per_minute: Optional[conint(ge=1)] = None
+    requests_per_minute: Optional[conint(ge=1)] = None
+
+
 class _AzureOpenAISettings(BaseSettings):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_OPENAI_",
@@ -109,6 +157,8 @@ class _AzureOpenAISettings(BaseSettings):
     top_p: float = 0
     max_tokens: int = 1000
     stream: bool = True
+    stream_coalesce_window_ms: conint(ge=0) = 0
+    stream_coalesce_max_bytes: conint(ge=1) = 1024
     stop_sequence: Optional[List[str]] = None
     seed: Optional[int] = None
     choices_count: Optional[conint(ge=1, le=128)] = Field(default=1, serialization_alias="n")
@@ -128,7 +178,36 @@ class _AzureOpenAISettings(BaseSettings):
     function_call_azure_functions_tools_base_url: Optional[str] = None
     function_call_azure_functions_tool_key: Optional[str] = None
     function_call_azure_functions_tool_base_url: Optional[str] = None
-    
+    function_call_azure_functions_tools_ttl: confloat(ge=0) = 300
+    function_call_azure_functions_max_concurrency: conint(ge=1) = 4
+    function_call_azure_functions_timeout: confloat(gt=0) = 30.0
+    http_max_connections: conint(ge=1) = 100
+    http_max_keepalive_connections: conint(ge=0) = 20
+    http_keepalive_expiry: confloat(ge=0) = 30.0
+    http2: bool = False
+    token_refresh_margin: confloat(ge=0) = 300
+    title_model: Optional[str] = None
+    title_message_window: conint(ge=1) = 4
+    history_token_budget: Optional[conint(ge=1)] = None
+    history_summarize: bool = False
+    coalesce_concurrent_requests: bool = False
+    coalesce_max_buffered_chunks: conint(ge=1) = 1024
+    coalesce_across_users: bool = False
+    retry_max_attempts: conint(ge=1) = 3
+    retry_base_delay: confloat(ge=0) = 0.5
+    retry_max_delay: confloat(ge=0) = 20.0
+    retry_budget_ratio: confloat(ge=0) = 0.2
+    retry_budget_min_per_second: confloat(ge=0) = 1.0
+    hedge_percentile: Optional[confloat(gt=0, lt=100)] = None
+    weight: confloat(gt=0) = 1.0
+    deployments: List[_AzureOpenAIDeployment] = []
+    breaker_failure_threshold: conint(ge=1) = 3
+    breaker_cooldown: confloat(ge=0) = 30.0
+    tokens_per_minute: Optional[conint(ge=1)] = None
+    requests_per_minute: Optional[conint(ge=1)] = None
+    admission_max_wait: confloat(ge=0) = 10.0
+    admission_max_queue_depth: conint(ge=0) = 100
+
     @field_validator('tools', mode='before')
     @classmethod
     def deserialize_tools(cls, tools_json_str: str) -> List[_AzureOpenAITool]:
@@ -229,18 +308,31 @@ class _SearchCommonSettings(BaseSettings):
 
 class DatasourcePayloadConstructor(BaseModel, ABC):
     _settings: '_AppSettings' = PrivateAttr()
+    _payload_configuration: Optional[dict] = PrivateAttr(default=None)
     
     def __init__(self, settings: '_AppSettings', **data):
         super().__init__(**data)
         self._settings = settings
     
     @abstractmethod
+    def _build_payload_configuration(self) -> dict:
+        pass
+    
     def construct_payload_configuration(
         self,
         *args,
         **kwargs
     ):
-        pass
+        # The payload only depends on settings, so it is built once. Each call
+        # gets its own top-level dicts to merge per-request fields into; nested
+        # values are shared and must not be mutated.
+        if self._payload_configuration is None:
+            self._payload_configuration = self._build_payload_configuration()
+        
+        return {
+            **self._payload_configuration,
+            "parameters": dict(self._payload_configuration["parameters"])
+        }
 
 
 class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
@@ -275,13 +367,14 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
         'vectorSemanticHybrid'
     ] = "simple"
     permitted_groups_column: Optional[str] = Field(default=None, exclude=True)
+    permitted_groups_cache_ttl: confloat(ge=0) = Field(default=300, exclude=True)
+    permitted_groups_cache_size: conint(ge=0) = Field(default=1024, exclude=True)
     
     # Constructed fields
     endpoint: Optional[str] = None
     authentication: Optional[dict] = None
     embedding_dependency: Optional[dict] = None
     fields_mapping: Optional[dict] = None
-    filter: Optional[str] = Field(default=None, exclude=True)
     
     @field_validator('content_columns', 'vector_columns', mode="before")
     @classmethod
@@ -320,7 +413,7 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
     def set_query_type(self) -> Self:
         self.query_type = to_snake(self.query_type)
 
-    def _set_filter_string(self, request: Request) -> str:
+    async def resolve_filter_string(self, request: Request, group_resolver) -> Optional[str]:
         if self.permitted_groups_column:
             user_token = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
             logging.debug(f"USER TOKEN is {'present' if user_token else 'not present'}")
@@ -329,21 +422,14 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
                     "Document-level access control is enabled, but user access token could not be fetched."
                 )
 
-            filter_string = generateFilterString(user_token)
+            user_groups = await group_resolver.get_groups(user_token)
+            filter_string = generateFilterString(user_groups, self.permitted_groups_column)
             logging.debug(f"FILTER: {filter_string}")
             return filter_string
         
         return None
             
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
-        request = kwargs.pop('request', None)
-        if request and self.permitted_groups_column:
-            self.filter = self._set_filter_string(request)
-            
+    def _build_payload_configuration(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -353,6 +439,18 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
             "type": self._type,
             "parameters": parameters
         }
+    
+    def construct_payload_configuration(
+        self,
+        *args,
+        **kwargs
+    ):
+        payload = super().construct_payload_configuration()
+        filter_string = kwargs.pop('filter_string', None)
+        if filter_string and self.permitted_groups_column:
+            payload["parameters"]["filter"] = filter_string
+        
+        return payload
 
 
 class _AzureCosmosDbMongoVcoreSettings(
@@ -412,11 +510,7 @@ class _AzureCosmosDbMongoVcoreSettings(
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _build_payload_configuration(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -482,11 +576,7 @@ class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _build_payload_configuration(self) -> dict:
         self.embedding_dependency = \
             {"type": "model_id", "model_id": self.embedding_model_id} if self.embedding_model_id else \
             self._settings.azure_openai.extract_embedding_dependency() 
@@ -554,11 +644,7 @@ class _PineconeSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _build_payload_configuration(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -612,11 +698,7 @@ class _AzureMLIndexSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _build_payload_configuration(self) -> dict:
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
@@ -659,11 +741,7 @@ class _AzureSqlServerSettings(BaseSettings, DatasourcePayloadConstructor):
             }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _build_payload_configuration(self) -> dict:
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         #parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
@@ -733,11 +811,7 @@ class _MongoDbSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _build_payload_configuration(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
             
@@ -761,6 +835,7 @@ class _BaseSettings(BaseSettings):
     auth_enabled: bool = True
     sanitize_answer: bool = False
     use_promptflow: bool = False
+    metrics_enabled: bool = False
 
 
 class _AppSettings(BaseModel):
@@ -768,6 +843,8 @@ class _AppSettings(BaseModel):
     azure_openai: _AzureOpenAISettings = _AzureOpenAISettings()
     search: _SearchCommonSettings = _SearchCommonSettings()
     ui: Optional[_UiSettings] = _UiSettings()
+    response_cache: _ResponseCacheSettings = _ResponseCacheSettings()
+    request_limits: _RequestLimitsSettings = _RequestLimitsSettings()
     
     # Constructed properties
     chat_history: Optional[_ChatHistorySettings] = None
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Tuple
+
+from backend.metrics import MetricsRegistry, metrics as default_metrics
+
+
+class StreamOverflowError(Exception):
+    pass
+
+
+class _Flight:
+    def __init__(self):
+        self.ready = asyncio.get_running_loop().create_future()
+        self.chunks = []
+        # Stream index of chunks[0]; earlier chunks were released
+        self.offset = 0
+        # Subscriber -> stream index of the next chunk it reads
+        self.positions = {}
+        self.done = False
+        self.error = None
+        self.task = None
+        self._new_data = asyncio.Event()
+        self._read = None
+
+    @property
+    def joinable(self) -> bool:
+        # Late subscribers must still be able to read the stream from the start
+        return not self.done and self.offset == 0
+
+    def notify(self):
+        new_data, self._new_data = self._new_data, asyncio.Event()
+        new_data.set()
+
+    async def wait(self):
+        await self._new_data.wait()
+
+    @property
+    def fastest(self) -> int:
+        return max(self.positions.values(), default=self.offset + len(self.chunks))
+
+    def notify_read(self):
+        if self._read is not None and not self._read.done():
+            self._read.set_result(None)
+
+    async def wait_read(self):
+        # Waits for a subscriber to read a chunk or to leave
+        self._read = asyncio.get_running_loop().create_future()
+        await self._read
+
+
+class SingleFlight:
+    '''
+    Coalesces identical concurrent upstream calls.
+
+    Callers passing the same key while a call is in flight share its result
+    instead of making their own call. Streamed chunks are appended to one
+    shared buffer that every subscriber reads at its own pace. The upstream
+    is read at most ``max_buffered_chunks`` ahead of the fastest subscriber,
+    so a lone slow client slows down the upstream read as it would without
+    sharing. Chunks read by everyone are released; a subscriber that falls
+    more than ``max_buffered_chunks`` behind the fastest one is detached with
+    ``StreamOverflowError`` rather than holding the others back. The upstream
+    stream is closed once every subscriber has gone.
+    '''
+    def __init__(self, max_buffered_chunks: int = 1024, registry: Optional[MetricsRegistry] = None):
+        self.max_buffered_chunks = max_buffered_chunks
+        self._calls = {}
+        self._flights = {}
+
+        registry = registry or default_metrics
+        self.upstream_calls = registry.counter("single_flight.upstream_calls")
+        self.shared_calls = registry.counter("single_flight.shared_calls")
+        self.overflows = registry.counter("single_flight.overflows")
+
+    async def call(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+            self.upstream_calls.inc()
+        else:
+            self.shared_calls.inc()
+
+        # A caller going away must not cancel the call for the others
+        return await asyncio.shield(task)
+
+    async def stream(
+        self,
+        key: str,
+        open_stream: Callable[[], Awaitable[Tuple[AsyncIterator, Any]]],
+    ) -> Tuple[AsyncIterator, Any]:
+        '''
+        Returns an iterator over the shared stream and the metadata returned
+        alongside it by ``open_stream``.
+        '''
+        flight = self._flights.get(key)
+        if flight is None or not flight.joinable:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, open_stream))
+            self.upstream_calls.inc()
+        else:
+            self.shared_calls.inc()
+
+        subscriber = object()
+        flight.positions[subscriber] = 0
+        try:
+            metadata = await asyncio.shield(flight.ready)
+        except BaseException:
+            self._unsubscribe(flight, subscriber)
+            raise
+
+        return self._subscribe(flight, subscriber), metadata
+
+    async def _run(self, key, flight, open_stream):
+        upstream = None
+        try:
+            upstream, metadata = await open_stream()
+            flight.ready.set_result(metadata)
+            async for chunk in upstream:
+                self._append(flight, chunk)
+                # Every subscriber is behind: wait for one to read before reading on
+                while flight.offset + len(flight.chunks) - flight.fastest >= self.max_buffered_chunks:
+                    await flight.wait_read()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            if flight.ready.done():
+                logging.exception("Exception in shared upstream stream")
+                flight.error = e
+            else:
+                flight.ready.set_exception(e)
+        finally:
+            if not flight.ready.done():
+                flight.ready.cancel()
+            flight.done = True
+            flight.notify()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            close = getattr(upstream, "close", None)
+            if close is not None:
+                await close()
+
+    def _append(self, flight, chunk):
+        flight.chunks.append(chunk)
+        if len(flight.chunks) > self.max_buffered_chunks:
+            # Release what every subscriber has read, then cut off laggards
+            # that another subscriber is too far ahead of
+            slowest = min(flight.positions.values(), default=flight.offset + len(flight.chunks))
+            released = max(slowest, flight.fastest - self.max_buffered_chunks) - flight.offset
+            if released > 0:
+                del flight.chunks[:released]
+                flight.offset += released
+        flight.notify()
+
+    def _unsubscribe(self, flight, subscriber):
+        flight.positions.pop(subscriber, None)
+        flight.notify_read()
+        if not flight.positions and flight.task is not None and not flight.task.done():
+            flight.task.cancel()
+
+    async def _subscribe(self, flight, subscriber):
+        try:
+            while True:
+                position = flight.positions[subscriber]
+                if position < flight.offset:
+                    self.overflows.inc()
+                    raise StreamOverflowError("Response stream buffer exceeded by a slow client")
+
+                index = position - flight.offset
+                if index < len(flight.chunks):
+                    flight.positions[subscriber] = position + 1
+                    flight.notify_read()
+                    yield flight.chunks[index]
+                    continue
+
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+
+                await flight.wait()
+        finally:
+            self._unsubscribe(flight, subscriber)
@@ -1,19 +1,18 @@
 import os
 import json
+import asyncio
 import logging
-import requests
 import dataclasses
+import time
+import uuid
 
+from json.encoder import encode_basestring_ascii
 from typing import List
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
     logging.basicConfig(level=logging.DEBUG)
 
-AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get(
-    "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN"
-)
-
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -22,13 +21,256 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
-async def format_as_ndjson(r):
+SECRET_PARAMS = ("key", "connection_string", "embedding_key", "encoded_api_key", "api_key")
+
+# Locations of secrets within model args, relative to the first data source's parameters
+_SECRET_PATHS = tuple(
+    ("extra_body", "data_sources", 0, "parameters") + container + (secret,)
+    for container in ((), ("authentication",), ("embedding_dependency", "authentication"))
+    for secret in SECRET_PARAMS
+)
+
+
+def _masked(obj, path):
+    # Copies only the containers along path, sharing everything else with obj
+    key, rest = path[0], path[1:]
+    try:
+        value = obj[key]
+    except (KeyError, IndexError, TypeError):
+        return obj
+
+    masked_value = _masked(value, rest) if rest else "*****" if value else value
+    if masked_value is value:
+        return obj
+
+    masked_obj = list(obj) if isinstance(obj, list) else dict(obj)
+    masked_obj[key] = masked_value
+    return masked_obj
+
+
+def redact_model_args(model_args):
+    for path in _SECRET_PATHS:
+        model_args = _masked(model_args, path)
+
+    return model_args
+
+
+class RedactedModelArgs:
+    '''
+    Log view of chat completion arguments with data source secrets masked.
+
+    Nothing is copied until the view is formatted, which the logging module
+    only does when the record is actually emitted.
+    '''
+    def __init__(self, model_args):
+        self.model_args = model_args
+
+    def __str__(self):
+        return json.dumps(redact_model_args(self.model_args), indent=4)
+
+
+def _assistant_content(event):
+    # Content of an event carrying only an assistant content delta, else None
+    try:
+        messages = event["choices"][0]["messages"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    if len(messages) != 1 or messages[0].keys() != {"role", "content"}:
+        return None
+    if messages[0]["role"] != "assistant" or not isinstance(messages[0]["content"], str):
+        return None
+
+    return messages[0]["content"]
+
+
+class _ContentBuffer:
+    def __init__(self):
+        self.events = []
+        self.contents = []
+        self.size = 0
+        self.deadline = None
+
+    def add(self, event, content):
+        self.events.append(event)
+        self.contents.append(content)
+        self.size += len(content.encode("utf-8"))
+
+    def flush(self):
+        merged = dict(self.events[-1])
+        merged["choices"] = [{"messages": [{"role": "assistant", "content": "".join(self.contents)}]}]
+        self.events, self.contents, self.size, self.deadline = [], [], 0, None
+        return merged
+
+
+_END_OF_STREAM = object()
+# Upstream events read ahead of the writer; beyond that the reader waits for the client
+_MAX_RECEIVED_EVENTS = 64
+
+
+async def close_stream(stream):
+    """
+    Closes an async generator or an SDK stream, so the upstream response
+    it reads is not left running when its reader goes away.
+    """
+    close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+    if close is not None:
+        result = close()
+        if asyncio.iscoroutine(result):
+            await result
+
+
+async def _coalesce_content_events(r, window, max_bytes):
+    """
+    Merge consecutive assistant content deltas that arrive within ``window``
+    seconds of each other (or until ``max_bytes`` of content is buffered).
+    The first content delta and any other kind of event are passed through
+    immediately, after flushing whatever is buffered.
+    """
+    loop = asyncio.get_running_loop()
+    received = asyncio.Queue(maxsize=_MAX_RECEIVED_EVENTS)
+    ready = asyncio.Event()
+
+    async def receive():
+        # Reads upstream on its own task so buffered content can be flushed
+        # on time even while the next delta is still pending. The queue is
+        # bounded, so a slow client still slows down the upstream read.
+        try:
+            async for event in r:
+                await received.put(event)
+                ready.set()
+        except Exception as error:
+            await received.put(error)
+        # Not reached when cancelled, where nobody is left to take the marker
+        await received.put(_END_OF_STREAM)
+        ready.set()
+
+    receiver = asyncio.create_task(receive())
+    buffer = _ContentBuffer()
+    window_timer = None
+    first_content_sent = False
+
+    try:
+        while True:
+            if received.empty():
+                if buffer.events and loop.time() >= buffer.deadline:
+                    yield buffer.flush()
+                    # Events received while the client took the flush already
+                    # set ready; check the queue again instead of clearing it
+                    continue
+                ready.clear()
+                await ready.wait()
+                continue
+
+            event = received.get_nowait()
+            if event is _END_OF_STREAM or isinstance(event, Exception):
+                # Deliver what was already received before ending or surfacing the error
+                if buffer.events:
+                    yield buffer.flush()
+                if event is _END_OF_STREAM:
+                    break
+                raise event
+
+            content = _assistant_content(event)
+            if content is None or not first_content_sent:
+                if buffer.events:
+                    yield buffer.flush()
+                first_content_sent = first_content_sent or content is not None
+                yield event
+                continue
+
+            if buffer.events and buffer.events[-1].get("id") != event.get("id"):
+                yield buffer.flush()
+
+            buffer.add(event, content)
+            if buffer.deadline is None:
+                buffer.deadline = loop.time() + window
+                # One timer per window wakes the loop if no further delta arrives
+                if window_timer is not None:
+                    window_timer.cancel()
+                window_timer = loop.call_later(window, ready.set)
+            if buffer.size >= max_bytes or loop.time() >= buffer.deadline:
+                yield buffer.flush()
+    finally:
+        if window_timer is not None:
+            window_timer.cancel()
+        receiver.cancel()
+        # The reader must have stopped before what it reads can be closed
+        await asyncio.gather(receiver, return_exceptions=True)
+        await close_stream(r)
+
+
+class _StreamEventSerializer:
+    '''
+    Serializes stream events exactly as ``json.dumps(event, cls=JSONEncoder)``.
+
+    Consecutive assistant content deltas of a stream differ only in their
+    content, so the JSON surrounding the content is rendered once into a
+    template and each delta only escapes and splices in its content. Any
+    other event, or a change of the surrounding fields (e.g. a title added
+    to history_metadata), falls back to or recompiles from ``json.dumps``.
+    '''
+    _PLACEHOLDER = "\x00content\x00"
+
+    def __init__(self):
+        self._key = None
+        self._template = None
+
+    @staticmethod
+    def _template_key(event):
+        try:
+            if len(event["choices"]) != 1 or len(event["choices"][0]) != 1:
+                return None
+            key = tuple(
+                (name, tuple(event["choices"][0]["messages"][0])) if name == "choices"
+                else (name, tuple(value.items())) if name == "history_metadata"
+                else (name, type(value), value)
+                for name, value in event.items()
+            )
+            hash(key)
+        except (KeyError, TypeError, AttributeError):
+            return None
+
+        return key
+
+    def _compile(self, event):
+        message = dict(event["choices"][0]["messages"][0])
+        message["content"] = self._PLACEHOLDER
+        rendered = json.dumps(dict(event, choices=[{"messages": [message]}]), cls=JSONEncoder)
+        encoded_placeholder = encode_basestring_ascii(self._PLACEHOLDER)
+        if rendered.count(encoded_placeholder) != 1:
+            return None
+
+        return tuple(rendered.split(encoded_placeholder))
+
+    def dumps(self, event):
+        content = _assistant_content(event)
+        if content is not None:
+            key = self._template_key(event)
+            if key is not None:
+                if key != self._key:
+                    self._key = key
+                    self._template = self._compile(event)
+                if self._template is not None:
+                    prefix, suffix = self._template
+                    return prefix + encode_basestring_ascii(content) + suffix
+
+        return json.dumps(event, cls=JSONEncoder)
+
+
+async def format_as_ndjson(r, coalesce_window: float = 0, coalesce_max_bytes: int = 1024):
+    if coalesce_window > 0:
+        r = _coalesce_content_events(r, coalesce_window, coalesce_max_bytes)
+
+    serializer = _StreamEventSerializer()
     try:
         async for event in r:
-            yield json.dumps(event, cls=JSONEncoder) + "\n"
+            yield serializer.dumps(event) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps({"error": str(error)})
+    finally:
+        # Runs when the client disconnects too, stopping the answer upstream
+        await close_stream(r)
 
 
 def parse_multi_columns(columns: str) -> list:
@@ -38,41 +280,13 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
-
-    headers = {"Authorization": "bearer " + userToken}
-    try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
-
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
-
-        return r["value"]
-    except Exception as e:
-        logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
-
-
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
-
-    # Construct filter string
+def generateFilterString(userGroups, permittedGroupsColumn):
+    # Construct filter string from the groups the user is a member of
     if not userGroups:
         logging.debug("No user groups found")
 
     group_ids = ", ".join([obj["id"] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+    return f"{permittedGroupsColumn}/any(g:search.in(g, '{group_ids}'))"
 
 
 def format_non_streaming_response(chatCompletion, history_metadata, apim_request_id):
@@ -159,6 +373,34 @@ def format_stream_response(chatCompletionChunk, history_metadata, apim_request_i
     return {}
 
 
+def _format_cached_response(object_name, messages, model, history_metadata):
+    return {
+        "id": str(uuid.uuid4()),
+        "model": model,
+        "created": int(time.time()),
+        "object": object_name,
+        "choices": [{"messages": [dict(message) for message in messages]}],
+        "history_metadata": history_metadata,
+        "apim-request-id": None,
+    }
+
+
+def format_cached_stream_response(messages, model, history_metadata):
+    # Replays a cached answer as one event per message, e.g. citations then answer
+    response_id = str(uuid.uuid4())
+    events = []
+    for message in messages:
+        event = _format_cached_response("chat.completion.chunk", [message], model, history_metadata)
+        event["id"] = response_id
+        events.append(event)
+
+    return events
+
+
+def format_cached_non_streaming_response(messages, model, history_metadata):
+    return _format_cached_response("chat.completion", messages, model, history_metadata)
+
+
 def format_pf_non_streaming_response(
     chatCompletion, history_metadata, response_field_name, citations_field_name, message_uuid=None
 ):
@@ -206,6 +448,65 @@ def format_pf_non_streaming_response(
         return {}
 
 
+async def parse_pf_stream(response):
+    '''
+    Yields the JSON objects of a promptflow response as they arrive. Handles
+    server-sent events, JSON lines, and a plain JSON body from endpoints that
+    do not stream.
+    '''
+    content_type = response.headers.get("content-type", "")
+    if content_type.startswith("text/event-stream"):
+        data = []
+        async for line in response.aiter_lines():
+            if line.startswith("data:"):
+                data.append(line[5:].removeprefix(" "))
+            elif not line and data:
+                payload, data = "\n".join(data), []
+                if payload != "[DONE]":
+                    yield json.loads(payload)
+        if data and data != ["[DONE]"]:
+            yield json.loads("\n".join(data))
+    elif "jsonl" in content_type or "ndjson" in content_type:
+        async for line in response.aiter_lines():
+            if line.strip():
+                yield json.loads(line)
+    else:
+        yield json.loads(await response.aread())
+
+
+def format_pf_stream_response(
+    pfChunk, history_metadata, response_field_name, citations_field_name, response_id
+):
+    # One event per message, citations first, as the UI reads the first message of each event
+    if "error" in pfChunk:
+        logging.error(f"Error in promptflow stream: {pfChunk['error']}")
+        raise Exception(pfChunk["error"])
+
+    messages = []
+    if pfChunk.get(citations_field_name):
+        messages.append({
+            "role": "tool",
+            "content": json.dumps({"citations": pfChunk[citations_field_name]})
+        })
+    if pfChunk.get(response_field_name):
+        messages.append({
+            "role": "assistant",
+            "content": pfChunk[response_field_name]
+        })
+
+    return [
+        {
+            "id": response_id,
+            "model": "",
+            "created": "",
+            "object": "",
+            "history_metadata": history_metadata,
+            "choices": [{"messages": [message]}],
+        }
+        for message in messages
+    ]
+
+
 def convert_to_pf_format(input_json, request_field_name, response_field_name):
     output_json = []
     logging.debug(f"Input json: {input_json}")
@@ -0,0 +1,116 @@
+"""Measure request units and latency of reading a long conversation from Cosmos DB.
+
+Compares the former reads (cross-partition SELECT * queries, messages ordered
+on c.timestamp) with the client's reads (a point read of the conversation and
+a projected query of its messages in the user's partition, ordered on
+c.createdAt). The conversation is written under a throwaway user id and
+deleted afterwards.
+
+Needs a Cosmos DB account or the emulator with the chat history container:
+
+Usage:
+    AZURE_COSMOSDB_ACCOUNT=... AZURE_COSMOSDB_ACCOUNT_KEY=... \\
+        python tests/benchmarks/benchmark_history_reads.py --messages 200 --reads 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from backend.history.cosmosdbservice import CosmosConversationClient, MAX_BATCH_OPERATIONS, RequestCharge  # noqa: E402
+from backend.metrics import MetricsRegistry  # noqa: E402
+
+FORMER_CONVERSATION_QUERY = "SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
+FORMER_MESSAGES_QUERY = "SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+
+
+async def former_read(client, query, user_id, conversation_id):
+    parameters = [
+        {"name": "@conversationId", "value": conversation_id},
+        {"name": "@userId", "value": user_id},
+    ]
+    request_charge = RequestCharge()
+    items = [
+        item async for item in client.container_client.query_items(
+            query=query, parameters=parameters, response_hook=request_charge
+        )
+    ]
+    return items, request_charge.request_units
+
+
+async def current_read(client, operation, user_id, conversation_id):
+    histogram = client.registry.histogram(f"cosmos.{operation}.request_charge")
+    charged = histogram.sum
+    result = await getattr(client, operation)(user_id, conversation_id)
+    return result, histogram.sum - charged
+
+
+async def measure(read, reads):
+    latencies = []
+    request_units = []
+    for _ in range(reads):
+        start = time.perf_counter()
+        result, charge = await read()
+        latencies.append((time.perf_counter() - start) * 1000)
+        request_units.append(charge)
+    size = len(result) if isinstance(result, list) else 1
+    return size, statistics.mean(request_units), statistics.median(latencies), max(latencies)
+
+
+async def main(args):
+    client = CosmosConversationClient(
+        cosmosdb_endpoint=args.endpoint,
+        credential=args.key,
+        database_name=args.database,
+        container_name=args.container,
+        registry=MetricsRegistry(),
+    )
+    user_id = f"benchmark-{uuid.uuid4()}"
+    content = "x" * args.content_bytes
+    try:
+        conversation = await client.create_conversation(user_id, "benchmark")
+        conversation_id = conversation["id"]
+        messages = [
+            (str(uuid.uuid4()), {"role": "user" if i % 2 == 0 else "assistant", "content": content})
+            for i in range(args.messages)
+        ]
+        for i in range(0, len(messages), MAX_BATCH_OPERATIONS - 1):
+            await client.add_messages_batch(conversation_id, user_id, messages[i:i + MAX_BATCH_OPERATIONS - 1])
+
+        print(f"conversation of {args.messages} messages of {args.content_bytes} bytes, {args.reads} reads each")
+        reads = (
+            ("get_conversation", "former", lambda: former_read(client, FORMER_CONVERSATION_QUERY, user_id, conversation_id)),
+            ("get_conversation", "current", lambda: current_read(client, "get_conversation", user_id, conversation_id)),
+            ("get_messages", "former", lambda: former_read(client, FORMER_MESSAGES_QUERY, user_id, conversation_id)),
+            ("get_messages", "current", lambda: current_read(client, "get_messages", user_id, conversation_id)),
+        )
+        for operation, label, read in reads:
+            items, request_units, p50, worst = await measure(read, args.reads)
+            print(
+                f"{operation:>16} {label:>7}: items {items:5d}  "
+                f"RU/read {request_units:8.2f}  "
+                f"p50 {p50:7.1f} ms  max {worst:7.1f} ms"
+            )
+    finally:
+        await client.delete_all_conversations(user_id)
+        await client.cosmosdb_client.close()
+
+
+if __name__ == "__main__":
+    account = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--endpoint", default=f"https://{account}.documents.azure.com:443/" if account else None)
+    parser.add_argument("--key", default=os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY"))
+    parser.add_argument("--database", default=os.environ.get("AZURE_COSMOSDB_DATABASE", "db_conversation_history"))
+    parser.add_argument("--container", default=os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER", "conversations"))
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--content-bytes", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=20)
+    args = parser.parse_args()
+    if not args.endpoint or not args.key:
+        parser.error("set AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_ACCOUNT_KEY, or pass --endpoint and --key")
+    asyncio.run(main(args))
@@ -0,0 +1,93 @@
+"""Compare allocations of deepcopy-based and lazy secret redaction for request logging.
+
+Usage:
+    python tests/benchmarks/benchmark_model_args_redaction.py --turns 50
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from backend.utils import SECRET_PARAMS, RedactedModelArgs  # noqa: E402
+
+
+def model_args(turns):
+    messages = [{"role": "system", "content": "You are an AI assistant that helps people find information."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"Question {i} " + "lorem ipsum " * 40})
+        messages.append({
+            "role": "assistant",
+            "content": f"Answer {i} " + "dolor sit amet " * 80,
+            "context": {"citations": [{"content": "citation " * 100, "url": f"https://example.com/{i}"}]},
+        })
+
+    return {
+        "messages": messages,
+        "temperature": 0,
+        "max_tokens": 1000,
+        "stream": True,
+        "model": "gpt-4",
+        "extra_body": {
+            "data_sources": [{
+                "type": "azure_search",
+                "parameters": {
+                    "endpoint": "https://search.search.windows.net",
+                    "index_name": "index",
+                    "authentication": {"type": "api_key", "key": "secret"},
+                    "embedding_dependency": {"type": "deployment_name", "deployment_name": "embedding"},
+                },
+            }]
+        },
+    }
+
+
+def deepcopy_redaction(args):
+    # The previous implementation: copy and mask on every request, then log
+    clean = copy.deepcopy(args)
+    parameters = clean["extra_body"]["data_sources"][0]["parameters"]
+    for secret_param in SECRET_PARAMS:
+        if parameters.get(secret_param):
+            parameters[secret_param] = "*****"
+    for field in parameters.get("authentication", {}):
+        if field in SECRET_PARAMS:
+            parameters["authentication"][field] = "*****"
+    logging.debug(f"REQUEST BODY: {json.dumps(clean, indent=4)}")
+
+
+def lazy_redaction(args):
+    logging.debug("REQUEST BODY: %s", RedactedModelArgs(args))
+
+
+def measure(func, args, iterations):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed / iterations
+
+
+def main(args):
+    # Format records like a real handler would, without printing them
+    logging.getLogger().addHandler(logging.StreamHandler(open(os.devnull, "w")))
+    request = model_args(args.turns)
+    print(f"{args.turns}-turn history, {args.iterations} requests")
+    for level_name, level in (("debug off", logging.INFO), ("debug on", logging.DEBUG)):
+        logging.getLogger().setLevel(level)
+        for name, func in (("deepcopy", deepcopy_redaction), ("lazy", lazy_redaction)):
+            peak, per_request = measure(func, request, args.iterations)
+            print(f"{level_name:>9} {name:>8}: peak alloc {peak / 1024:9.1f} KiB  {per_request * 1e6:9.1f} us/request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=200)
+    main(parser.parse_args())
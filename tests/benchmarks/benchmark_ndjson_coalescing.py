@@ -0,0 +1,85 @@
+"""Measure format_as_ndjson with and without chunk coalescing on a mocked stream.
+
+Every NDJSON line yielded by format_as_ndjson becomes one write to the
+transport, so "writes/response" approximates send() syscalls per response.
+
+Usage:
+    python tests/benchmarks/benchmark_ndjson_coalescing.py --tokens 1000 --interval-ms 2
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from backend.utils import format_as_ndjson  # noqa: E402
+
+
+def content_event(content):
+    return {
+        "id": "chatcmpl-benchmark",
+        "model": "gpt-4",
+        "created": 0,
+        "object": "chat.completion.chunk",
+        "choices": [{"messages": [{"role": "assistant", "content": content}]}],
+        "history_metadata": {"conversation_id": "benchmark"},
+        "apim-request-id": "benchmark",
+    }
+
+
+async def mocked_stream(tokens, interval):
+    for token in tokens:
+        if interval:
+            # Exponential inter-arrival times, as tokens tend to arrive in bursts
+            await asyncio.sleep(random.expovariate(1 / interval))
+        yield content_event(token)
+
+
+async def measure(tokens, interval, window, max_bytes):
+    writes = 0
+    written_bytes = 0
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    async for line in format_as_ndjson(
+        mocked_stream(tokens, interval),
+        coalesce_window=window,
+        coalesce_max_bytes=max_bytes,
+    ):
+        writes += 1
+        written_bytes += len(line.encode("utf-8"))
+
+    return {
+        "writes": writes,
+        "bytes": written_bytes,
+        "wall": time.perf_counter() - wall_start,
+        "cpu": time.process_time() - cpu_start,
+    }
+
+
+async def main(args):
+    random.seed(0)
+    tokens = [random.choice(["The", " quick", " brown", " fox", " jumps", ".", "\n"]) for _ in range(args.tokens)]
+    windows_ms = [0] + args.windows_ms
+
+    for label, interval in (("burst", 0), (f"paced {args.interval_ms} ms", args.interval_ms / 1000)):
+        print(f"{args.tokens} upstream deltas, {label}")
+        for window_ms in windows_ms:
+            result = await measure(tokens, interval, window_ms / 1000, args.max_bytes)
+            name = "no coalescing" if window_ms == 0 else f"window {window_ms} ms"
+            print(
+                f"{name:>16}: writes/response {result['writes']:6d}  "
+                f"bytes {result['bytes']:8d}  "
+                f"events/sec {args.tokens / result['wall']:10.0f}  "
+                f"cpu {result['cpu'] * 1000:7.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--interval-ms", type=float, default=2)
+    parser.add_argument("--windows-ms", type=int, nargs="+", default=[20, 50])
+    parser.add_argument("--max-bytes", type=int, default=1024)
+    asyncio.run(main(parser.parse_args()))
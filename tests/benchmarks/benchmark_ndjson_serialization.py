@@ -0,0 +1,64 @@
+"""Compare CPU per content delta of format_as_ndjson with plain json.dumps serialization.
+
+format_as_ndjson renders the JSON around assistant content deltas once and
+only escapes each delta's content; the baseline serializes every event.
+
+Usage:
+    python tests/benchmarks/benchmark_ndjson_serialization.py --tokens 2000 --repeat 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from backend.utils import JSONEncoder, format_as_ndjson  # noqa: E402
+
+
+def content_event(content):
+    return {
+        "id": "chatcmpl-benchmark",
+        "model": "gpt-4",
+        "created": 0,
+        "object": "chat.completion.chunk",
+        "choices": [{"messages": [{"role": "assistant", "content": content}]}],
+        "history_metadata": {"conversation_id": "benchmark"},
+        "apim-request-id": "benchmark",
+    }
+
+
+async def stream(events):
+    for event in events:
+        yield event
+
+
+async def baseline(events):
+    async for event in stream(events):
+        yield json.dumps(event, cls=JSONEncoder) + "\n"
+
+
+async def consume(lines):
+    start = time.process_time()
+    async for _ in lines:
+        pass
+    return time.process_time() - start
+
+
+async def main(args):
+    events = [content_event(f"token {i} ") for i in range(args.tokens)]
+    # The best of several runs, as the process timer is coarse on some platforms
+    baseline_cpu = min([await consume(baseline(events)) for _ in range(args.repeat)])
+    template_cpu = min([await consume(format_as_ndjson(stream(events))) for _ in range(args.repeat)])
+
+    print(f"{args.tokens} content deltas, best of {args.repeat}")
+    for name, cpu in (("json.dumps", baseline_cpu), ("format_as_ndjson", template_cpu)):
+        print(f"{name:>16}: cpu {cpu * 1000:7.1f} ms  per delta {cpu / args.tokens * 1e6:6.2f} us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
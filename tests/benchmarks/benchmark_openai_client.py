@@ -0,0 +1,100 @@
+"""Compare a per-request AsyncAzureOpenAI client with a pooled, per-worker client.
+
+Usage:
+    python tests/benchmarks/benchmark_openai_client.py --requests 500 --concurrency 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+
+sys.path.append(os.path.dirname(__file__))
+from mock_aoai_server import MockAzureOpenAIServer  # noqa: E402
+
+API_VERSION = "2024-05-01-preview"
+MODEL = "benchmark"
+MESSAGES = [{"role": "user", "content": "What is Contoso?"}]
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run(make_client, release_client, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            client = make_client()
+            await client.chat.completions.create(model=MODEL, messages=MESSAGES)
+            await release_client(client)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(one() for _ in range(total)))
+    return latencies
+
+
+async def main(args):
+    async with MockAzureOpenAIServer(latency=args.latency) as server:
+        def new_client(http_client=None):
+            return AsyncAzureOpenAI(
+                api_version=API_VERSION,
+                api_key="benchmark",
+                azure_endpoint=server.endpoint,
+                http_client=http_client,
+            )
+
+        async def close_client(client):
+            await client.close()
+
+        async def keep_client(client):
+            pass
+
+        pooled = new_client(
+            DefaultAsyncHttpxClient(
+                http2=args.http2,
+                limits=httpx.Limits(
+                    max_connections=args.max_connections,
+                    max_keepalive_connections=args.max_keepalive_connections,
+                    keepalive_expiry=30.0,
+                ),
+            )
+        )
+
+        results = {
+            "per-request client": await run(
+                new_client, close_client, args.requests, args.concurrency
+            ),
+            "pooled client": await run(
+                lambda: pooled, keep_client, args.requests, args.concurrency
+            ),
+        }
+        await pooled.close()
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}, server latency {args.latency * 1000:.0f} ms")
+    for name, latencies in results.items():
+        print(
+            f"{name:>20}: p50 {percentile(latencies, 50):7.2f} ms  "
+            f"p99 {percentile(latencies, 99):7.2f} ms  "
+            f"mean {statistics.mean(latencies):7.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated server latency in seconds")
+    parser.add_argument("--max-connections", type=int, default=100)
+    parser.add_argument("--max-keepalive-connections", type=int, default=20)
+    parser.add_argument("--http2", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,102 @@
+"""Local mock of the Azure OpenAI chat completions endpoint for benchmarks."""
+import asyncio
+import json
+import time
+import uuid
+
+from aiohttp import web
+
+
+def _completion(model, content):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }
+        ],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+    }
+
+
+def _chunk(completion_id, model, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+class MockAzureOpenAIServer:
+    def __init__(self, latency: float = 0.0, tokens: list = None):
+        self.latency = latency
+        self.tokens = tokens or ["Hello", " from", " the", " mock", " server", "."]
+        self.request_count = 0
+        self._runner = None
+        self.port = None
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def chat_completions(self, request: web.Request):
+        self.request_count += 1
+        body = await request.json()
+        model = request.match_info["deployment"]
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        headers = {"apim-request-id": str(uuid.uuid4())}
+        if not body.get("stream"):
+            return web.json_response(
+                _completion(model, "".join(self.tokens)), headers=headers
+            )
+
+        response = web.StreamResponse(
+            headers={**headers, "Content-Type": "text/event-stream"}
+        )
+        await response.prepare(request)
+        completion_id = f"chatcmpl-{uuid.uuid4()}"
+        await response.write(
+            f"data: {json.dumps(_chunk(completion_id, model, {'role': 'assistant', 'content': ''}))}\n\n".encode()
+        )
+        for token in self.tokens:
+            await response.write(
+                f"data: {json.dumps(_chunk(completion_id, model, {'content': token}))}\n\n".encode()
+            )
+        await response.write(
+            f"data: {json.dumps(_chunk(completion_id, model, {}, 'stop'))}\n\n".encode()
+        )
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(
+            "/openai/deployments/{deployment}/chat/completions", self.chat_completions
+        )
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *args):
+        await self.stop()
@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+import pytest
+
+from backend.admission import AdmissionController, RateLimitExceeded
+from backend.load_balancer import Deployment, LoadBalancer
+from backend.metrics import MetricsRegistry
+
+
+def controller(**kwargs):
+    return AdmissionController(registry=MetricsRegistry(), **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_requests_wait_for_tokens_in_arrival_order():
+    # 100 tokens a second
+    admission = controller(tokens_per_minute=6000)
+    await admission.admit(6000)
+
+    admitted = []
+
+    async def request(name):
+        await admission.admit(10)
+        admitted.append((name, time.monotonic()))
+
+    start = time.monotonic()
+    await asyncio.gather(*[request(name) for name in "abc"])
+
+    assert [name for name, _ in admitted] == ["a", "b", "c"]
+    assert admitted[-1][1] - start == pytest.approx(0.3, abs=0.05)
+    assert admission.wait_ms.count == 4
+    assert admission.queue_depth.value == 0
+
+
+@pytest.mark.asyncio
+async def test_queue_depth_reported_while_waiting():
+    admission = controller(tokens_per_minute=6000)
+    await admission.admit(6000)
+
+    waiting = [asyncio.create_task(admission.admit(10)) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert admission.queue_depth.value == 3
+
+    await asyncio.gather(*waiting)
+    assert admission.queue_depth.value == 0
+
+
+@pytest.mark.asyncio
+async def test_sheds_requests_that_would_wait_too_long():
+    admission = controller(tokens_per_minute=6000, max_wait=10)
+    await admission.admit(6000)
+
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await admission.admit(2000)
+
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.retry_after == pytest.approx(20, abs=0.1)
+    assert admission.shed.value == 1
+    # Shed requests reserve nothing
+    assert admission.delay(10) == pytest.approx(0.1, abs=0.01)
+
+
+@pytest.mark.asyncio
+async def test_sheds_when_queue_is_full():
+    admission = controller(tokens_per_minute=6000, max_queue_depth=1)
+    await admission.admit(6000)
+
+    waiting = asyncio.create_task(admission.admit(10))
+    await asyncio.sleep(0)
+    with pytest.raises(RateLimitExceeded):
+        await admission.admit(10)
+
+    await waiting
+
+
+@pytest.mark.asyncio
+async def test_requests_per_minute():
+    admission = controller(requests_per_minute=60, max_wait=0.5)
+    for _ in range(60):
+        await admission.admit(0)
+
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await admission.admit(0)
+    assert exc_info.value.retry_after == pytest.approx(1, abs=0.05)
+
+
+@pytest.mark.asyncio
+async def test_settle_returns_unused_tokens():
+    admission = controller(tokens_per_minute=6000, max_wait=0)
+    reserved = await admission.admit(6000)
+    admission.settle(reserved, 1000)
+
+    assert await admission.admit(5000) == 5000
+    with pytest.raises(RateLimitExceeded):
+        await admission.admit(100)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_request_returns_its_reservation():
+    admission = controller(tokens_per_minute=6000, requests_per_minute=60)
+    await admission.admit(6000)
+
+    waiting = asyncio.create_task(admission.admit(500))
+    await asyncio.sleep(0.01)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+
+    assert admission.queue_depth.value == 0
+    assert admission.delay(10) < 0.2
+
+
+@pytest.mark.asyncio
+async def test_load_balancer_prefers_deployment_with_quota():
+    registry = MetricsRegistry()
+    drained = AdmissionController(tokens_per_minute=6000, name="drained", registry=registry)
+    await drained.admit(6000)
+    load_balancer = LoadBalancer(
+        [
+            Deployment("drained", None, "gpt-4", weight=10, admission=drained),
+            Deployment("spare", None, "gpt-4", admission=AdmissionController(tokens_per_minute=6000, name="spare", registry=registry)),
+        ],
+        registry=registry,
+    )
+
+    async def complete(lease):
+        lease.release(tokens=100)
+        return lease.deployment.name
+
+    assert await load_balancer.call(complete, tokens=1000) == "spare"
+    # The estimate was settled against the actual usage
+    assert load_balancer.deployments[1].admission.token_bucket.tokens == pytest.approx(5900, abs=1)
@@ -0,0 +1,953 @@
+import asyncio
+import httpx
+import json
+import os
+import pytest
+from importlib import import_module, reload
+from types import SimpleNamespace
+
+from aiohttp import web
+from openai import AsyncAzureOpenAI
+
+from backend.admission import AdmissionController
+from backend.fair_scheduler import FairScheduler
+from backend.function_calling.tool_executor import ToolExecutor
+from backend.history_trimming import HistoryTrimmer, SummaryCache
+from backend.load_balancer import Deployment, LoadBalancer
+from backend.metrics import MetricsRegistry
+from backend.response_cache import ResponseCache
+from backend.single_flight import SingleFlight
+
+
+@pytest.fixture(scope="function")
+def app_module():
+    # Reload module objects to pick up a known environment
+    os.environ["DOTENV_PATH"] = os.path.join(
+        os.path.dirname(__file__),
+        "dotenv_data",
+        "dotenv_no_datasource_1"
+    )
+    reload(import_module("backend.settings"))
+    app_module = reload(import_module("app"))
+
+    yield app_module
+
+
+@pytest.mark.asyncio
+async def test_openai_client_shared_across_requests(app_module):
+    test_app = app_module.create_app()
+
+    async with test_app.test_app():
+        client = test_app.azure_openai_client
+        assert client is not None
+
+        async with test_app.app_context():
+            assert await app_module.get_openai_client() is client
+            assert await app_module.get_openai_client() is client
+
+    assert test_app.azure_openai_client is None
+    assert client.is_closed()
+
+
+@pytest.mark.asyncio
+async def test_openai_client_lazy_initialization(app_module):
+    test_app = app_module.create_app()
+
+    async with test_app.app_context():
+        client = await app_module.get_openai_client()
+        assert client is not None
+        assert await app_module.get_openai_client() is client
+
+    await client.close()
+
+
+class FakeCredential:
+    '''Credential whose tokens cannot be acquired'''
+    instances = []
+
+    def __init__(self):
+        self.closed = False
+        FakeCredential.instances.append(self)
+
+    async def get_token(self, *scopes):
+        raise RuntimeError("no identity available")
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_failed_openai_initialization_releases_credential(app_module, monkeypatch):
+    FakeCredential.instances = []
+    monkeypatch.setattr(app_module, "DefaultAzureCredential", FakeCredential)
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "key", None)
+    test_app = app_module.create_app()
+
+    async with test_app.app_context():
+        # Misconfigured: nothing is created
+        monkeypatch.setattr(app_module.app_settings.azure_openai, "model", None)
+        with pytest.raises(ValueError):
+            await app_module.get_openai_client()
+        assert FakeCredential.instances == []
+
+        # The credential fails: it is closed and not kept
+        monkeypatch.setattr(app_module.app_settings.azure_openai, "model", "my_model")
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await app_module.get_openai_client()
+
+    assert [credential.closed for credential in FakeCredential.instances] == [True, True]
+    assert test_app.azure_openai_token_provider is None
+    assert test_app.azure_openai_client is None
+
+
+@pytest.mark.asyncio
+async def test_failed_openai_initialization_closes_tool_clients(app_module, monkeypatch):
+    registries = []
+
+    class FakeToolRegistry:
+        def __init__(self, url, ttl, http_client):
+            self.http_client = http_client
+            self.closed = False
+            registries.append(self)
+
+        async def start(self):
+            pass
+
+        async def close(self):
+            self.closed = True
+
+    def failing_load_balancer(*args, **kwargs):
+        raise RuntimeError("invalid deployment pool")
+
+    monkeypatch.setattr(app_module, "ToolRegistry", FakeToolRegistry)
+    monkeypatch.setattr(app_module, "LoadBalancer", failing_load_balancer)
+    settings = app_module.app_settings.azure_openai
+    monkeypatch.setattr(settings, "function_call_azure_functions_enabled", True)
+    monkeypatch.setattr(settings, "function_call_azure_functions_tools_base_url", "https://functions.example/api/tools")
+    monkeypatch.setattr(settings, "function_call_azure_functions_tool_base_url", "https://functions.example/api/tool")
+    test_app = app_module.create_app()
+
+    async with test_app.app_context():
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await app_module.get_openai_client()
+
+    assert len(registries) == 2
+    assert all(registry.closed and registry.http_client.is_closed for registry in registries)
+    assert test_app.azure_openai_tool_registry is None
+    assert test_app.azure_functions_http_client is None
+
+
+@pytest.mark.asyncio
+async def test_process_function_call_preserves_tool_call_order(app_module, monkeypatch):
+    class FakeToolRegistry:
+        available_tools = frozenset({"first", "second"})
+
+    class FakeToolExecutor:
+        async def call_all(self, tool_calls):
+            return [f"{name} result" for name, _ in tool_calls]
+
+    def tool_call(name):
+        return SimpleNamespace(function=SimpleNamespace(name=name, arguments="{}"))
+
+    response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+        role="assistant",
+        tool_calls=[tool_call("second"), tool_call("unknown"), tool_call("first")],
+    ))])
+
+    monkeypatch.setattr(
+        app_module.app_settings.azure_openai,
+        "function_call_azure_functions_enabled",
+        True
+    )
+    test_app = app_module.create_app()
+    test_app.azure_openai_tool_registry = FakeToolRegistry()
+    test_app.azure_openai_tool_executor = FakeToolExecutor()
+
+    async with test_app.app_context():
+        messages = await app_module.process_function_call(response)
+
+    assert [(m["role"], m.get("content")) for m in messages] == [
+        ("assistant", None),
+        ("function", "second result"),
+        ("assistant", None),
+        ("function", "first result"),
+    ]
+
+
+class FakeCosmosConversationClient:
+    def __init__(self):
+        self.conversations = {}
+        self.messages = []
+        self.batches = []
+        self.jobs = {}
+
+    async def create_conversation(self, user_id, title=''):
+        conversation = {"id": f"conversation-{len(self.conversations)}", "title": title, "createdAt": "now"}
+        self.conversations[conversation["id"]] = conversation
+        return conversation
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message):
+        self.messages.append(input_message)
+        return {"id": uuid}
+
+    async def add_messages_batch(self, conversation_id, user_id, input_messages):
+        self.batches.append([message_id for message_id, _ in input_messages])
+        self.messages.extend(input_message for _, input_message in input_messages)
+        return [{"id": message_id} for message_id, _ in input_messages]
+
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        self.conversations[conversation_id]["title"] = title
+        return self.conversations[conversation_id]
+
+    async def get_conversations(self, user_id, limit, sort_order="DESC", offset=0):
+        return list(self.conversations.values())[offset:offset + limit]
+
+    async def get_conversations_page(self, user_id, limit, continuation_token=None, sort_order="DESC"):
+        start = int(continuation_token or 0)
+        conversations = list(self.conversations.values())
+        end = start + limit
+        return conversations[start:end], str(end) if end < len(conversations) else None
+
+    async def delete_all_conversations(self, user_id):
+        deleted = len(self.conversations)
+        self.conversations.clear()
+        self.messages.clear()
+        return deleted
+
+    async def create_deletion_job(self, user_id):
+        job = {"id": f"job-{len(self.jobs)}", "status": "running", "deleted": 0}
+        self.jobs[job["id"]] = job
+        return dict(job)
+
+    async def update_deletion_job(self, user_id, job_id, status, deleted=0, error=None):
+        self.jobs[job_id].update(status=status, deleted=deleted, error=error)
+        return self.jobs[job_id]
+
+    async def get_deletion_job(self, user_id, job_id):
+        return self.jobs.get(job_id)
+
+
+@pytest.mark.asyncio
+async def test_conversation_title_generated_in_background(app_module, monkeypatch):
+    title_requested = app_module.asyncio.Event()
+    release_title = app_module.asyncio.Event()
+
+    async def slow_generate_title(conversation_messages):
+        title_requested.set()
+        await release_title.wait()
+        return "Generated title"
+
+    async def echo_history_metadata(request_body, request_headers):
+        return app_module.jsonify(dict(request_body["history_metadata"]))
+
+    monkeypatch.setattr(app_module, "generate_title", slow_generate_title)
+    monkeypatch.setattr(app_module, "conversation_internal", echo_history_metadata)
+
+    test_app = app_module.create_app()
+    async with test_app.test_app() as started_app:
+        cosmos_client = FakeCosmosConversationClient()
+        test_app.cosmos_conversation_client = cosmos_client
+
+        response = await started_app.test_client().post(
+            "/history/generate",
+            json={"messages": [{"role": "user", "content": "What is Contoso?"}]}
+        )
+        history_metadata = await response.get_json()
+
+        # The answer is not held back by title generation
+        assert response.status_code == 200
+        assert history_metadata["title"] == "What is Contoso?"
+        assert cosmos_client.messages == [{"role": "user", "content": "What is Contoso?"}]
+
+        await title_requested.wait()
+        release_title.set()
+        await app_module.asyncio.gather(*test_app.background_tasks)
+
+    conversation = cosmos_client.conversations[history_metadata["conversation_id"]]
+    assert conversation["title"] == "Generated title"
+
+
+@pytest.mark.asyncio
+async def test_update_writes_tool_and_assistant_messages_in_one_batch(app_module):
+    test_app = app_module.create_app()
+    async with test_app.test_app() as started_app:
+        cosmos_client = FakeCosmosConversationClient()
+        test_app.cosmos_conversation_client = cosmos_client
+
+        response = await started_app.test_client().post("/history/update", json={
+            "conversation_id": "conversation-0",
+            "messages": [
+                {"role": "user", "content": "How many vacation days?"},
+                {"role": "tool", "content": '{"citations": []}'},
+                {"id": "assistant-1", "role": "assistant", "content": "You get 20 days."},
+            ],
+        })
+
+    assert response.status_code == 200
+    assert len(cosmos_client.batches) == 1
+    assert cosmos_client.batches[0][1] == "assistant-1"
+    assert [message["role"] for message in cosmos_client.messages] == ["tool", "assistant"]
+
+
+@pytest.mark.asyncio
+async def test_delete_all_in_background(app_module):
+    test_app = app_module.create_app()
+    async with test_app.test_app() as started_app:
+        cosmos_client = FakeCosmosConversationClient()
+        test_app.cosmos_conversation_client = cosmos_client
+        for _ in range(3):
+            await cosmos_client.create_conversation("user-1")
+        client = started_app.test_client()
+
+        response = await client.delete("/history/delete_all?background=true")
+        assert response.status_code == 202
+        job = await response.get_json()
+        assert job["status"] == "running"
+
+        await app_module.asyncio.gather(*test_app.background_tasks)
+        response = await client.get(response.headers["Location"])
+        assert await response.get_json() == {"job_id": job["job_id"], "status": "succeeded", "deleted": 3, "error": None}
+        assert cosmos_client.conversations == {}
+
+        response = await client.get("/history/delete_all/unknown")
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_list_conversations_with_cursor(app_module):
+    test_app = app_module.create_app()
+    async with test_app.test_app() as started_app:
+        cosmos_client = FakeCosmosConversationClient()
+        test_app.cosmos_conversation_client = cosmos_client
+        for _ in range(30):
+            await cosmos_client.create_conversation("user-1")
+        client = started_app.test_client()
+
+        # Without a cursor the list is still a plain array
+        response = await client.get("/history/list?offset=25")
+        assert len(await response.get_json()) == 5
+
+        response = await client.get("/history/list?cursor=")
+        first_page = await response.get_json()
+        assert len(first_page["conversations"]) == 25
+        response = await client.get("/history/list", query_string={"cursor": first_page["next"]})
+        second_page = await response.get_json()
+        assert [c["id"] for c in second_page["conversations"]] == [f"conversation-{i}" for i in range(25, 30)]
+        assert second_page["next"] is None
+
+        assert (await client.get("/history/list?cursor=not-base64!")).status_code == 400
+        assert (await client.get("/history/list?offset=0%20limit%201000")).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_prepare_model_args_trims_and_summarizes_history(app_module, monkeypatch):
+    summarized = []
+
+    async def fake_summarize_history(messages, previous_summary=None):
+        summarized.append((messages, previous_summary))
+        return f"Summary {len(summarized)}."
+
+    history_trimmer = HistoryTrimmer(600, encoding_name=None, registry=MetricsRegistry())
+    monkeypatch.setattr(app_module, "history_trimmer", history_trimmer)
+    monkeypatch.setattr(app_module, "history_summary_cache", SummaryCache(registry=MetricsRegistry()))
+    monkeypatch.setattr(app_module, "summarize_history", fake_summarize_history)
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "history_summarize", True)
+
+    request_messages = []
+    for i in range(20):
+        request_messages.append({"role": "user", "content": f"question {i} " + "word " * 20})
+        request_messages.append({"role": "assistant", "content": f"answer {i} " + "word " * 20})
+
+    test_app = app_module.create_app()
+    sent = []
+    for turn in range(10):
+        request_messages.append({"role": "user", "content": f"latest question {turn}"})
+        async with test_app.test_request_context("/conversation", method="POST"):
+            model_args = await app_module.prepare_model_args({"messages": request_messages}, {})
+        sent.append(model_args["messages"])
+        request_messages.append({"role": "assistant", "content": f"latest answer {turn} " + "word " * 20})
+
+        messages = model_args["messages"]
+        assert messages[0]["role"] == "system"
+        assert messages[1] == {"role": "assistant", "content": f"Summary of the earlier conversation: Summary {len(summarized)}."}
+        assert messages[2]["role"] == "user"
+        assert messages[-1] == {"role": "user", "content": f"latest question {turn}"}
+        assert history_trimmer.count_tokens(messages) <= 600
+
+    # Turns that fit beside the cached summary do not summarize again
+    assert 1 < len(summarized) < 5
+    # Each summary carries over the previous one and only adds the turns dropped since
+    covered = 0
+    for i, (messages, previous_summary) in enumerate(summarized):
+        assert previous_summary == (f"Summary {i}." if i else None)
+        assert messages == request_messages[covered:covered + len(messages)]
+        covered += len(messages)
+    assert sent[-1][2:-1] == request_messages[covered:len(request_messages) - 2]
+
+
+@pytest.mark.asyncio
+async def test_summarize_history_prompt_stays_within_budget(app_module, monkeypatch):
+    prompts = []
+
+    async def create(**kwargs):
+        prompts.append(kwargs["messages"])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Summary."))])
+
+    async def fake_get_openai_client():
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    history_trimmer = HistoryTrimmer(600, encoding_name=None, registry=MetricsRegistry())
+    monkeypatch.setattr(app_module, "history_trimmer", history_trimmer)
+    monkeypatch.setattr(app_module, "get_openai_client", fake_get_openai_client)
+
+    dropped = []
+    for i in range(200):
+        dropped.append({"role": "user", "content": f"question {i} " + "word " * 20})
+        dropped.append({"role": "assistant", "content": f"answer {i} " + "word " * 20})
+
+    assert await app_module.summarize_history(dropped, previous_summary="Earlier summary.") == "Summary."
+
+    prompt = prompts[0]
+    assert prompt[0]["content"] == "Summary of the earlier conversation: Earlier summary."
+    assert prompt[1]["role"] == "user"
+    assert prompt[-2] == dropped[-1]
+    assert history_trimmer.count_tokens(prompt) + app_module.HISTORY_SUMMARY_MAX_TOKENS <= 600
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("across_users", [False, True])
+async def test_identical_requests_share_one_call(app_module, monkeypatch, across_users):
+    upstream_calls = []
+
+    async def fake_create_chat_completion(model_args):
+        upstream_calls.append(model_args)
+        await asyncio.sleep(0.05)
+        return "answer", "apim-request-id"
+
+    async def fake_get_openai_client():
+        return None
+
+    # Defender user context is on by default and differs per user
+    assert app_module.MS_DEFENDER_ENABLED
+    monkeypatch.setattr(app_module, "single_flight", SingleFlight(registry=MetricsRegistry()))
+    monkeypatch.setattr(app_module, "create_chat_completion", fake_create_chat_completion)
+    monkeypatch.setattr(app_module, "get_openai_client", fake_get_openai_client)
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "stream", False)
+    if across_users:
+        monkeypatch.setattr(app_module.app_settings.azure_openai, "coalesce_across_users", True)
+
+    async def ask(user, question):
+        headers = {"X-Ms-Client-Principal-Id": user, "Remote-Addr": f"10.0.0.{len(user)}:443"}
+        return await app_module.send_chat_request({"messages": [{"role": "user", "content": question}]}, headers)
+
+    test_app = app_module.create_app()
+    async with test_app.test_request_context("/conversation", method="POST"):
+        results = await asyncio.gather(
+            ask("user-1", "What is the vacation policy?"),
+            ask("user-1", "What is the vacation policy?"),
+            ask("user-22", "What is the vacation policy?"),
+            ask("user-333", "Who approves expenses?"),
+        )
+
+    assert results == [("answer", "apim-request-id")] * 4
+    users = [call["extra_body"]["user_security_context"]["end_user_id"] for call in upstream_calls]
+    if across_users:
+        # The shared call carries the context of the user whose request started it
+        assert users == ["user-1", "user-333"]
+    else:
+        # Every call carries the Defender context of each user it answers
+        assert users == ["user-1", "user-22", "user-333"]
+
+
+def completion_chunk(delta):
+    return SimpleNamespace(
+        id="chatcmpl-1",
+        model="gpt-4",
+        created=0,
+        object="chat.completion.chunk",
+        choices=[SimpleNamespace(delta=delta)],
+    )
+
+
+@pytest.mark.asyncio
+async def test_cached_answer_replayed_as_ndjson(app_module, monkeypatch):
+    model_calls = []
+
+    async def fake_send_chat_request(request_body, request_headers):
+        model_calls.append(request_body)
+
+        async def chunks():
+            yield completion_chunk(SimpleNamespace(role="assistant", context={"citations": [{"content": "Handbook"}]}))
+            for content in ["You get ", "20 days."]:
+                yield completion_chunk(SimpleNamespace(role="assistant", content=content, tool_calls=None))
+
+        return chunks(), "apim-1"
+
+    monkeypatch.setattr(app_module, "send_chat_request", fake_send_chat_request)
+    monkeypatch.setattr(app_module, "response_cache", ResponseCache(registry=MetricsRegistry()))
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "stream", True)
+
+    async def ask(messages):
+        response = await test_app.test_client().post("/conversation", json={"messages": messages})
+        return [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+
+    def messages_of(events):
+        return [message for event in events for message in event["choices"][0]["messages"]]
+
+    test_app = app_module.create_app()
+    question = [{"role": "user", "content": "How many vacation days?"}]
+    live = await ask(question)
+    cached = await ask([{"role": "user", "content": "how many  vacation days"}])
+
+    assert len(model_calls) == 1
+    assert messages_of(cached) == [
+        {"role": "tool", "content": json.dumps({"citations": [{"content": "Handbook"}]})},
+        {"role": "assistant", "content": "You get 20 days."},
+    ]
+    assert messages_of(cached)[0] == messages_of(live)[0]
+    assert cached[0]["id"] != live[0]["id"]
+    assert app_module.response_cache.hits.value == 1
+
+    # Follow-up questions depend on the conversation and always go to the model
+    await ask(question + [{"role": "assistant", "content": "You get 20 days."}] + question)
+    assert len(model_calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_cached_answer_lookup_embeds_only_on_exact_miss(app_module, monkeypatch):
+    embedded = []
+
+    async def fake_embed_question(question):
+        embedded.append(question)
+        return [1.0, 0.0]
+
+    monkeypatch.setattr(app_module, "embed_question", fake_embed_question)
+    monkeypatch.setattr(app_module, "response_cache", ResponseCache(similarity_threshold=0.9, registry=MetricsRegistry()))
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "embedding_name", "embedding")
+
+    test_app = app_module.create_app()
+    async with test_app.test_request_context("/conversation", method="POST"):
+        miss = await app_module.lookup_cached_answer({"messages": [{"role": "user", "content": "How many vacation days?"}]})
+        assert miss.answer is None
+        assert embedded == ["How many vacation days?"]
+
+        # The embedding of the miss is stored with the answer
+        app_module.store_cached_answer(miss, [{"role": "assistant", "content": "You get 20 days."}], "gpt-4")
+        similar = await app_module.lookup_cached_answer({"messages": [{"role": "user", "content": "Vacation allowance?"}]})
+        assert similar.answer.messages == [{"role": "assistant", "content": "You get 20 days."}]
+        assert len(embedded) == 2
+
+        exact = await app_module.lookup_cached_answer({"messages": [{"role": "user", "content": "how many vacation days"}]})
+        assert exact.answer.messages == [{"role": "assistant", "content": "You get 20 days."}]
+        assert len(embedded) == 2
+
+    assert app_module.response_cache.hits.value == 2
+    assert app_module.response_cache.semantic_hits.value == 1
+    assert app_module.response_cache.misses.value == 1
+
+
+@pytest.fixture(scope="function")
+def promptflow_app_module(app_module, monkeypatch):
+    settings_module = import_module("backend.settings")
+    monkeypatch.setattr(app_module.app_settings.base_settings, "use_promptflow", True)
+    monkeypatch.setattr(app_module.app_settings, "promptflow", settings_module._PromptflowSettings(
+        endpoint="https://promptflow.example/score",
+        api_key="pf-key",
+    ))
+
+    yield app_module
+
+
+@pytest.mark.asyncio
+async def test_promptflow_client_shared_across_requests(promptflow_app_module):
+    app_module = promptflow_app_module
+    test_app = app_module.create_app()
+
+    async with test_app.test_app():
+        client = test_app.promptflow_http_client
+        assert client is not None
+        assert client.headers["Authorization"] == "Bearer pf-key"
+
+        async with test_app.app_context():
+            assert app_module.get_promptflow_client() is client
+
+    assert test_app.promptflow_http_client is None
+    assert client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_promptflow_answer_streamed_as_ndjson(promptflow_app_module, monkeypatch):
+    app_module = promptflow_app_module
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "stream", True)
+    monkeypatch.setattr(app_module.app_settings.promptflow, "stream", True)
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, json={"reply": "You get 20 days.", "documents": [{"content": "Handbook"}]})
+
+    test_app = app_module.create_app()
+    test_app.promptflow_http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    question = {"id": "message-1", "role": "user", "content": "How many vacation days?"}
+    for _ in range(2):
+        response = await test_app.test_client().post("/conversation", json={"messages": [question]})
+        assert response.mimetype == "application/json-lines"
+        events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+
+    assert requests == [{"query": "How many vacation days?", "chat_history": []}] * 2
+    assert [event["choices"][0]["messages"] for event in events] == [
+        [{"role": "tool", "content": json.dumps({"citations": [{"content": "Handbook"}]})}],
+        [{"role": "assistant", "content": "You get 20 days."}],
+    ]
+    assert all(event["id"] == "message-1" for event in events)
+    await test_app.promptflow_http_client.aclose()
+
+
+class FakePromptflowServer:
+    '''Local promptflow endpoint streaming its answer as server-sent events'''
+    def __init__(self, tokens, documents):
+        self.tokens = tokens
+        self.documents = documents
+        self.requests = []
+        self.release = asyncio.Event()
+        self.runner = None
+        self.url = None
+
+    async def score(self, request):
+        self.requests.append((request.headers.get("Authorization"), await request.json()))
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(f"data: {json.dumps({'documents': self.documents, 'reply': ''})}\n\n".encode())
+        for i, token in enumerate(self.tokens):
+            if i == 1:
+                # Hold the rest of the answer until the client has seen the first token
+                await self.release.wait()
+            await response.write(f"data: {json.dumps({'reply': token})}\n\n".encode())
+        await response.write_eof()
+        return response
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/score", self.score)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/score"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release.set()
+        await self.runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_promptflow_stream_translated_to_ndjson(promptflow_app_module, monkeypatch):
+    app_module = promptflow_app_module
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "stream", True)
+    monkeypatch.setattr(app_module.app_settings.promptflow, "stream", True)
+    request_body = {
+        "messages": [{"id": "message-1", "role": "user", "content": "How many vacation days?"}],
+        "history_metadata": {"conversation_id": "conversation-1"},
+    }
+
+    async with FakePromptflowServer(["You get ", "20 days."], [{"content": "Handbook"}]) as server:
+        monkeypatch.setattr(app_module.app_settings.promptflow, "endpoint", server.url)
+        test_app = app_module.create_app()
+
+        async with test_app.test_app():
+            async with test_app.app_context():
+                stream = await app_module.stream_promptflow_request(request_body)
+
+            # Events are produced as the endpoint streams, not once it is done
+            citations = await asyncio.wait_for(stream.__anext__(), 5)
+            first_token = await asyncio.wait_for(stream.__anext__(), 5)
+            server.release.set()
+            rest = [event async for event in stream]
+
+            response = await test_app.test_client().post("/conversation", json=request_body)
+            lines = (await response.get_data(as_text=True)).splitlines()
+
+    events = [citations, first_token] + rest
+    assert [json.loads(line) for line in lines] == events
+    assert [event["choices"][0]["messages"] for event in events] == [
+        [{"role": "tool", "content": json.dumps({"citations": [{"content": "Handbook"}]})}],
+        [{"role": "assistant", "content": "You get "}],
+        [{"role": "assistant", "content": "20 days."}],
+    ]
+    assert all(event["id"] == "message-1" for event in events)
+    assert all(event["history_metadata"] == {"conversation_id": "conversation-1"} for event in events)
+    assert server.requests[0] == ("Bearer pf-key", {"query": "How many vacation days?", "chat_history": []})
+
+
+@pytest.mark.asyncio
+async def test_promptflow_stream_error_status(promptflow_app_module, monkeypatch):
+    app_module = promptflow_app_module
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "stream", True)
+    monkeypatch.setattr(app_module.app_settings.promptflow, "stream", True)
+
+    test_app = app_module.create_app()
+    test_app.promptflow_http_client = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(424, json={"error": "flow failed"}))
+    )
+
+    response = await test_app.test_client().post(
+        "/conversation", json={"messages": [{"role": "user", "content": "Hello"}]}
+    )
+
+    assert response.status_code == 500
+    assert "424" in (await response.get_json())["error"]
+    await test_app.promptflow_http_client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_title_generated_on_another_deployment_when_throttled(app_module):
+    requests = []
+
+    def deployment(name, status_code):
+        def handler(request):
+            requests.append((name, request.url.path))
+            if status_code == 429:
+                return httpx.Response(429, headers={"retry-after": "30"}, json={"error": {"message": "throttled"}})
+            return httpx.Response(200, json={
+                "id": "chatcmpl-1",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-4",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": f"Title from {name}"}}],
+            })
+
+        client = AsyncAzureOpenAI(
+            api_key="key",
+            api_version="2024-05-01-preview",
+            azure_endpoint=f"https://{name}.example",
+            max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        )
+        return Deployment(name, client, f"{name}-model", weight=2 if status_code == 429 else 1)
+
+    test_app = app_module.create_app()
+    test_app.azure_openai_client = object()
+    test_app.azure_openai_load_balancer = LoadBalancer(
+        [deployment("eastus", 429), deployment("westus", 200)],
+        registry=MetricsRegistry(),
+    )
+
+    async with test_app.app_context():
+        title = await app_module.generate_title([{"role": "user", "content": "How many vacation days?"}])
+
+    assert title == "Title from westus"
+    assert requests == [
+        ("eastus", "/openai/deployments/eastus-model/chat/completions"),
+        ("westus", "/openai/deployments/westus-model/chat/completions"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_conversation_shed_with_retry_hint_when_over_quota(app_module):
+    admission = AdmissionController(tokens_per_minute=6000, max_wait=1, registry=MetricsRegistry())
+    await admission.admit(6000)
+
+    test_app = app_module.create_app()
+    test_app.azure_openai_client = object()
+    test_app.azure_openai_load_balancer = LoadBalancer(
+        [Deployment("primary", None, "gpt-4", admission=admission)],
+        registry=MetricsRegistry(),
+    )
+
+    response = await test_app.test_client().post(
+        "/conversation", json={"messages": [{"role": "user", "content": "How many vacation days?"}]}
+    )
+
+    assert response.status_code == 429
+    # The prompt and max_tokens need more than 10 seconds of quota
+    assert int(response.headers["Retry-After"]) > 10
+    assert admission.shed.value == 1
+
+
+@pytest.mark.asyncio
+async def test_conversation_limited_per_user_until_stream_sent(app_module, monkeypatch):
+    scheduler = FairScheduler(max_concurrency=4, per_user_concurrency=1, registry=MetricsRegistry())
+    monkeypatch.setattr(app_module, "fair_scheduler", scheduler)
+    answer_ready = asyncio.Event()
+
+    async def conversation_internal(request_body, request_headers):
+        async def stream():
+            await answer_ready.wait()
+            yield b'{"answer": "42"}\n'
+
+        return stream()
+
+    monkeypatch.setattr(app_module, "conversation_internal", conversation_internal)
+    client = app_module.create_app().test_client()
+    body = {"messages": [{"role": "user", "content": "How many vacation days?"}]}
+
+    first = asyncio.create_task(client.post("/conversation", json=body))
+    await asyncio.sleep(0.05)
+    assert scheduler.running == 1
+
+    throttled = await client.post("/conversation", json=body)
+    assert throttled.status_code == 429
+    assert int(throttled.headers["Retry-After"]) >= 1
+
+    other_user = asyncio.create_task(
+        client.post("/conversation", json=body, headers={"X-Ms-Client-Principal-Id": "another-user"})
+    )
+    await asyncio.sleep(0.05)
+    assert scheduler.running == 2
+
+    answer_ready.set()
+    for response in await asyncio.gather(first, other_user):
+        assert response.status_code == 200
+        assert await response.get_data() == b'{"answer": "42"}\n'
+    assert scheduler.running == 0
+    assert scheduler.outstanding == {}
+
+
+class SlowCompletionStream(httpx.AsyncByteStream):
+    '''Streamed chat completion of ``chunks`` deltas, one every ``interval`` seconds'''
+    def __init__(self, chunks=100, interval=0.01):
+        self.chunks = chunks
+        self.interval = interval
+        self.sent = 0
+        self.closed = False
+
+    async def __aiter__(self):
+        for i in range(self.chunks):
+            await asyncio.sleep(self.interval)
+            self.sent += 1
+            chunk = {
+                "id": "chatcmpl-1",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "gpt-4",
+                "choices": [{"index": 0, "delta": {"role": "assistant", "content": f"word{i} "}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+        yield b"data: [DONE]\n\n"
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("coalesce_window_ms", [0, 50])
+async def test_upstream_stream_closed_when_client_disconnects(app_module, monkeypatch, coalesce_window_ms):
+    upstream = SlowCompletionStream()
+    client = AsyncAzureOpenAI(
+        api_key="key",
+        api_version="2024-05-01-preview",
+        azure_endpoint="https://eastus.example",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, headers={"Content-Type": "text/event-stream"}, stream=upstream)
+        )),
+    )
+    load_balancer = LoadBalancer([Deployment("primary", client, "gpt-4")], registry=MetricsRegistry())
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "stream", True)
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "stream_coalesce_window_ms", coalesce_window_ms)
+
+    test_app = app_module.create_app()
+    test_app.azure_openai_client = object()
+    test_app.azure_openai_load_balancer = load_balancer
+    body = {"messages": [{"role": "user", "content": "How many vacation days?"}]}
+
+    async with test_app.test_client().request(
+        "/conversation", method="POST", headers={"Content-Type": "application/json"}
+    ) as connection:
+        await connection.send(json.dumps(body).encode("utf-8"))
+        await connection.send_complete()
+        lines = [await connection.receive() for _ in range(3)]
+        await connection.disconnect()
+
+    assert all(json.loads(line)["choices"][0]["messages"][0]["role"] == "assistant" for line in lines)
+    assert upstream.closed
+    assert upstream.sent < 20
+    assert load_balancer.deployments[0].in_flight == 0
+    assert load_balancer.abandoned_streams.value == 1
+    assert load_balancer.tokens_saved.value > 0
+
+
+def completion_stream(deltas):
+    '''Server-sent events of a streamed chat completion, one chunk per delta'''
+    events = [
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-4",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        }
+        for delta in deltas
+    ]
+    body = "".join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n"
+    return httpx.Response(200, headers={"Content-Type": "text/event-stream"}, content=body.encode("utf-8"))
+
+
+def function_calling_deployment(completion_requests):
+    # Asks for a tool call first, then answers once the tool result is in the conversation
+    def handler(request):
+        messages = json.loads(request.content)["messages"]
+        completion_requests.append(messages)
+        if messages[-1]["role"] != "function":
+            return completion_stream([
+                {"role": "assistant", "tool_calls": [{"index": 0, "id": "call-1", "type": "function", "function": {"name": "get_weather", "arguments": ""}}]},
+                {"tool_calls": [{"index": 0, "function": {"arguments": '{"city": "Oslo"}'}}]},
+                {},
+            ])
+        return completion_stream([
+            {"role": "assistant", "content": "Sunny "},
+            {"content": "in Oslo."},
+        ])
+
+    client = AsyncAzureOpenAI(
+        api_key="key",
+        api_version="2024-05-01-preview",
+        azure_endpoint="https://eastus.example",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+    return LoadBalancer([Deployment("primary", client, "gpt-4")], registry=MetricsRegistry())
+
+
+@pytest.mark.asyncio
+async def test_streamed_answer_completed_after_function_call(app_module, monkeypatch):
+    class FakeToolRegistry:
+        tools = [{"type": "function", "function": {"name": "get_weather"}}]
+        available_tools = frozenset({"get_weather"})
+
+    tool_requests = []
+
+    def tool_function(request):
+        tool_requests.append(json.loads(request.content))
+        return httpx.Response(200, text="sunny")
+
+    completion_requests = []
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "stream", True)
+    monkeypatch.setattr(app_module.app_settings.azure_openai, "function_call_azure_functions_enabled", True)
+
+    test_app = app_module.create_app()
+    test_app.azure_openai_client = object()
+    test_app.azure_openai_load_balancer = function_calling_deployment(completion_requests)
+    test_app.azure_openai_tool_registry = FakeToolRegistry()
+    test_app.azure_openai_tool_executor = ToolExecutor(
+        "https://functions.example/api/tool?code=key",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(tool_function)),
+        registry=MetricsRegistry(),
+    )
+
+    response = await test_app.test_client().post(
+        "/conversation", json={"messages": [{"role": "user", "content": "Weather in Oslo?"}]}
+    )
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+
+    # The second completion is requested while the answer is being streamed
+    assert all("error" not in event for event in events)
+    assert "".join(event["choices"][0]["messages"][0]["content"] for event in events) == "Sunny in Oslo."
+    assert tool_requests == [{"tool_name": "get_weather", "tool_arguments": {"city": "Oslo"}}]
+    assert len(completion_requests) == 2
+    assert completion_requests[1][-1] == {"role": "function", "name": "get_weather", "content": "sunny"}
@@ -0,0 +1,437 @@
+import asyncio
+import copy
+import json
+import re
+
+import pytest
+from azure.cosmos import exceptions
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.metrics import MetricsRegistry
+
+
+class FakeContainer:
+    '''
+    In-memory container partitioned on /userId. Every call is recorded and
+    charged ``request_charge`` request units through its response hook.
+    '''
+    def __init__(self, request_charge=1.0, latency=0):
+        self.items = {}
+        self.calls = []
+        self.queries = []
+        self.request_charge = request_charge
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.pages_read = 0
+        self.cross_partition_queries = 0
+
+    def _respond(self, operation, result, response_hook):
+        self.calls.append(operation)
+        if response_hook:
+            response_hook({"x-ms-request-charge": str(self.request_charge)}, result)
+        return result
+
+    def _read(self, item, partition_key):
+        try:
+            return self.items[(partition_key, item)]
+        except KeyError:
+            raise exceptions.CosmosResourceNotFoundError(message="Entity with the specified id does not exist", status_code=404)
+
+    async def upsert_item(self, body, response_hook=None):
+        self.items[(body["userId"], body["id"])] = copy.deepcopy(body)
+        return self._respond("upsert_item", copy.deepcopy(body), response_hook)
+
+    async def read_item(self, item, partition_key, response_hook=None):
+        return self._respond("read_item", copy.deepcopy(self._read(item, partition_key)), response_hook)
+
+    def _patch(self, item, partition_key, patch_operations, filter_predicate=None):
+        document = self._read(item, partition_key)
+        if filter_predicate:
+            field, value = re.fullmatch(r"from c where c\.(\w+) = '(.*)'", filter_predicate).groups()
+            if document.get(field) != value:
+                raise exceptions.CosmosAccessConditionFailedError(message="Precondition not met", status_code=412)
+        for operation in patch_operations:
+            assert operation["op"] == "set"
+            document[operation["path"].lstrip("/")] = operation["value"]
+        return document
+
+    async def patch_item(self, item, partition_key, patch_operations, filter_predicate=None, response_hook=None):
+        document = self._patch(item, partition_key, patch_operations, filter_predicate)
+        return self._respond("patch_item", copy.deepcopy(document), response_hook)
+
+    def _query(self, query, parameters, partition_key):
+        # Just enough SQL for the client's queries: equality filters joined by AND, ORDER BY, projections
+        match = re.fullmatch(
+            r"SELECT (VALUE )?(.+?) FROM c(?: WHERE (.+?))?(?: ORDER BY c\.(\w+) (ASC|DESC))?(?: OFFSET (\d+|@\w+) LIMIT (\d+|@\w+))?",
+            query.strip(),
+            re.IGNORECASE,
+        )
+        value, projection, where, order_by, direction, offset, limit = match.groups()
+        values = {parameter["name"]: parameter["value"] for parameter in parameters or []}
+        conditions = [
+            re.fullmatch(r"c\.(\w+)\s*=\s*(@\w+|'[^']*')", condition.strip()).groups()
+            for condition in re.split(r"\s+AND\s+", where, flags=re.IGNORECASE)
+        ] if where else []
+
+        documents = [
+            document for (user_id, _), document in self.items.items()
+            if partition_key is None or user_id == partition_key
+        ]
+        for field, operand in conditions:
+            expected = values[operand] if operand.startswith("@") else operand.strip("'")
+            documents = [document for document in documents if document.get(field) == expected]
+        if order_by:
+            documents.sort(key=lambda document: document.get(order_by, ""), reverse=direction.upper() == "DESC")
+        if limit is not None:
+            offset, limit = (values[operand] if operand.startswith("@") else int(operand) for operand in (offset, limit))
+            documents = documents[offset:offset + limit]
+
+        if projection == "*":
+            return [copy.deepcopy(document) for document in documents]
+        fields = [field.strip()[len("c."):] for field in projection.split(",")]
+        if value:
+            return [document.get(fields[0]) for document in documents]
+        return [{field: document[field] for field in fields if field in document} for document in documents]
+
+    def query_items(self, query, parameters=None, partition_key=None, max_item_count=None, response_hook=None, **kwargs):
+        self.calls.append("query_items")
+        self.queries.append(query)
+        if partition_key is None:
+            self.cross_partition_queries += 1
+        return FakeQueryIterable(self, self._query(query, parameters, partition_key), max_item_count, response_hook)
+
+    async def execute_item_batch(self, batch_operations, partition_key, response_hook=None):
+        assert len(batch_operations) <= 100
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        snapshot = copy.deepcopy(self.items)
+        results = []
+        for index, operation in enumerate(batch_operations):
+            operation_type, args = operation[0], operation[1]
+            kwargs = operation[2] if len(operation) > 2 else {}
+            try:
+                if operation_type == "upsert":
+                    assert args[0]["userId"] == partition_key
+                    self.items[(partition_key, args[0]["id"])] = copy.deepcopy(args[0])
+                    results.append({"statusCode": 200, "resourceBody": copy.deepcopy(args[0])})
+                elif operation_type == "patch":
+                    document = self._patch(args[0], partition_key, args[1], kwargs.get("filter_predicate"))
+                    results.append({"statusCode": 200, "resourceBody": copy.deepcopy(document)})
+                elif operation_type == "delete":
+                    self._read(args[0], partition_key)
+                    del self.items[(partition_key, args[0])]
+                    results.append({"statusCode": 204})
+            except exceptions.CosmosHttpResponseError as e:
+                # Nothing in a failed batch is applied
+                self.items = snapshot
+                self.calls.append("execute_item_batch")
+                raise exceptions.CosmosBatchOperationError(
+                    error_index=index,
+                    headers={},
+                    status_code=e.status_code,
+                    message="There was an error in the transactional batch",
+                    operation_responses=results + [{"statusCode": e.status_code}],
+                )
+        return self._respond("execute_item_batch", results, response_hook)
+
+    async def delete_item(self, item, partition_key, response_hook=None):
+        self._read(item, partition_key)
+        del self.items[(partition_key, item)]
+        return self._respond("delete_item", None, response_hook)
+
+
+class FakeQueryIterable:
+    '''Query results, iterable item by item or by page with continuation tokens'''
+    def __init__(self, container, results, max_item_count, response_hook):
+        self.container = container
+        self.results = results
+        self.page_size = max_item_count or 100
+        self.response_hook = response_hook
+        self.continuation_token = None
+
+    def _charge(self, page):
+        self.container.pages_read += 1
+        if self.response_hook:
+            self.response_hook({"x-ms-request-charge": str(self.container.request_charge)}, {"Documents": page})
+
+    async def __aiter__(self):
+        for start in range(0, max(len(self.results), 1), self.page_size):
+            page = self.results[start:start + self.page_size]
+            self._charge(page)
+            for result in page:
+                yield result
+
+    def by_page(self, continuation_token=None):
+        start = json.loads(continuation_token)["start"] if continuation_token else 0
+        if not isinstance(start, int):
+            raise exceptions.CosmosHttpResponseError(status_code=400, message="Invalid continuation token")
+
+        async def pages():
+            nonlocal start
+            while True:
+                page = self.results[start:start + self.page_size]
+                start += self.page_size
+                self._charge(page)
+                self.continuation_token = json.dumps({"start": start}) if start < len(self.results) else None
+
+                async def items(page=page):
+                    for result in page:
+                        yield result
+
+                yield items()
+                if self.continuation_token is None:
+                    return
+
+        page_iterator = pages()
+        # The page iterator carries the token of the next page, like the SDK's
+        iterable = self
+
+        class PageIterator:
+            def __aiter__(self):
+                return page_iterator
+
+            @property
+            def continuation_token(self):
+                return iterable.continuation_token
+
+        return PageIterator()
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+
+@pytest.fixture
+def container():
+    return FakeContainer(request_charge=5.0)
+
+
+@pytest.fixture
+def cosmos_client(container, registry):
+    client = CosmosConversationClient(
+        "https://cosmos.example:443/", "a2V5", "db_conversation_history", "conversations", registry=registry
+    )
+    client.container_client = container
+    return client
+
+
+@pytest.mark.asyncio
+async def test_create_message_bumps_conversation_without_query(cosmos_client, container, registry):
+    conversation = await cosmos_client.create_conversation("user-1", title="Vacation")
+    container.calls.clear()
+
+    message = await cosmos_client.create_message(
+        "message-1", conversation["id"], "user-1", {"role": "user", "content": "How many vacation days?"}
+    )
+
+    assert message["content"] == "How many vacation days?"
+    # One patch of the conversation and one write of the message
+    assert container.calls == ["patch_item", "upsert_item"]
+    stored = container.items[("user-1", conversation["id"])]
+    assert stored["updatedAt"] == message["createdAt"]
+    assert stored["title"] == "Vacation"
+
+    request_charge = registry.histogram("cosmos.touch_conversation.request_charge")
+    assert request_charge.count == 1
+    assert request_charge.sum == 5.0
+    assert registry.histogram("cosmos.create_message.latency_ms").count == 1
+
+
+@pytest.mark.asyncio
+async def test_create_message_requires_conversation_of_user(cosmos_client, container):
+    conversation = await cosmos_client.create_conversation("user-1")
+
+    for user_id, conversation_id in [("user-1", "missing"), ("user-2", conversation["id"])]:
+        result = await cosmos_client.create_message(
+            "message-1", conversation_id, user_id, {"role": "user", "content": "Hi"}
+        )
+        assert result == "Conversation not found"
+
+    # Nor may a message stand in for a conversation
+    await cosmos_client.create_message("message-1", conversation["id"], "user-1", {"role": "user", "content": "Hi"})
+    result = await cosmos_client.create_message("message-2", "message-1", "user-1", {"role": "user", "content": "Hi"})
+    assert result == "Conversation not found"
+    assert [key for key in container.items if key[1].startswith("message")] == [("user-1", "message-1")]
+
+
+@pytest.mark.asyncio
+async def test_add_messages_batch_writes_messages_in_one_round_trip(cosmos_client, container, registry):
+    conversation = await cosmos_client.create_conversation("user-1")
+    container.calls.clear()
+
+    messages = await cosmos_client.add_messages_batch(conversation["id"], "user-1", [
+        ("tool-1", {"role": "tool", "content": '{"citations": []}'}),
+        ("assistant-1", {"role": "assistant", "content": "You get 20 days."}),
+    ])
+
+    assert container.calls == ["execute_item_batch"]
+    assert [message["id"] for message in messages] == ["tool-1", "assistant-1"]
+    assert messages[0]["createdAt"] < messages[1]["createdAt"]
+    assert container.items[("user-1", conversation["id"])]["updatedAt"] == messages[1]["createdAt"]
+    assert registry.histogram("cosmos.add_messages_batch.request_charge").sum == 5.0
+
+
+@pytest.mark.asyncio
+async def test_add_messages_batch_writes_nothing_without_conversation(cosmos_client, container):
+    conversation = await cosmos_client.create_conversation("user-1")
+    stored = dict(container.items)
+
+    for user_id, conversation_id in [("user-1", "missing"), ("user-2", conversation["id"])]:
+        result = await cosmos_client.add_messages_batch(conversation_id, user_id, [
+            ("assistant-1", {"role": "assistant", "content": "You get 20 days."}),
+        ])
+        assert result == "Conversation not found"
+
+    assert container.items == stored
+
+    with pytest.raises(ValueError):
+        await cosmos_client.add_messages_batch(conversation["id"], "user-1", [
+            (f"message-{i}", {"role": "assistant", "content": ""}) for i in range(100)
+        ])
+
+
+async def create_history(cosmos_client, user_id, conversations=1, messages=2):
+    conversation_ids = []
+    for _ in range(conversations):
+        conversation = await cosmos_client.create_conversation(user_id)
+        await cosmos_client.add_messages_batch(conversation["id"], user_id, [
+            (f"{conversation['id']}-{i}", {"role": "user", "content": f"question {i}"}) for i in range(messages)
+        ])
+        conversation_ids.append(conversation["id"])
+    return conversation_ids
+
+
+@pytest.mark.asyncio
+async def test_get_messages_projected_in_creation_order(cosmos_client, container, registry):
+    [conversation_id] = await create_history(cosmos_client, "user-1", messages=5)
+    await create_history(cosmos_client, "user-2", messages=5)
+
+    messages = await cosmos_client.get_messages("user-1", conversation_id)
+
+    assert [message["content"] for message in messages] == [f"question {i}" for i in range(5)]
+    assert set(messages[0]) == {"id", "role", "content", "createdAt"}
+    query = container.queries[-1]
+    assert "SELECT *" not in query and "c.timestamp" not in query
+    assert query.endswith("ORDER BY c.createdAt ASC")
+    assert container.cross_partition_queries == 0
+    assert registry.histogram("cosmos.get_messages.request_charge").sum == 5.0
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_is_a_point_read(cosmos_client, container):
+    [conversation_id] = await create_history(cosmos_client, "user-1", messages=1)
+    container.calls.clear()
+
+    conversation = await cosmos_client.get_conversation("user-1", conversation_id)
+    assert conversation["id"] == conversation_id
+    assert container.calls == ["read_item"]
+
+    # Not found in another user's partition, nor for an id that is not a conversation
+    assert await cosmos_client.get_conversation("user-2", conversation_id) is None
+    assert await cosmos_client.get_conversation("user-1", f"{conversation_id}-0") is None
+    assert "query_items" not in container.calls
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_in_concurrent_batches(cosmos_client, container, registry):
+    cosmos_client.delete_concurrency = 2
+    container.latency = 0.01
+    [conversation_id] = await create_history(cosmos_client, "user-1", messages=99)
+    await cosmos_client.add_messages_batch(conversation_id, "user-1", [
+        (f"more-{i}", {"role": "user", "content": "again"}) for i in range(99)
+    ])
+    container.calls.clear()
+
+    assert await cosmos_client.delete_messages(conversation_id, "user-1") == 198
+
+    # One query for the ids, then two batches of deletions
+    assert container.calls == ["query_items", "execute_item_batch", "execute_item_batch"]
+    assert container.queries[-1].startswith("SELECT VALUE c.id FROM c")
+    assert container.max_in_flight == 2
+    assert list(container.items) == [("user-1", conversation_id)]
+    assert registry.histogram("cosmos.delete_batch.latency_ms").count == 2
+
+
+@pytest.mark.asyncio
+async def test_delete_batch_skips_items_already_deleted(cosmos_client, container):
+    [conversation_id] = await create_history(cosmos_client, "user-1", messages=3)
+
+    assert await cosmos_client.delete_items("user-1", [f"{conversation_id}-0", "gone", f"{conversation_id}-2"]) == 2
+    assert list(container.items) == [("user-1", conversation_id), ("user-1", f"{conversation_id}-1")]
+
+
+@pytest.mark.asyncio
+async def test_delete_all_conversations_of_user(cosmos_client, container):
+    cosmos_client.delete_concurrency = 3
+    await create_history(cosmos_client, "user-1", conversations=30, messages=4)
+    [other_conversation_id] = await create_history(cosmos_client, "user-2")
+    job = await cosmos_client.create_deletion_job("user-1")
+
+    assert await cosmos_client.delete_all_conversations("user-1") == 30
+
+    assert sorted(container.items) == sorted([
+        ("user-1", job["id"]),
+        ("user-2", other_conversation_id),
+        ("user-2", f"{other_conversation_id}-0"),
+        ("user-2", f"{other_conversation_id}-1"),
+    ])
+    assert await cosmos_client.delete_all_conversations("user-1") == 0
+
+
+@pytest.mark.asyncio
+async def test_deletion_job_status(cosmos_client):
+    job = await cosmos_client.create_deletion_job("user-1")
+    assert job["status"] == "running"
+
+    await cosmos_client.update_deletion_job("user-1", job["id"], "succeeded", deleted=12)
+    job = await cosmos_client.get_deletion_job("user-1", job["id"])
+    assert (job["status"], job["deleted"]) == ("succeeded", 12)
+
+    # Jobs are only visible to their user
+    assert await cosmos_client.get_deletion_job("user-2", job["id"]) is None
+
+
+@pytest.mark.asyncio
+async def test_conversations_paged_with_continuation_tokens(cosmos_client, container):
+    conversation_ids = await create_history(cosmos_client, "user-1", conversations=60, messages=1)
+    await create_history(cosmos_client, "user-2", conversations=5)
+    container.pages_read = 0
+
+    pages = []
+    continuation_token = None
+    while True:
+        conversations, continuation_token = await cosmos_client.get_conversations_page(
+            "user-1", limit=25, continuation_token=continuation_token
+        )
+        pages.append(conversations)
+        if continuation_token is None:
+            break
+
+    assert [len(page) for page in pages] == [25, 25, 10]
+    # Most recently updated first, and only what the list shows
+    assert [conversation["id"] for page in pages for conversation in page] == conversation_ids[::-1]
+    assert set(pages[0][0]) == {"id", "title", "createdAt", "updatedAt"}
+    # Each page is read on its own, without skipping over the earlier ones
+    assert container.pages_read == 3
+    assert all("OFFSET" not in query for query in container.queries[-3:])
+
+
+@pytest.mark.asyncio
+async def test_conversations_offset_is_an_integer(cosmos_client, container):
+    await create_history(cosmos_client, "user-1", conversations=3, messages=1)
+
+    conversations = await cosmos_client.get_conversations("user-1", limit=2, offset="1")
+    assert len(conversations) == 2
+    # Passed as parameters, never part of the query text
+    assert container.queries[-1].endswith("OFFSET @offset LIMIT @limit")
+
+    with pytest.raises(ValueError):
+        await cosmos_client.get_conversations("user-1", limit=2, offset="0 LIMIT 1000")
+    with pytest.raises(ValueError):
+        await cosmos_client.get_conversations("user-1", limit=2, sort_order="DESC; DROP")
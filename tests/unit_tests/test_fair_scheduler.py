@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from backend.admission import RateLimitExceeded
+from backend.fair_scheduler import FairScheduler
+from backend.metrics import MetricsRegistry
+
+
+def scheduler(**kwargs):
+    return FairScheduler(registry=MetricsRegistry(), **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_rejects_user_over_their_concurrency():
+    fair_scheduler = scheduler(per_user_concurrency=2)
+    slots = [await fair_scheduler.acquire("alice") for _ in range(2)]
+
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await fair_scheduler.acquire("alice")
+    assert exc_info.value.retry_after >= 1
+    assert fair_scheduler.rejected.value == 1
+
+    # Other users are unaffected
+    await fair_scheduler.acquire("bob")
+
+    slots[0].release()
+    slots[0].release()
+    await fair_scheduler.acquire("alice")
+    assert fair_scheduler.outstanding == {"alice": 2, "bob": 1}
+
+
+@pytest.mark.asyncio
+async def test_queued_requests_served_fairly_by_weight():
+    fair_scheduler = scheduler(max_concurrency=1, per_user_concurrency=10, user_weights={"carol": 2})
+    running = await fair_scheduler.acquire("someone")
+    served = []
+
+    async def request(user_id):
+        slot = await fair_scheduler.acquire(user_id)
+        served.append(user_id)
+        slot.release()
+
+    # Alice queues first, but cannot hold the others back
+    tasks = [asyncio.create_task(request("alice")) for _ in range(4)]
+    await asyncio.sleep(0)
+    tasks += [asyncio.create_task(request("bob")) for _ in range(2)]
+    tasks += [asyncio.create_task(request("carol")) for _ in range(4)]
+    await asyncio.sleep(0)
+    assert fair_scheduler.queue_depth.value == 10
+
+    running.release()
+    await asyncio.gather(*tasks)
+
+    # Carol's weight gets her twice the share; Alice's backlog is served last
+    assert served == ["carol", "alice", "bob", "carol", "carol", "alice", "bob", "carol", "alice", "alice"]
+    assert fair_scheduler.queue_wait_ms.count == 11
+    assert fair_scheduler.running == 0
+    assert fair_scheduler.outstanding == {}
+
+
+@pytest.mark.asyncio
+async def test_rejects_when_queue_is_full():
+    fair_scheduler = scheduler(max_concurrency=1, max_queue_depth=1)
+    running = await fair_scheduler.acquire("alice")
+    waiting = asyncio.create_task(fair_scheduler.acquire("bob"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(RateLimitExceeded):
+        await fair_scheduler.acquire("carol")
+
+    running.release()
+    (await waiting).release()
+    assert fair_scheduler.in_flight.value == 0
+
+
+@pytest.mark.asyncio
+async def test_rejects_requests_that_wait_too_long():
+    fair_scheduler = scheduler(max_concurrency=1, max_wait=0.05)
+    running = await fair_scheduler.acquire("alice")
+
+    with pytest.raises(RateLimitExceeded):
+        await fair_scheduler.acquire("bob")
+    assert fair_scheduler.queue_depth.value == 0
+    assert "bob" not in fair_scheduler.outstanding
+
+    # The abandoned entry is skipped when the slot frees up
+    waiting = asyncio.create_task(fair_scheduler.acquire("carol"))
+    await asyncio.sleep(0)
+    running.release()
+    assert (await waiting).user_id == "carol"
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_gives_up_its_place():
+    fair_scheduler = scheduler(max_concurrency=1)
+    running = await fair_scheduler.acquire("alice")
+    waiting = asyncio.create_task(fair_scheduler.acquire("bob"))
+    await asyncio.sleep(0)
+
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    running.release()
+
+    assert fair_scheduler.outstanding == {}
+    assert fair_scheduler.queue_depth.value == 0
+    assert fair_scheduler.in_flight.value == 0
@@ -0,0 +1,160 @@
+import asyncio
+import base64
+import json
+import time
+import httpx
+import pytest
+
+from backend.auth.graph_groups import GraphGroupResolver
+from backend.metrics import MetricsRegistry
+from backend.utils import generateFilterString
+
+
+GRAPH_URL = "https://graph.example.com/v1.0/me/transitiveMemberOf?$select=id"
+
+
+def user_token(subject, exp=None, nonce="1"):
+    claims = {"oid": subject, "nonce": nonce}
+    if exp is not None:
+        claims["exp"] = exp
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+class StubGraphServer:
+    '''Serves each user's groups as pages linked by @odata.nextLink'''
+    def __init__(self, groups_by_token, page_size=2, delay=0):
+        self.groups_by_token = groups_by_token
+        self.page_size = page_size
+        self.delay = delay
+        self.status_code = 200
+        self.requests = []
+
+    async def handler(self, request: httpx.Request):
+        self.requests.append(request)
+        await asyncio.sleep(self.delay)
+        if self.status_code != 200:
+            return httpx.Response(self.status_code, text="throttled")
+
+        token = request.headers["Authorization"].removeprefix("bearer ")
+        groups = self.groups_by_token[token]
+        page = int(request.url.params.get("page", 0))
+        body = {"value": [{"id": g} for g in groups[page * self.page_size:(page + 1) * self.page_size]]}
+        if (page + 1) * self.page_size < len(groups):
+            body["@odata.nextLink"] = f"{GRAPH_URL}&page={page + 1}"
+        return httpx.Response(200, json=body)
+
+    def client(self):
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+
+
+@pytest.mark.asyncio
+async def test_groups_paginated_iteratively():
+    token = user_token("alice")
+    groups = [f"group-{i}" for i in range(7)]
+    server = StubGraphServer({token: groups})
+    resolver = GraphGroupResolver(GRAPH_URL, http_client=server.client(), registry=MetricsRegistry())
+
+    result = await resolver.get_groups(token)
+
+    assert [g["id"] for g in result] == groups
+    assert len(server.requests) == 4
+    assert server.requests[0].headers["Authorization"] == f"bearer {token}"
+
+
+@pytest.mark.asyncio
+async def test_groups_cached_on_repeat_turns():
+    token = user_token("alice")
+    server = StubGraphServer({token: ["a", "b", "c"]})
+    resolver = GraphGroupResolver(GRAPH_URL, http_client=server.client(), registry=MetricsRegistry())
+
+    first = await resolver.get_groups(token)
+    second = await resolver.get_groups(token)
+
+    assert first == second
+    assert len(server.requests) == 2
+    assert resolver.hits.value == 1
+    assert resolver.misses.value == 1
+
+
+@pytest.mark.asyncio
+async def test_cache_requires_same_token():
+    alice = user_token("alice")
+    forged = user_token("alice", nonce="forged")
+    server = StubGraphServer({alice: ["a"], forged: ["b"]})
+    resolver = GraphGroupResolver(GRAPH_URL, http_client=server.client(), registry=MetricsRegistry())
+
+    await resolver.get_groups(alice)
+    result = await resolver.get_groups(forged)
+
+    # A token claiming the same subject still goes to Graph, and replaces the entry
+    assert [g["id"] for g in result] == ["b"]
+    assert len(resolver._cache) == 1
+    assert resolver.misses.value == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_expires_after_ttl_and_token_expiry():
+    token = user_token("alice")
+    short_lived = user_token("bob", exp=time.time() + 0.05)
+    server = StubGraphServer({token: ["a"], short_lived: ["b"]})
+    resolver = GraphGroupResolver(GRAPH_URL, ttl=0.05, http_client=server.client(), registry=MetricsRegistry())
+
+    await resolver.get_groups(token)
+    resolver.ttl = 300
+    await resolver.get_groups(short_lived)
+    await asyncio.sleep(0.1)
+    await resolver.get_groups(token)
+    await resolver.get_groups(short_lived)
+
+    assert resolver.misses.value == 4
+
+
+@pytest.mark.asyncio
+async def test_cache_bounded_lru():
+    tokens = [user_token(f"user-{i}") for i in range(3)]
+    server = StubGraphServer({token: ["a"] for token in tokens})
+    resolver = GraphGroupResolver(GRAPH_URL, max_entries=2, http_client=server.client(), registry=MetricsRegistry())
+
+    await resolver.get_groups(tokens[0])
+    await resolver.get_groups(tokens[1])
+    await resolver.get_groups(tokens[0])
+    await resolver.get_groups(tokens[2])
+
+    assert len(resolver._cache) == 2
+    await resolver.get_groups(tokens[0])
+    assert resolver.hits.value == 2
+    await resolver.get_groups(tokens[1])
+    assert resolver.misses.value == 4
+
+
+@pytest.mark.asyncio
+async def test_failures_not_cached():
+    token = user_token("alice")
+    server = StubGraphServer({token: ["a"]})
+    resolver = GraphGroupResolver(GRAPH_URL, http_client=server.client(), registry=MetricsRegistry())
+
+    server.status_code = 429
+    assert await resolver.get_groups(token) == []
+    assert resolver.fetch_failures.value == 1
+
+    server.status_code = 200
+    assert [g["id"] for g in await resolver.get_groups(token)] == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_lookups_do_not_block_event_loop():
+    tokens = [user_token(f"user-{i}") for i in range(5)]
+    server = StubGraphServer({token: ["a"] for token in tokens}, delay=0.1)
+    resolver = GraphGroupResolver(GRAPH_URL, http_client=server.client(), registry=MetricsRegistry())
+
+    start = time.perf_counter()
+    await asyncio.gather(*[resolver.get_groups(token) for token in tokens])
+
+    assert time.perf_counter() - start < 0.3
+
+
+def test_generate_filter_string():
+    filter_string = generateFilterString([{"id": "a"}, {"id": "b"}], "group_ids")
+
+    assert filter_string == "group_ids/any(g:search.in(g, 'a, b'))"
@@ -0,0 +1,127 @@
+from backend.history_trimming import HistoryTrimmer, SummaryCache
+from backend.metrics import MetricsRegistry
+
+
+def trimmer(budget):
+    # No encoding name: count with the length heuristic, without loading tiktoken data
+    return HistoryTrimmer(budget, encoding_name=None, registry=MetricsRegistry())
+
+
+def conversation(turns, words=40):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "word " * words})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "word " * words})
+    messages.append({"role": "user", "content": "latest question"})
+    return messages
+
+
+def test_history_within_budget_is_unchanged():
+    history_trimmer = trimmer(100_000)
+    messages = conversation(5)
+
+    kept, dropped = history_trimmer.trim(messages)
+
+    assert kept == messages
+    assert dropped == []
+    assert history_trimmer.trimmed_requests.value == 0
+    assert history_trimmer.sent_tokens.sum == history_trimmer.count_tokens(messages)
+
+
+def test_keeps_system_latest_and_recent_turns():
+    history_trimmer = trimmer(250)
+    messages = conversation(10)
+
+    kept, dropped = history_trimmer.trim(messages)
+
+    assert kept[0] == messages[0]
+    assert kept[-1] == messages[-1]
+    assert kept[1]["role"] == "user"
+    assert kept[1:-1] == messages[len(messages) - len(kept) + 1:-1]
+    assert dropped == messages[1:len(messages) - len(kept) + 1]
+    assert history_trimmer.count_tokens(kept) <= 250
+    assert history_trimmer.dropped_messages.value == len(dropped)
+    assert history_trimmer.prompt_tokens.sum == history_trimmer.count_tokens(messages)
+    assert history_trimmer.sent_tokens.sum == history_trimmer.count_tokens(kept)
+
+
+def test_kept_history_starts_with_user_message():
+    history_trimmer = trimmer(10_000)
+    messages = conversation(3)
+    # Budget leaves room for the last assistant reply but not its question
+    budget = history_trimmer.count_tokens([messages[0], messages[-2], messages[-1]])
+    history_trimmer.budget = budget
+
+    kept, dropped = history_trimmer.trim(messages)
+
+    assert kept == [messages[0], messages[-1]]
+    assert len(dropped) == len(messages) - 2
+
+
+def test_latest_message_kept_over_budget():
+    history_trimmer = trimmer(10)
+    messages = conversation(2)
+
+    kept, _ = history_trimmer.trim(messages)
+
+    assert kept == [messages[0], messages[-1]]
+
+
+def test_reserved_tokens_reduce_budget():
+    messages = conversation(10)
+    budget = 600
+
+    kept, _ = trimmer(budget).trim(messages)
+    kept_with_reserve, _ = trimmer(budget).trim(messages, reserved_tokens=200)
+
+    assert len(kept_with_reserve) < len(kept)
+
+
+def test_counts_only_model_fields():
+    history_trimmer = trimmer(1000)
+    message = {"role": "user", "content": "hello"}
+    stored_message = dict(message, id="0c4a4e1c-53d4-4e5c-a3c5-5d2c1a2b3c4d", date="2024-01-01T00:00:00")
+
+    assert history_trimmer.count_message(stored_message) == history_trimmer.count_message(message)
+    assert history_trimmer.count_message({"role": "assistant", "content": None, "context": {"citations": []}}) > 3
+
+
+def test_unavailable_encoding_falls_back_to_estimate():
+    history_trimmer = HistoryTrimmer(100, encoding_name="not-an-encoding", registry=MetricsRegistry())
+
+    assert history_trimmer.load_encoding() is None
+    assert history_trimmer.count_message({"role": "user", "content": "x" * 40}) == 3 + 1 + 10
+
+
+def test_fit_keeps_newest_messages_from_a_user_message():
+    history_trimmer = trimmer(0)
+    history = conversation(10)[1:-1]
+
+    fitted = history_trimmer.fit(history, 200)
+
+    assert fitted == history[len(history) - len(fitted):]
+    assert fitted[0]["role"] == "user"
+    assert sum(history_trimmer.count_message(message) for message in fitted) <= 200
+    assert history_trimmer.fit(history, 0) == []
+
+
+def test_summary_cache_finds_longest_summarized_prefix():
+    cache = SummaryCache(max_entries=2, registry=MetricsRegistry())
+    history = conversation(5)[1:-1]
+
+    assert cache.get(history) == (0, None)
+    cache.put(history[:2], "first")
+    cache.put(history[:6], "second")
+
+    assert cache.get(history) == (6, "second")
+    assert cache.get(history[:4]) == (2, "first")
+    # Stored fields other than role and content do not change the key
+    assert cache.get([dict(history[0], id="1"), history[1]]) == (2, "first")
+    assert cache.get(history[1:]) == (0, None)
+
+    # The least recently used summary is evicted
+    cache.put(history[:8], "third")
+    assert cache.get(history) == (8, "third")
+    assert cache.get(history[:6]) == (2, "first")
+    assert cache.hits.value == 5
+    assert cache.misses.value == 2
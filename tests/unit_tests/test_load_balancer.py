@@ -0,0 +1,233 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+from backend.load_balancer import Deployment, LoadBalancer, TrackedStream
+from backend.metrics import MetricsRegistry
+from backend.resilience import RetryBudget, RetryPolicy
+
+
+def status_error(status_code, headers=None):
+    response = httpx.Response(
+        status_code,
+        headers=headers or {},
+        request=httpx.Request("POST", "https://aoai.example/openai/deployments/gpt-4/chat/completions"),
+    )
+    error_class = openai.RateLimitError if status_code == 429 else openai.InternalServerError
+    return error_class("error", response=response, body=None)
+
+
+def pool(*weights, **kwargs):
+    deployments = [Deployment(f"d{i}", None, "gpt-4", weight=weight) for i, weight in enumerate(weights)]
+    return LoadBalancer(deployments, registry=MetricsRegistry(), **kwargs)
+
+
+class SimulatedEndpoint:
+    '''Deployment serving ``capacity`` concurrent requests, throttling the rest'''
+    def __init__(self, capacity=4, latency=0.02):
+        self.capacity = capacity
+        self.latency = latency
+        self.active = 0
+        self.served = 0
+
+    async def complete(self):
+        if self.active >= self.capacity:
+            raise status_error(429, {"retry-after-ms": "10"})
+        self.active += 1
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.active -= 1
+        self.served += 1
+        return "answer"
+
+
+async def simulate(endpoints, duration=0.5, concurrency=12):
+    load_balancer = LoadBalancer(
+        [Deployment(f"d{i}", endpoint, "gpt-4") for i, endpoint in enumerate(endpoints)],
+        registry=MetricsRegistry(),
+    )
+    retry_policy = RetryPolicy(
+        max_attempts=1000,
+        base_delay=0.01,
+        budget=RetryBudget(min_retries_per_second=100000),
+        registry=MetricsRegistry(),
+    )
+
+    async def complete(lease):
+        result = await lease.deployment.client.complete()
+        lease.release(tokens=10)
+        return result
+
+    async def worker(deadline):
+        while time.monotonic() < deadline:
+            await retry_policy.call(lambda: load_balancer.call(complete))
+
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[worker(deadline) for _ in range(concurrency)])
+    return sum(endpoint.served for endpoint in endpoints) / duration
+
+
+def test_routes_to_least_loaded():
+    load_balancer = pool(1, 1, 1)
+
+    leases = [load_balancer.acquire() for _ in range(3)]
+    assert {lease.deployment.name for lease in leases} == {"d0", "d1", "d2"}
+
+    leases[1].release()
+    assert load_balancer.acquire().deployment is leases[1].deployment
+
+
+def test_routes_by_weight():
+    load_balancer = pool(2, 1)
+
+    names = [load_balancer.acquire().deployment.name for _ in range(6)]
+    assert names.count("d0") == 4
+    assert names.count("d1") == 2
+
+
+def test_spreads_sequential_requests_by_token_rate():
+    load_balancer = pool(1, 1)
+
+    first = load_balancer.acquire()
+    first.release(tokens=500)
+    second = load_balancer.acquire()
+    assert second.deployment is not first.deployment
+
+
+def test_throttled_deployment_ejected_until_reset():
+    load_balancer = pool(1, 1)
+    lease = load_balancer.acquire()
+    throttled = lease.deployment
+    lease.release(status_error(429, {"retry-after-ms": "50"}))
+
+    assert load_balancer.available() == [d for d in load_balancer.deployments if d is not throttled]
+    assert load_balancer.healthy_deployments.value == 1
+    assert all(load_balancer.acquire().deployment is not throttled for _ in range(5))
+
+    time.sleep(0.06)
+    # Half-open: one probe at a time
+    probe = load_balancer.acquire(exclude=[d for d in load_balancer.deployments if d is not throttled])
+    assert probe.deployment is throttled
+    assert throttled not in load_balancer.available()
+    probe.release()
+    assert throttled in load_balancer.available()
+
+
+def test_breaker_opens_after_consecutive_server_errors():
+    load_balancer = pool(1, failure_threshold=2, cooldown=30)
+    deployment = load_balancer.deployments[0]
+
+    load_balancer.acquire().release(status_error(500))
+    assert deployment.available(time.monotonic())
+    load_balancer.acquire().release(status_error(500))
+    assert not deployment.available(time.monotonic())
+
+    # Nothing healthy left; requests are still served rather than failed
+    assert load_balancer.acquire().deployment is deployment
+    assert load_balancer.no_healthy_deployment.value == 1
+
+
+def test_client_errors_do_not_eject():
+    load_balancer = pool(1, failure_threshold=1)
+
+    load_balancer.acquire().release(openai.BadRequestError(
+        "bad request", response=status_error(400).response, body=None
+    ))
+    assert load_balancer.available() == load_balancer.deployments
+
+
+@pytest.mark.asyncio
+async def test_call_fails_over_to_another_deployment():
+    load_balancer = pool(1, 1)
+    attempts = []
+
+    async def complete(lease):
+        attempts.append(lease.deployment.name)
+        if len(attempts) == 1:
+            raise status_error(429, {"retry-after": "10"})
+        lease.release()
+        return lease.deployment.name
+
+    assert await load_balancer.call(complete) == attempts[1]
+    assert attempts[0] != attempts[1]
+    assert load_balancer.failovers.value == 1
+    assert all(deployment.in_flight == 0 for deployment in load_balancer.deployments)
+
+
+@pytest.mark.asyncio
+async def test_call_without_alternative_raises():
+    load_balancer = pool(1)
+
+    async def complete(lease):
+        raise status_error(503)
+
+    with pytest.raises(openai.InternalServerError):
+        await load_balancer.call(complete)
+    assert load_balancer.deployments[0].in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_holds_lease_until_consumed():
+    load_balancer = pool(1)
+
+    class Stream:
+        closed = False
+
+        async def __aiter__(self):
+            for chunk in ["a", "b", "c"]:
+                yield chunk
+
+        async def close(self):
+            self.closed = True
+
+    lease = load_balancer.acquire()
+    stream = TrackedStream(Stream(), lease)
+    deployment = lease.deployment
+    assert deployment.in_flight == 1
+
+    assert [chunk async for chunk in stream] == ["a", "b", "c"]
+    assert deployment.in_flight == 0
+    assert deployment.token_rate(time.monotonic()) == 3
+
+    lease = load_balancer.acquire()
+    await TrackedStream(Stream(), lease).close()
+    assert deployment.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_throughput_scales_with_deployments():
+    single = await simulate([SimulatedEndpoint()])
+    pooled = await simulate([SimulatedEndpoint() for _ in range(3)])
+
+    # Each endpoint serves at most 4 / 0.02s = 200 requests per second
+    assert pooled > 2 * single
+
+
+@pytest.mark.asyncio
+async def test_closing_stream_early_counts_tokens_saved():
+    load_balancer = pool(1)
+
+    class Stream:
+        async def __aiter__(self):
+            for chunk in ["a", "b", "c", "d"]:
+                yield chunk
+
+        async def close(self):
+            pass
+
+    assert len([chunk async for chunk in TrackedStream(Stream(), load_balancer.acquire(), max_tokens=100)]) == 4
+    assert load_balancer.abandoned_streams.value == 0
+
+    stream = TrackedStream(Stream(), load_balancer.acquire(), max_tokens=100)
+    async for chunk in stream:
+        break
+    await stream.close()
+
+    assert load_balancer.abandoned_streams.value == 1
+    # Answers have been 4 tokens long, 1 was generated
+    assert load_balancer.tokens_saved.value == 3
+    assert load_balancer.deployments[0].in_flight == 0
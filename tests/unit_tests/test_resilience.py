@@ -0,0 +1,167 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+from backend.metrics import MetricsRegistry
+from backend.resilience import RetryBudget, RetryPolicy, retry_after
+
+
+def completion(content):
+    return {
+        "id": "chatcmpl-1",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-4",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+    }
+
+
+class ThrottlingServer:
+    '''Azure OpenAI chat completions endpoint answering the first requests with 429s'''
+    def __init__(self, throttled=1, headers=None, status_code=429, delays=()):
+        self.throttled = throttled
+        self.headers = headers if headers is not None else {"retry-after-ms": "300"}
+        self.status_code = status_code
+        self.delays = list(delays)
+        self.requests = 0
+
+    async def handler(self, request: httpx.Request):
+        self.requests += 1
+        number = self.requests
+        if self.delays:
+            await asyncio.sleep(self.delays.pop(0))
+        if number <= self.throttled:
+            return httpx.Response(self.status_code, headers=self.headers, json={"error": {"message": "throttled"}})
+        return httpx.Response(200, json=completion(f"answer {number}"))
+
+    def client(self):
+        return openai.AsyncAzureOpenAI(
+            api_key="key",
+            api_version="2024-05-01-preview",
+            azure_endpoint="https://aoai.example",
+            max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(self.handler)),
+        )
+
+
+def create(client):
+    async def create():
+        response = await client.chat.completions.create(model="gpt-4", messages=[{"role": "user", "content": "Hi"}])
+        return response.choices[0].message.content
+
+    return create
+
+
+def policy(**kwargs):
+    return RetryPolicy(registry=MetricsRegistry(), **kwargs)
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "300"}, 0.3),
+    ({"retry-after": "2"}, 2.0),
+    ({"x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "6m0s"}, 360.0),
+    ({"x-ratelimit-reset-tokens": "250ms"}, 0.25),
+    ({"x-ratelimit-reset-tokens": "soon"}, None),
+    ({}, None),
+])
+def test_retry_after(headers, expected):
+    assert retry_after(httpx.Headers(headers)) == expected
+
+
+def test_retry_after_http_date():
+    headers = httpx.Headers({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})
+    assert retry_after(headers) == 0.0
+
+
+@pytest.mark.asyncio
+async def test_throttled_request_retried_after_requested_delay():
+    server = ThrottlingServer(throttled=1, headers={"retry-after-ms": "300"})
+    retry_policy = policy()
+
+    start = time.monotonic()
+    assert await retry_policy.call(create(server.client())) == "answer 2"
+
+    assert time.monotonic() - start >= 0.3
+    assert server.requests == 2
+    assert retry_policy.retries.value == 1
+
+
+@pytest.mark.asyncio
+async def test_backoff_without_headers_is_jittered_exponential():
+    server = ThrottlingServer(throttled=2, headers={}, status_code=503)
+    retry_policy = policy(base_delay=0.01)
+
+    assert await retry_policy.call(create(server.client())) == "answer 3"
+    assert server.requests == 3
+    for attempt in range(5):
+        assert 0 <= retry_policy.backoff(attempt, RuntimeError()) <= 0.01 * 2 ** attempt
+
+
+@pytest.mark.asyncio
+async def test_gives_up_after_max_attempts():
+    server = ThrottlingServer(throttled=10, headers={"retry-after-ms": "1"})
+
+    with pytest.raises(openai.RateLimitError):
+        await policy(max_attempts=3).call(create(server.client()))
+    assert server.requests == 3
+
+
+@pytest.mark.asyncio
+async def test_long_retry_after_fails_immediately():
+    server = ThrottlingServer(throttled=1, headers={"retry-after": "60"})
+
+    with pytest.raises(openai.RateLimitError):
+        await policy(max_delay=20).call(create(server.client()))
+    assert server.requests == 1
+
+
+@pytest.mark.asyncio
+async def test_client_errors_are_not_retried():
+    server = ThrottlingServer(throttled=1, status_code=400)
+
+    with pytest.raises(openai.BadRequestError):
+        await policy().call(create(server.client()))
+    assert server.requests == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_budget_limits_retries():
+    server = ThrottlingServer(throttled=100, headers={"retry-after-ms": "1"})
+    retry_policy = policy(budget=RetryBudget(ratio=0.5, min_retries_per_second=0))
+    client = create(server.client())
+
+    results = await asyncio.gather(*[retry_policy.call(client) for _ in range(10)], return_exceptions=True)
+
+    assert all(isinstance(result, openai.RateLimitError) for result in results)
+    # 10 requests, a budget of 5 retries instead of 20
+    assert server.requests == 15
+    assert retry_policy.retries.value == 5
+    assert retry_policy.budget_exhausted.value == 10
+
+
+@pytest.mark.asyncio
+async def test_slow_call_is_hedged():
+    server = ThrottlingServer(throttled=0, delays=[1.0, 0.01])
+    retry_policy = policy(hedge_percentile=95, hedge_min_samples=3)
+    retry_policy._latencies.extend([0.02, 0.03, 0.05])
+
+    start = time.monotonic()
+    assert await retry_policy.call(create(server.client()), hedge=True) == "answer 2"
+
+    assert time.monotonic() - start < 0.5
+    assert retry_policy.hedged_calls.value == 1
+    assert retry_policy.hedge_wins.value == 1
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_before_enough_samples():
+    server = ThrottlingServer(throttled=0, delays=[0.1])
+    retry_policy = policy(hedge_percentile=95, hedge_min_samples=3)
+
+    assert await retry_policy.call(create(server.client()), hedge=True) == "answer 1"
+    assert server.requests == 1
+    assert retry_policy.hedged_calls.value == 0
+    assert len(retry_policy._latencies) == 1
@@ -0,0 +1,120 @@
+import time
+
+from backend.metrics import MetricsRegistry
+from backend.response_cache import ResponseCache, normalize_question
+
+
+ANSWER = [
+    {"role": "tool", "content": "{\"citations\": [{\"content\": \"Handbook\"}]}"},
+    {"role": "assistant", "content": "You get 20 days of vacation."},
+]
+
+
+def cache(**kwargs):
+    return ResponseCache(registry=MetricsRegistry(), **kwargs)
+
+
+def test_normalize_question():
+    assert normalize_question("  How many   Vacation days?? ") == "how many vacation days"
+    assert normalize_question("?!") == ""
+
+
+def test_hit_after_put_with_normalized_question():
+    response_cache = cache()
+    assert response_cache.get("How many vacation days?", "scope") is None
+
+    response_cache.put("How many vacation days?", "scope", ANSWER, "gpt-4")
+    answer = response_cache.get("how many vacation days", "scope")
+
+    assert answer.messages == ANSWER
+    assert answer.model == "gpt-4"
+    assert response_cache.hits.value == 1
+    assert response_cache.misses.value == 1
+    assert response_cache.hit_rate == 0.5
+
+
+def test_exact_lookup_does_not_count_misses():
+    response_cache = cache()
+    assert response_cache.get_exact("How many vacation days?", "scope") is None
+    assert response_cache.misses.value == 0
+
+    response_cache.put("How many vacation days?", "scope", ANSWER, "gpt-4")
+    assert response_cache.get_exact("how many vacation days", "scope").messages == ANSWER
+    assert response_cache.get_exact("how many vacation days", "other") is None
+    assert response_cache.hits.value == 1
+
+
+def test_scopes_are_isolated():
+    response_cache = cache()
+    response_cache.put("How many vacation days?", "config:group-a", ANSWER, "gpt-4")
+
+    assert response_cache.get("How many vacation days?", "config:group-b") is None
+
+
+def test_entries_expire():
+    response_cache = cache(ttl=0.05)
+    response_cache.put("question", "scope", ANSWER, "gpt-4")
+    time.sleep(0.1)
+
+    assert response_cache.get("question", "scope") is None
+    assert response_cache.entries.value == 0
+
+
+def test_bounded_entries_in_lru_order():
+    response_cache = cache(max_entries=2)
+    response_cache.put("first", "scope", ANSWER, "gpt-4")
+    response_cache.put("second", "scope", ANSWER, "gpt-4")
+    response_cache.get("first", "scope")
+    response_cache.put("third", "scope", ANSWER, "gpt-4")
+
+    assert response_cache.get("second", "scope") is None
+    assert response_cache.get("first", "scope") is not None
+    assert response_cache.evictions.value == 1
+    assert response_cache.entries.value == 2
+
+
+def test_bounded_bytes():
+    answer = [{"role": "assistant", "content": "x" * 100}]
+    response_cache = cache(max_bytes=250)
+    for i in range(3):
+        response_cache.put(f"question {i}", "scope", answer, "gpt-4")
+
+    assert response_cache.bytes.value <= 250
+    assert response_cache.get("question 0", "scope") is None
+    assert response_cache.get("question 2", "scope") is not None
+
+    response_cache.put("huge", "scope", [{"role": "assistant", "content": "x" * 1000}], "gpt-4")
+    assert response_cache.get("huge", "scope") is None
+
+
+def test_similar_question_lookup():
+    response_cache = cache(similarity_threshold=0.9)
+    response_cache.put("How many vacation days do I get?", "scope", ANSWER, "gpt-4", embedding=[1.0, 0.0, 0.1])
+    response_cache.put("Where is the office?", "scope", ANSWER[1:], "gpt-4", embedding=[0.0, 1.0, 0.0])
+
+    answer = response_cache.get("What is my vacation allowance?", "scope", embedding=[0.9, 0.05, 0.1])
+    assert answer.messages == ANSWER
+    assert response_cache.semantic_hits.value == 1
+
+    assert response_cache.get("Unrelated", "scope", embedding=[0.5, 0.5, 0.7]) is None
+    assert response_cache.get("What is my vacation allowance?", "other", embedding=[0.9, 0.05, 0.1]) is None
+
+
+def test_similar_question_lookup_after_evictions():
+    response_cache = cache(similarity_threshold=0.9, max_entries=20)
+    # More questions than the cache holds, each along its own axis
+    for i in range(50):
+        embedding = [0.0] * 64
+        embedding[i] = 1.0
+        response_cache.put(f"Question {i}", "scope", ANSWER, "gpt-4", embedding=embedding)
+
+    def near(i):
+        embedding = [0.01] * 64
+        embedding[i] = 1.0
+        return embedding
+
+    # Evicted questions are not matched, the most similar cached one is
+    assert response_cache.get("Like question 5", "scope", embedding=near(5)) is None
+    assert response_cache.get("Like question 45", "scope", embedding=near(45)) is not None
+    assert response_cache.semantic_hits.value == 1
+    assert len(response_cache._indexes["scope"]) == 20
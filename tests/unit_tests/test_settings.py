@@ -1,6 +1,9 @@
+import asyncio
 import os
+import random
 import pytest
 from importlib import import_module, reload
+from types import SimpleNamespace
 
 
 @pytest.fixture(scope="function")
@@ -70,3 +73,29 @@ def test_dotenv_with_elasticsearch_success(app_settings):
     
     
 
+
+
+@pytest.mark.asyncio
+async def test_dotenv_with_azure_search_permitted_groups(app_settings):
+    class FakeGroupResolver:
+        async def get_groups(self, user_token):
+            # Let other requests run between resolving and building the payload
+            await asyncio.sleep(random.uniform(0, 0.01))
+            return [{"id": f"{user_token}-group"}]
+
+    async def build_payload(user):
+        request = SimpleNamespace(headers={"X-MS-TOKEN-AAD-ACCESS-TOKEN": user})
+        filter_string = await app_settings.datasource.resolve_filter_string(request, FakeGroupResolver())
+        await asyncio.sleep(random.uniform(0, 0.01))
+        return app_settings.datasource.construct_payload_configuration(filter_string=filter_string)
+
+    users = [f"user-{i}" for i in range(20)]
+    payloads = await asyncio.gather(*[build_payload(user) for user in users])
+
+    for user, payload in zip(users, payloads):
+        assert payload["type"] == "azure_search"
+        assert payload["parameters"]["filter"] == f"group_ids/any(g:search.in(g, '{user}-group'))"
+
+    # The shared settings payload is never modified by a request
+    assert "filter" not in app_settings.datasource.construct_payload_configuration()
+    assert app_settings.datasource.construct_payload_configuration()["parameters"]["index_name"] == "search_index"
@@ -0,0 +1,174 @@
+import asyncio
+import pytest
+
+from backend.metrics import MetricsRegistry
+from backend.single_flight import SingleFlight, StreamOverflowError
+
+
+class FakeUpstream:
+    def __init__(self, chunks, delay=0):
+        self.chunks = chunks
+        self.delay = delay
+        self.opened = 0
+        self.closed = False
+        self.sent = 0
+
+    async def open(self):
+        self.opened += 1
+        await asyncio.sleep(self.delay)
+        return self, "apim-1"
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.delay)
+            self.sent += 1
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+async def consume(single_flight, upstream, key="key", delay=0):
+    stream, metadata = await single_flight.stream(key, upstream.open)
+    chunks = []
+    async for chunk in stream:
+        chunks.append(chunk)
+        await asyncio.sleep(delay)
+    return metadata, chunks
+
+
+@pytest.mark.asyncio
+async def test_identical_streams_share_one_upstream_call():
+    single_flight = SingleFlight(registry=MetricsRegistry())
+    upstream = FakeUpstream(list(range(20)), delay=0.001)
+
+    results = await asyncio.gather(*[consume(single_flight, upstream) for _ in range(5)])
+
+    assert upstream.opened == 1
+    assert results == [("apim-1", list(range(20)))] * 5
+    assert single_flight.upstream_calls.value == 1
+    assert single_flight.shared_calls.value == 4
+    assert upstream.closed
+
+
+@pytest.mark.asyncio
+async def test_different_keys_do_not_share():
+    single_flight = SingleFlight(registry=MetricsRegistry())
+    upstream = FakeUpstream([1, 2, 3], delay=0.001)
+
+    await asyncio.gather(consume(single_flight, upstream, "a"), consume(single_flight, upstream, "b"))
+
+    assert upstream.opened == 2
+
+
+@pytest.mark.asyncio
+async def test_finished_flight_is_not_reused():
+    single_flight = SingleFlight(registry=MetricsRegistry())
+    upstream = FakeUpstream([1, 2, 3])
+
+    await consume(single_flight, upstream)
+    await consume(single_flight, upstream)
+
+    assert upstream.opened == 2
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_does_not_stall_others():
+    single_flight = SingleFlight(max_buffered_chunks=10, registry=MetricsRegistry())
+    upstream = FakeUpstream(list(range(100)))
+
+    async def slow():
+        stream, _ = await single_flight.stream("key", upstream.open)
+        await asyncio.sleep(0.2)
+        return [chunk async for chunk in stream]
+
+    fast = asyncio.create_task(consume(single_flight, upstream))
+    slow_task = asyncio.create_task(slow())
+
+    _, chunks = await asyncio.wait_for(fast, 0.1)
+    assert chunks == list(range(100))
+    with pytest.raises(StreamOverflowError):
+        await slow_task
+    assert single_flight.overflows.value == 1
+
+
+@pytest.mark.asyncio
+async def test_single_slow_subscriber_slows_down_upstream():
+    single_flight = SingleFlight(max_buffered_chunks=10, registry=MetricsRegistry())
+    upstream = FakeUpstream(list(range(100)))
+
+    stream, _ = await single_flight.stream("key", upstream.open)
+    chunks = [await stream.__anext__()]
+    # The client takes nothing more for a while
+    await asyncio.sleep(0.05)
+    assert upstream.sent <= 11
+
+    chunks += [chunk async for chunk in stream]
+    assert chunks == list(range(100))
+    assert single_flight.overflows.value == 0
+
+
+@pytest.mark.asyncio
+async def test_buffer_released_as_subscribers_read():
+    single_flight = SingleFlight(max_buffered_chunks=10, registry=MetricsRegistry())
+    upstream = FakeUpstream(list(range(100)), delay=0.001)
+
+    results = await asyncio.gather(*[consume(single_flight, upstream) for _ in range(3)])
+
+    assert all(chunks == list(range(100)) for _, chunks in results)
+    assert single_flight.overflows.value == 0
+
+
+@pytest.mark.asyncio
+async def test_open_error_propagates_to_all_subscribers():
+    single_flight = SingleFlight(registry=MetricsRegistry())
+
+    async def failing_open():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("429 Too Many Requests")
+
+    results = await asyncio.gather(
+        *[single_flight.stream("key", failing_open) for _ in range(3)],
+        return_exceptions=True
+    )
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert single_flight.upstream_calls.value == 1
+
+
+@pytest.mark.asyncio
+async def test_upstream_closed_when_all_subscribers_leave():
+    single_flight = SingleFlight(registry=MetricsRegistry())
+    upstream = FakeUpstream(list(range(1000)), delay=0.001)
+
+    async def read_some():
+        stream, _ = await single_flight.stream("key", upstream.open)
+        async for chunk in stream:
+            if chunk == 5:
+                break
+        await stream.aclose()
+
+    await asyncio.gather(read_some(), read_some())
+    await asyncio.sleep(0.01)
+
+    assert upstream.closed
+    assert upstream.sent < 20
+
+
+@pytest.mark.asyncio
+async def test_shared_call_survives_cancelled_caller():
+    single_flight = SingleFlight(registry=MetricsRegistry())
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "completion", "apim-1"
+
+    first = asyncio.create_task(single_flight.call("key", create))
+    second = asyncio.create_task(single_flight.call("key", create))
+    await asyncio.sleep(0.01)
+    first.cancel()
+
+    assert await second == ("completion", "apim-1")
+    assert len(calls) == 1
@@ -0,0 +1,118 @@
+import asyncio
+import time
+import pytest
+from azure.core.credentials import AccessToken
+
+from backend.auth.token_cache import CachedTokenProvider
+from backend.metrics import MetricsRegistry
+
+
+class FakeCredential:
+    def __init__(self, ttl=3600, fail=False, delay=0):
+        self.ttl = ttl
+        self.fail = fail
+        self.delay = delay
+        self.calls = 0
+        self.closed = False
+
+    async def get_token(self, *scopes):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.fail:
+            raise Exception("token endpoint unavailable")
+        return AccessToken(f"token-{self.calls}", time.time() + self.ttl)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_token_served_from_cache():
+    credential = FakeCredential()
+    provider = CachedTokenProvider(credential, registry=MetricsRegistry())
+    await provider.start()
+
+    tokens = await asyncio.gather(*(provider() for _ in range(10)))
+
+    assert tokens == ["token-1"] * 10
+    assert credential.calls == 1
+    assert provider.hits.value == 10
+    assert provider.misses.value == 0
+
+    await provider.close()
+    assert credential.closed
+
+
+@pytest.mark.asyncio
+async def test_token_refreshed_ahead_of_expiry():
+    credential = FakeCredential(ttl=2)
+    provider = CachedTokenProvider(
+        credential,
+        refresh_margin=1.9,
+        registry=MetricsRegistry()
+    )
+    await provider.start()
+    assert await provider() == "token-1"
+
+    await asyncio.sleep(0.5)
+
+    assert provider.refreshes.value >= 1
+    assert await provider() != "token-1"
+    assert provider.misses.value == 0
+
+    await provider.close()
+
+
+@pytest.mark.asyncio
+async def test_refresh_does_not_block_callers():
+    credential = FakeCredential(ttl=2)
+    provider = CachedTokenProvider(
+        credential,
+        refresh_margin=1.9,
+        registry=MetricsRegistry()
+    )
+    await provider.start()
+    credential.delay = 1
+
+    # A refresh is now in flight; callers still get the cached token immediately
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    assert await provider() == "token-1"
+    assert time.perf_counter() - start < 0.1
+
+    await provider.close()
+
+
+@pytest.mark.asyncio
+async def test_refresh_failure_keeps_cached_token():
+    credential = FakeCredential(ttl=2)
+    provider = CachedTokenProvider(
+        credential,
+        refresh_margin=1.9,
+        retry_interval=0.05,
+        registry=MetricsRegistry()
+    )
+    await provider.start()
+    credential.fail = True
+
+    await asyncio.sleep(0.3)
+
+    assert provider.refresh_failures.value >= 1
+    assert await provider() == "token-1"
+
+    await provider.close()
+
+
+@pytest.mark.asyncio
+async def test_token_acquired_once_on_concurrent_misses():
+    credential = FakeCredential(delay=0.05)
+    provider = CachedTokenProvider(credential, registry=MetricsRegistry())
+
+    tokens = await asyncio.gather(*(provider() for _ in range(5)))
+
+    assert tokens == ["token-1"] * 5
+    assert credential.calls == 1
+    assert provider.misses.value == 5
+
+    await provider.close()
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import time
+import httpx
+import pytest
+
+from backend.function_calling.tool_executor import ToolExecutor
+from backend.metrics import MetricsRegistry
+
+
+TOOL_URL = "https://functions.example.com/api/tool?code=dummy"
+
+
+class FakeToolServer:
+    def __init__(self, delays):
+        self.delays = delays
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.timeouts = []
+
+    async def handler(self, request: httpx.Request):
+        body = json.loads(request.content)
+        self.timeouts.append(request.extensions["timeout"]["read"])
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delays.get(body["tool_name"], 0))
+        finally:
+            self.in_flight -= 1
+        if body["tool_name"] == "broken":
+            return httpx.Response(500)
+        return httpx.Response(200, text=f'{body["tool_name"]}:{json.dumps(body["tool_arguments"])}')
+
+    def client(self):
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+
+
+@pytest.mark.asyncio
+async def test_tool_calls_run_concurrently_in_order():
+    server = FakeToolServer({"slow": 0.2, "medium": 0.1, "fast": 0})
+    executor = ToolExecutor(TOOL_URL, http_client=server.client(), max_concurrency=5, registry=MetricsRegistry())
+
+    start = time.perf_counter()
+    results = await executor.call_all([
+        ("slow", '{"n": 1}'),
+        ("medium", '{"n": 2}'),
+        ("fast", '{"n": 3}'),
+    ])
+    elapsed = time.perf_counter() - start
+
+    assert results == ['slow:{"n": 1}', 'medium:{"n": 2}', 'fast:{"n": 3}']
+    assert elapsed < 0.3
+    assert server.max_in_flight == 3
+    assert executor.calls.value == 3
+
+
+@pytest.mark.asyncio
+async def test_tool_calls_respect_concurrency_cap():
+    server = FakeToolServer({"tool": 0.05})
+    executor = ToolExecutor(TOOL_URL, http_client=server.client(), max_concurrency=2, registry=MetricsRegistry())
+
+    results = await executor.call_all([("tool", "{}")] * 6)
+
+    assert len(results) == 6
+    assert server.max_in_flight == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrency_cap_applies_per_batch():
+    server = FakeToolServer({"tool": 0.05})
+    executor = ToolExecutor(TOOL_URL, http_client=server.client(), max_concurrency=2, registry=MetricsRegistry())
+
+    # Two model responses served at the same time each get their own cap
+    await asyncio.gather(
+        executor.call_all([("tool", "{}")] * 4),
+        executor.call_all([("tool", "{}")] * 4),
+    )
+
+    assert server.max_in_flight == 4
+
+
+@pytest.mark.asyncio
+async def test_tool_call_timeout_overrides_client_default():
+    server = FakeToolServer({})
+    executor = ToolExecutor(TOOL_URL, http_client=server.client(), timeout=60, registry=MetricsRegistry())
+
+    await executor.call_all([("tool", "{}")])
+
+    # httpx would read for at most 5 seconds by default
+    assert server.timeouts == [60]
+
+
+@pytest.mark.asyncio
+async def test_tool_call_timeout():
+    server = FakeToolServer({"slow": 1})
+    executor = ToolExecutor(TOOL_URL, http_client=server.client(), timeout=0.05, registry=MetricsRegistry())
+
+    with pytest.raises(asyncio.TimeoutError):
+        await executor.call_all([("slow", "{}"), ("fast", "{}")])
+
+    assert executor.timeouts.value == 1
+
+
+@pytest.mark.asyncio
+async def test_tool_call_failure_cancels_remaining_calls():
+    server = FakeToolServer({"slow": 1})
+    executor = ToolExecutor(TOOL_URL, http_client=server.client(), registry=MetricsRegistry())
+
+    with pytest.raises(httpx.HTTPStatusError):
+        await executor.call_all([("slow", "{}"), ("broken", "{}")])
+
+    assert server.in_flight == 0
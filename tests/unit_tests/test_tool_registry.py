@@ -0,0 +1,133 @@
+import asyncio
+import httpx
+import pytest
+
+from backend.function_calling.tool_registry import ToolRegistry
+from backend.metrics import MetricsRegistry
+
+
+TOOLS_URL = "https://functions.example.com/api/tools?code=dummy"
+
+
+def tool(name):
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": f"{name} description",
+            "parameters": {"type": "object", "properties": {}},
+        },
+    }
+
+
+class FakeToolsServer:
+    def __init__(self, tools, etag='"v1"'):
+        self.tools = tools
+        self.etag = etag
+        self.status_code = 200
+        self.requests = []
+
+    def handler(self, request: httpx.Request):
+        self.requests.append(request)
+        if self.status_code != 200:
+            return httpx.Response(self.status_code)
+        if request.headers.get("If-None-Match") == self.etag:
+            return httpx.Response(304)
+        return httpx.Response(200, json=self.tools, headers={"ETag": self.etag})
+
+    def client(self):
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+
+
+@pytest.mark.asyncio
+async def test_tools_loaded_and_deduplicated():
+    server = FakeToolsServer([tool("get_weather"), tool("get_time"), tool("get_weather")])
+    registry = ToolRegistry(TOOLS_URL, ttl=0, http_client=server.client(), registry=MetricsRegistry())
+    await registry.start()
+
+    assert [t["function"]["name"] for t in registry.tools] == ["get_weather", "get_time"]
+    assert registry.available_tools == {"get_weather", "get_time"}
+    assert isinstance(registry.available_tools, frozenset)
+
+    await registry.close()
+
+
+@pytest.mark.asyncio
+async def test_refresh_does_not_grow_tools():
+    server = FakeToolsServer([tool("get_weather")])
+    registry = ToolRegistry(TOOLS_URL, ttl=0, http_client=server.client(), registry=MetricsRegistry())
+    await registry.start()
+
+    server.etag = '"v2"'
+    for _ in range(3):
+        await registry.refresh()
+
+    assert len(registry.tools) == 1
+    assert registry.fetches.value == 2
+    assert registry.not_modified.value == 2
+
+
+@pytest.mark.asyncio
+async def test_refresh_uses_etag():
+    server = FakeToolsServer([tool("get_weather")])
+    registry = ToolRegistry(TOOLS_URL, ttl=0, http_client=server.client(), registry=MetricsRegistry())
+    await registry.start()
+    tools = registry.tools
+
+    await registry.refresh()
+
+    assert server.requests[-1].headers["If-None-Match"] == '"v1"'
+    assert registry.not_modified.value == 1
+    assert registry.tools is tools
+
+    server.tools = [tool("get_weather"), tool("get_time")]
+    server.etag = '"v2"'
+    await registry.refresh()
+
+    assert registry.available_tools == {"get_weather", "get_time"}
+
+
+@pytest.mark.asyncio
+async def test_failed_refresh_keeps_previous_tools():
+    server = FakeToolsServer([tool("get_weather")])
+    registry = ToolRegistry(TOOLS_URL, ttl=0, http_client=server.client(), registry=MetricsRegistry())
+    await registry.start()
+
+    server.status_code = 500
+    await registry.refresh()
+
+    assert registry.available_tools == {"get_weather"}
+    assert registry.fetch_failures.value == 1
+
+
+@pytest.mark.asyncio
+async def test_background_refresh_after_ttl():
+    server = FakeToolsServer([tool("get_weather")])
+    registry = ToolRegistry(TOOLS_URL, ttl=0.05, http_client=server.client(), registry=MetricsRegistry())
+    await registry.start()
+
+    server.tools = [tool("get_time")]
+    server.etag = '"v2"'
+    await asyncio.sleep(0.2)
+
+    assert registry.available_tools == {"get_time"}
+
+    await registry.close()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_refreshes_are_consistent():
+    server = FakeToolsServer([tool("a"), tool("b")])
+    registry = ToolRegistry(TOOLS_URL, ttl=0, http_client=server.client(), registry=MetricsRegistry())
+
+    async def read():
+        await asyncio.sleep(0)
+        return set(t["function"]["name"] for t in registry.tools), registry.available_tools
+
+    results = await asyncio.gather(*[registry.refresh() for _ in range(5)], *[read() for _ in range(5)])
+
+    for result in results[5:]:
+        names, available = result
+        assert names == available
+    assert registry.available_tools == {"a", "b"}
+    assert len(registry.tools) == 2
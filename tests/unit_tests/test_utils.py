@@ -1,5 +1,18 @@
+import asyncio
+import httpx
+import json
+import logging
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from backend import utils
+from backend.utils import (
+    JSONEncoder,
+    RedactedModelArgs,
+    format_as_ndjson,
+    format_pf_stream_response,
+    parse_multi_columns,
+    parse_pf_stream,
+    redact_model_args,
+)
 
 
 @pytest.mark.asyncio
@@ -27,3 +40,263 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+def content_event(content, id="chatcmpl-1"):
+    return {
+        "id": id,
+        "model": "gpt-4",
+        "created": 0,
+        "object": "chat.completion.chunk",
+        "choices": [{"messages": [{"role": "assistant", "content": content}]}],
+        "history_metadata": {},
+        "apim-request-id": "apim",
+    }
+
+
+async def delayed_events(events, delay=0):
+    for event in events:
+        if delay:
+            await asyncio.sleep(delay)
+        yield event
+
+
+def parse_ndjson(lines):
+    return [json.loads(line) for line in lines]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesces_content():
+    events = [content_event(token) for token in ["Hel", "lo", " wor", "ld", "!"]]
+
+    lines = [
+        line async for line in format_as_ndjson(delayed_events(events), coalesce_window=0.05)
+    ]
+
+    contents = [e["choices"][0]["messages"][0]["content"] for e in parse_ndjson(lines)]
+    # The first token is flushed on its own, the rest is merged
+    assert contents == ["Hel", "lo world!"]
+    assert all(line.endswith("\n") for line in lines)
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesce_flushes_on_window():
+    events = [content_event(token) for token in ["a", "b", "c", "d"]]
+
+    lines = [
+        line async for line in format_as_ndjson(delayed_events(events, delay=0.04), coalesce_window=0.01)
+    ]
+
+    assert len(lines) == 4
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesce_flushes_on_byte_budget():
+    events = [content_event("x" * 10) for _ in range(10)]
+
+    lines = [
+        line async for line in format_as_ndjson(
+            delayed_events(events), coalesce_window=1, coalesce_max_bytes=30
+        )
+    ]
+
+    contents = [e["choices"][0]["messages"][0]["content"] for e in parse_ndjson(lines)]
+    assert contents == ["x" * 10, "x" * 30, "x" * 30, "x" * 30]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesce_preserves_other_events():
+    tool_event = content_event(None)
+    tool_event["choices"][0]["messages"] = [{"role": "tool", "content": "{\"citations\": []}"}]
+    events = [tool_event, content_event("a"), content_event("b"), {}, content_event("c")]
+
+    lines = [
+        line async for line in format_as_ndjson(delayed_events(events), coalesce_window=1)
+    ]
+
+    parsed = parse_ndjson(lines)
+    assert parsed[0]["choices"][0]["messages"][0]["role"] == "tool"
+    assert parsed[1]["choices"][0]["messages"][0]["content"] == "a"
+    assert parsed[2]["choices"][0]["messages"][0]["content"] == "b"
+    assert parsed[3] == {}
+    assert parsed[4]["choices"][0]["messages"][0]["content"] == "c"
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesce_reads_no_further_ahead_than_the_client():
+    read = 0
+
+    async def upstream():
+        nonlocal read
+        for i in range(1000):
+            read += 1
+            yield content_event(f"token {i} ")
+
+    lines = format_as_ndjson(upstream(), coalesce_window=1, coalesce_max_bytes=100)
+    first = await lines.__anext__()
+    # The client takes nothing more for a while
+    await asyncio.sleep(0.05)
+    assert read < 100
+
+    rest = [line async for line in lines]
+    contents = [e["choices"][0]["messages"][0]["content"] for e in parse_ndjson([first] + rest)]
+    assert "".join(contents) == "".join(f"token {i} " for i in range(1000))
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesce_ends_with_slow_client():
+    async def upstream():
+        yield content_event("a")
+        await asyncio.sleep(0.03)
+        yield content_event("b")
+        await asyncio.sleep(0.03)
+
+    async def read_slowly():
+        lines = []
+        async for line in format_as_ndjson(upstream(), coalesce_window=0.02):
+            lines.append(line)
+            # The stream ends while the client is still taking the window flush
+            if len(lines) == 2:
+                await asyncio.sleep(0.05)
+        return lines
+
+    lines = await asyncio.wait_for(read_slowly(), timeout=1)
+
+    contents = [e["choices"][0]["messages"][0]["content"] for e in parse_ndjson(lines)]
+    assert contents == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesce_exception():
+    async def failing_generator():
+        yield content_event("a")
+        yield content_event("b")
+        raise Exception("test exception")
+
+    lines = [
+        line async for line in format_as_ndjson(failing_generator(), coalesce_window=1)
+    ]
+
+    assert [json.loads(line) for line in lines[:2]] == [content_event("a"), content_event("b")]
+    assert lines[-1] == '{"error": "test exception"}'
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_template_is_byte_identical():
+    history_metadata = {"conversation_id": "conversation-1"}
+
+    def event(content, id="chatcmpl-1"):
+        e = content_event(content, id)
+        e["history_metadata"] = history_metadata
+        return e
+
+    async def stream():
+        for content in ["Hello", " \"quoted\" \\ path\n", "café ☃ \U0001f600", "\x00\x1f\x7f\t"]:
+            yield event(content)
+        # Fields around the content change mid-stream
+        history_metadata["title"] = "Generated title"
+        yield event("after title")
+        yield event("next response", id="chatcmpl-2")
+        yield event("")
+        reordered = event("reordered")
+        reordered["choices"][0]["messages"][0] = {"content": "reordered", "role": "assistant"}
+        yield reordered
+        yield {"id": "chatcmpl-2", "choices": [{"messages": [{"role": "tool", "content": "{}"}]}]}
+        yield {}
+        yield event("last")
+
+    expected = []
+    async for e in stream():
+        expected.append(json.dumps(e, cls=JSONEncoder) + "\n")
+    history_metadata.pop("title")
+
+    lines = [line async for line in format_as_ndjson(stream())]
+
+    assert lines == expected
+
+
+def model_args_with_secrets():
+    return {
+        "messages": [{"role": "user", "content": "Hello"}],
+        "model": "gpt-4",
+        "extra_body": {
+            "data_sources": [{
+                "type": "azure_search",
+                "parameters": {
+                    "index_name": "index",
+                    "key": "search-key",
+                    "authentication": {"type": "api_key", "key": "search-key"},
+                    "embedding_dependency": {
+                        "type": "endpoint",
+                        "authentication": {"type": "api_key", "key": "embedding-key"},
+                    },
+                },
+            }]
+        },
+    }
+
+
+def test_redact_model_args():
+    model_args = model_args_with_secrets()
+    original = json.dumps(model_args)
+
+    redacted = redact_model_args(model_args)
+
+    parameters = redacted["extra_body"]["data_sources"][0]["parameters"]
+    assert parameters["key"] == "*****"
+    assert parameters["authentication"] == {"type": "api_key", "key": "*****"}
+    assert parameters["embedding_dependency"]["authentication"] == {"type": "api_key", "key": "*****"}
+    assert parameters["index_name"] == "index"
+    # The request itself is untouched and the history is shared, not copied
+    assert json.dumps(model_args) == original
+    assert redacted["messages"] is model_args["messages"]
+    assert redact_model_args({"messages": []}) == {"messages": []}
+
+
+def test_redacted_model_args_only_rendered_for_debug(monkeypatch, caplog):
+    calls = []
+    monkeypatch.setattr(utils, "redact_model_args", lambda model_args: calls.append(model_args) or model_args)
+
+    with caplog.at_level(logging.INFO):
+        logging.debug("REQUEST BODY: %s", RedactedModelArgs({"model": "gpt-4"}))
+    assert calls == []
+
+    with caplog.at_level(logging.DEBUG):
+        logging.debug("REQUEST BODY: %s", RedactedModelArgs({"model": "gpt-4"}))
+    assert calls
+    assert '"model": "gpt-4"' in caplog.text
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content_type, body", [
+    ("text/event-stream", 'data: {"reply": "Hello"}\n\n: keep-alive\n\nevent: message\ndata: {"reply":\ndata:  " world"}\n\ndata: [DONE]\n\n'),
+    ("text/event-stream", 'data: {"reply": "Hello"}\r\n\r\ndata: {"reply": " world"}'),
+    ("application/jsonl", '{"reply": "Hello"}\n\n{"reply": " world"}\n'),
+])
+async def test_parse_pf_stream(content_type, body):
+    response = httpx.Response(200, headers={"content-type": content_type}, content=body.encode())
+
+    assert [event async for event in parse_pf_stream(response)] == [{"reply": "Hello"}, {"reply": " world"}]
+
+
+@pytest.mark.asyncio
+async def test_parse_pf_stream_plain_json():
+    response = httpx.Response(200, json={"reply": "Hello world", "documents": []})
+
+    assert [event async for event in parse_pf_stream(response)] == [{"reply": "Hello world", "documents": []}]
+
+
+def test_format_pf_stream_response():
+    events = format_pf_stream_response(
+        {"reply": "You get", "documents": [{"content": "Handbook"}]}, {}, "reply", "documents", "message-1"
+    )
+
+    assert [event["choices"][0]["messages"] for event in events] == [
+        [{"role": "tool", "content": json.dumps({"citations": [{"content": "Handbook"}]})}],
+        [{"role": "assistant", "content": "You get"}],
+    ]
+    assert all(event["id"] == "message-1" for event in events)
+    assert format_pf_stream_response({"reply": ""}, {}, "reply", "documents", "message-1") == []
+
+    with pytest.raises(Exception, match="flow failed"):
+        format_pf_stream_response({"error": "flow failed"}, {}, "reply", "documents", "message-1")